@@ -1,2 +1,27 @@
+#!/bin/bash
+# ./deploy.sh              sync the site to the public bucket and invalidate cloudfront
+# ./deploy.sh lambdas      zip every lambda with lambdas/satlib and update its code
+# ./deploy.sh lambdas get_visible id_visible
+#                          only the named lambdas
+if [ "$1" = "lambdas" ]; then
+    set -e
+    shift
+    names="$@"
+    if [ -z "$names" ]; then
+        names="get_visible id_visible get_opportunities precompute_grid refresh_data"
+    fi
+
+    mkdir -p build
+    for name in $names; do
+        zip_path="$PWD/build/$name.zip"
+        rm -f "$zip_path"
+        # lambda_function.py (and snapshot.pkl if written) at the root, satlib next to it
+        (cd "lambdas/$name" && zip -qr "$zip_path" . -x "__pycache__/*")
+        (cd lambdas && zip -qr "$zip_path" satlib -x "*/__pycache__/*")
+        aws lambda update-function-code --function-name "sat-finder-${name//_/-}" --zip-file "fileb://$zip_path"
+    done
+    exit 0
+fi
+
 aws s3 sync . s3://sat-finder-public --exclude="*" --include="*.html" --include="*.css" --include="*.js"
 aws cloudfront create-invalidation --distribution-id E3J96IK4F0VX62 --paths "/*"
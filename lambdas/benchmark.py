@@ -0,0 +1,332 @@
+"""
+Benchmark the lambda pipeline stages on synthetic catalogs of increasing size
+
+    python benchmark.py --data-dir /tmp/bench --ephem /path/to/de421.bsp --out results.json
+    python benchmark.py --data-dir /tmp/bench --ephem /path/to/de421.bsp --compare results.json
+
+For every catalog size a local data directory is generated (once, reused on
+later runs) with valid TLEs for a mix of LEO, MEO, GEO and Molniya orbits with
+epochs at the benchmark time, stored as JSON and as the binary catalog that
+refresh_data writes. The lambdas are then run against it stage by stage:
+
+    read_satellite_data     get_visible, read and json decode the catalog
+    load_catalog            get_visible, cold parse and propagator build
+    propagate_ecef_sunlit   get_visible, whole catalog at one time
+    visible_local           get_visible, one observer
+    identify_object         id_visible, one pointing direction
+    find_passes             get_opportunities, pass search over --pass-hours
+
+Each stage reports median and min wall time over --repeats runs, throughput in
+satellites per second and peak traced memory (one extra run under tracemalloc,
+numpy allocations included). Results are saved as JSON along with the commit
+and package versions, and --compare prints the ratio to a previous run so
+speedups and regressions show up before deploying. Environment variables the
+lambdas read (PROPAGATOR, PARALLEL, ...) apply as usual. Without --ephem the
+sun comes from the analytic model (SUN_MODEL=analytic).
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import subprocess
+import tracemalloc
+from datetime import datetime
+
+import numpy as np
+
+LAMBDAS_DIR = os.path.dirname(os.path.abspath(__file__))
+
+SIZES = [100, 1000, 10000, 30000]
+STAGES = ["read_satellite_data", "load_catalog", "propagate_ecef_sunlit", "visible_local", "identify_object", "find_passes"]
+
+# benchmark observer and pointing direction
+LAT = 40.0
+LON = -75.0
+POINT_AZ = 143.0
+POINT_EL = 60.0
+
+# share of each orbit family in the synthetic catalogs, roughly the active catalog
+ORBIT_MIX = {"leo": 0.85, "meo": 0.06, "geo": 0.07, "molniya": 0.02}
+
+# a stage slower than this ratio against --compare is flagged
+REGRESSION_RATIO = 1.2
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark sat-finder lambda stages on synthetic catalogs")
+    parser.add_argument("--data-dir", required=True, help="directory for the generated catalogs, one subdirectory per size")
+    parser.add_argument("--ephem", default=None, help="ephemeris file (de421.bsp) covering --time-utc, default analytic sun")
+    parser.add_argument("--sizes", default=",".join(str(n) for n in SIZES), help="comma separated catalog sizes")
+    parser.add_argument("--stages", default=",".join(STAGES), help="comma separated stages to run")
+    parser.add_argument("--time-utc", default="2024-06-01 03:00:00", help="benchmark time, also the TLE epoch")
+    parser.add_argument("--pass-hours", type=float, default=6.0, help="look ahead of the find_passes stage")
+    parser.add_argument("--repeats", type=int, default=5, help="timed runs per stage (find_passes runs once)")
+    parser.add_argument("--out", default=None, help="write results JSON here")
+    parser.add_argument("--compare", default=None, help="results JSON of a previous run to compare against")
+    args = parser.parse_args()
+
+    if args.ephem is None:
+        os.environ["SUN_MODEL"] = "analytic"
+
+    modules = load_lambdas()
+
+    results = {"commit": git_commit(),
+               "time": datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S"),
+               "machine": {"python": platform.python_version(),
+                           "platform": platform.platform(),
+                           "cpus": os.cpu_count(),
+                           "numpy": np.__version__,
+                           "sgp4": package_version("sgp4")},
+               "settings": {"time_utc": args.time_utc,
+                            "pass_hours": args.pass_hours,
+                            "repeats": args.repeats,
+                            "sun_model": os.environ.get("SUN_MODEL", "spk"),
+                            "propagator": os.environ.get("PROPAGATOR", "sgp4"),
+                            "parallel": os.environ.get("PARALLEL", "serial")},
+               "sizes": {}}
+
+    stages = args.stages.split(",")
+
+    for n in [int(size) for size in args.sizes.split(",")]:
+        local_dir = write_catalog_dir(modules["refresh_data"], args.data_dir, n, args.time_utc, args.ephem)
+        print("{} satellites ({})".format(n, local_dir))
+        results["sizes"][str(n)] = run_stages(modules, local_dir, n, stages, args)
+
+    if args.out is not None:
+        with open(args.out, "w") as f:
+            json.dump(results, f, indent=2)
+        print("Results written to {}".format(args.out))
+
+    if args.compare is not None:
+        with open(args.compare) as f:
+            compare_results(json.load(f), results)
+
+
+def load_lambdas():
+    """
+    Import every lambda that has a benchmarked stage, see local_server.load_lambda()
+    """
+    sys.path.insert(0, LAMBDAS_DIR)
+    from local_server import load_lambda
+
+    return {name: load_lambda(name) for name in ["get_visible", "id_visible", "get_opportunities", "refresh_data"]}
+
+
+def run_stages(modules, local_dir, n, stages, args):
+    """
+    Time each stage on one catalog directory
+
+    Returns:
+    dict of stage: {"median_ms", "min_ms", "sats_per_s", "peak_mb", "runs"}
+    """
+    gv = modules["get_visible"]
+    iv = modules["id_visible"]
+    go = modules["get_opportunities"]
+
+    lla = np.array([LAT, LON, 0])
+    time_utc = args.time_utc
+
+    from satlib.catalogs import catalog_cache, loaded_snapshots
+    from satlib.ephemeris import load_ephemeris, get_sun_direction_ecef
+    from satlib.propagation import propagate_ecef_sunlit
+
+    # keep the shipped snapshot out of it, the stages load from local_dir
+    for module in [gv, iv, go]:
+        loaded_snapshots.add(module.SNAPSHOT_PATH)
+
+    def load_cold():
+        catalog_cache.clear()
+        return gv.load_catalog("brightest", local_dir)
+
+    catalog = load_cold()
+    ephem = load_ephemeris(local_dir)
+    sats_ecef, sunlit = propagate_ecef_sunlit(catalog["sats"], time_utc, ephem, catalog["satrecs"])
+    sun_ecef = get_sun_direction_ecef(time_utc, ephem)
+
+    go_catalog = go.load_catalog(local_dir)
+
+    work = {"read_satellite_data": lambda: gv.read_satellite_data("brightest", local_dir),
+            "load_catalog": load_cold,
+            "propagate_ecef_sunlit": lambda: propagate_ecef_sunlit(catalog["sats"], time_utc, ephem, catalog["satrecs"]),
+            "visible_local": lambda: gv.visible_local(catalog["names"], sats_ecef, sun_ecef, sunlit, lla),
+            "identify_object": lambda: iv.identify_object(POINT_AZ, POINT_EL, catalog["names"], sats_ecef, sunlit, lla),
+            "find_passes": lambda: go.find_passes(go_catalog, time_utc, args.pass_hours, ephem, lla)}
+
+    res = {}
+    for stage in stages:
+        repeats = 1 if stage == "find_passes" else args.repeats
+        res[stage] = time_stage(work[stage], n, repeats)
+        print("  {:<24} {:10.2f} ms {:14.0f} sats/s {:10.1f} MB peak".format(stage, res[stage]["median_ms"],
+                                                                          res[stage]["sats_per_s"], res[stage]["peak_mb"]))
+
+    return res
+
+
+def time_stage(run, n, repeats):
+    """
+    Median and min wall time of run() over repeats after one warm up call,
+    then peak traced memory of one more call
+
+    Returns:
+    dict with median_ms, min_ms, sats_per_s, peak_mb, runs
+    """
+    run()
+
+    times = []
+    for _ in range(repeats):
+        t0 = time.perf_counter()
+        run()
+        times.append(time.perf_counter() - t0)
+
+    tracemalloc.start()
+    run()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    median_s = float(np.median(times))
+
+    return {"median_ms": median_s * 1000.0,
+            "min_ms": float(np.min(times)) * 1000.0,
+            "sats_per_s": n / median_s if median_s > 0 else float("inf"),
+            "peak_mb": peak / 1e6,
+            "runs": repeats}
+
+
+def compare_results(old, new):
+    """
+    Print new/old median time for every size and stage in both runs, flagging
+    stages slower by more than REGRESSION_RATIO
+    """
+    print("Compared to {} ({}), new / old median time:".format(old.get("commit"), old.get("time")))
+    print("  {:>8} {:<24} {:>12} {:>12} {:>8}".format("sats", "stage", "old_ms", "new_ms", "ratio"))
+
+    for size, stages in new["sizes"].items():
+        for stage, timing in stages.items():
+            old_timing = old["sizes"].get(size, {}).get(stage)
+            if old_timing is None:
+                continue
+            ratio = timing["median_ms"] / old_timing["median_ms"]
+            flag = "  REGRESSION" if ratio > REGRESSION_RATIO else ""
+            print("  {:>8} {:<24} {:12.2f} {:12.2f} {:8.2f}{}".format(size, stage, old_timing["median_ms"],
+                                                                   timing["median_ms"], ratio, flag))
+
+
+def write_catalog_dir(refresh_data, data_dir, n, time_utc, ephem_path=None):
+    """
+    Local data directory with a synthetic catalog of n satellites, stored under
+    every object key the lambdas read (brightest for get_visible, sats for the
+    others) as JSON and binary. Existing directories are reused so the files,
+    and the versions the lambdas see, stay the same between runs
+
+    Returns:
+    path of the directory
+    """
+    local_dir = os.path.join(data_dir, "n{}".format(n))
+    epoch_dt = datetime.strptime(time_utc, "%Y-%m-%d %H:%M:%S")
+
+    if not os.path.exists(os.path.join(local_dir, "sats.bin")):
+        os.makedirs(local_dir, exist_ok=True)
+        sats = synthetic_catalog(n, epoch_dt)
+        body = json.dumps(sats).encode("UTF-8")
+        binary = refresh_data.catalog_to_binary(sats)
+
+        for name in ["brightest", "sats"]:
+            with open(os.path.join(local_dir, name + ".json"), "wb") as f:
+                f.write(body)
+            with open(os.path.join(local_dir, name + ".bin"), "wb") as f:
+                f.write(binary)
+
+    link = os.path.join(local_dir, "de421.bsp")
+    if ephem_path is not None and not os.path.exists(link):
+        os.symlink(os.path.abspath(ephem_path), link)
+
+    return local_dir
+
+
+def synthetic_catalog(n, epoch_dt, seed=0):
+    """
+    Satellite dict (name: (line1, line2)) of n valid TLEs drawn from ORBIT_MIX,
+    all with epoch epoch_dt. The same n and seed always give the same catalog
+
+    Returns:
+    dict with "SYNTH <satnum>" keys and TLE tuple values
+    """
+    rng = np.random.default_rng(seed)
+    families = rng.choice(list(ORBIT_MIX), size=n, p=list(ORBIT_MIX.values()))
+
+    epoch = "{:02d}{:012.8f}".format(epoch_dt.year % 100, epoch_dt.timetuple().tm_yday +
+                                     (epoch_dt.hour * 3600 + epoch_dt.minute * 60 + epoch_dt.second) / 86400.0)
+
+    sats = {}
+    for i, family in enumerate(families):
+        if family == "leo":
+            elements = (rng.uniform(0, 110), rng.uniform(0, 0.02), rng.uniform(11.5, 16.0), rng.uniform(1e-5, 5e-4))
+        elif family == "meo":
+            elements = (rng.uniform(50, 65), rng.uniform(0, 0.02), rng.uniform(1.8, 2.2), 0.0)
+        elif family == "geo":
+            elements = (rng.uniform(0, 15), rng.uniform(0, 0.001), rng.uniform(0.99, 1.01), 0.0)
+        else:
+            elements = (rng.uniform(62, 64), rng.uniform(0.6, 0.75), rng.uniform(2.0, 2.01), 0.0)
+
+        inclo, ecco, mean_motion, bstar = elements
+        satnum = 10000 + i
+        sats["SYNTH {}".format(satnum)] = tle_lines(satnum, epoch, inclo, rng.uniform(0, 360), ecco,
+                                                   rng.uniform(0, 360), rng.uniform(0, 360), mean_motion, bstar)
+
+    return sats
+
+
+def tle_lines(satnum, epoch, inclo, nodeo, ecco, argpo, mo, mean_motion, bstar):
+    """
+    Format elements (degrees, revs per day) as a TLE line pair with checksums
+    """
+    line1 = "1 {:05d}U 24001A   {} {} {} {} 0  999".format(satnum, epoch, " .00000000", " 00000-0", tle_exponent(bstar))
+    line2 = "2 {:05d} {:8.4f} {:8.4f} {:07d} {:8.4f} {:8.4f} {:11.8f}{:5d}".format(
+        satnum, inclo, nodeo, int(round(ecco * 1e7)), argpo, mo, mean_motion, 1)
+
+    return line1 + tle_checksum(line1), line2 + tle_checksum(line2)
+
+
+def tle_exponent(value):
+    """
+    TLE assumed decimal point exponent field, e.g. 1.234e-5 -> " 12340-4"
+    """
+    if value == 0:
+        return " 00000-0"
+
+    exponent = int(np.floor(np.log10(abs(value)))) + 1
+    mantissa = int(round(abs(value) / 10.0 ** exponent * 1e5))
+    if mantissa == 100000:
+        mantissa, exponent = 10000, exponent + 1
+
+    return "{}{:05d}{:+d}".format("-" if value < 0 else " ", mantissa, exponent)
+
+
+def tle_checksum(line):
+    """
+    Modulo 10 checksum of the first 68 characters, minus signs count as 1
+    """
+    total = sum(int(c) if c.isdigit() else (1 if c == "-" else 0) for c in line[:68])
+    return str(total % 10)
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=LAMBDAS_DIR, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def package_version(name):
+    try:
+        from importlib.metadata import version
+        return version(name)
+    except Exception:
+        return None
+
+
+if __name__ == "__main__":
+    main()
@@ -1,30 +1,44 @@
 import os
 import json
-from datetime import datetime
-import boto3
+import time
+from datetime import timedelta
 
 import numpy as np
 
-from skyfield.api import load, utc, load_file
-from skyfield.sgp4lib import EarthSatellite
-from skyfield.framelib import itrs
-
-# Constants
-DEG2RAD = 0.017453292519943296
-RAD2DEG = 57.295779513082321
-RE_SEMIMAJOR_M = 6378137.0
-RE_SEMIMINOR_M = 6356752.0
-RE_MEAN_M = 6371008.0
+from sgp4.api import jday
+
+from satlib import geometry
+from satlib.storage import read_object_if_changed, maybe_gunzip
+from satlib.metrics import LOG_RESULTS, request_metrics, timed, count_metric
+from satlib.parallel import run_sharded
+from satlib.geometry import DEG2RAD, lla_to_ecef, lla_to_ecef_normal, ecef_to_az_el
+from satlib.ephemeris import (get_timescale, utc_time, teme_to_itrs_rotation, get_sun_position_ecef_m,
+                              sunlit_mask)
+from satlib.propagation import propagator_subset, propagate_teme
+from satlib.catalogs import (STARTUP, MASTER_CATALOG, master_catalog_group, load_catalog_object, group_view,
+                             load_with_ephemeris, snapshot_path, dump_snapshot, load_snapshot, warm_start)
+
+# PRECISION "float32" (geometry.COMPUTE_DTYPE) keeps the coarse pass search
+# grid (N,T,3 satellite positions relative to the observer) in single
+# precision, halving the memory and bandwidth of the biggest arrays of the
+# search. Positions are differenced in float64 first, so elevations are good to
+# around 1e-5 deg, far inside HORIZON_BUFFER. The fine search az/el come from
+# geometry.ecef_to_az_el in the same dtype. SGP4, time, frame rotations, sun
+# and shadow math stay float64, and the passes found are the same (see
+# test_precision())
+
+# candidate satellites per chunk in the fine pass search
+PARALLEL_PASS_CHUNK = int(os.environ.get("PARALLEL_PASS_CHUNK", "50"))
 
 DT_COARSE = 300
 DT_FINE = 10
 HORIZON_BUFFER = 30
+SUN_EL_MAX = 0.0
 
-s3 = boto3.client("s3")
-obj_bucket = "sat-finder-private"
 obj_sats_key = "sats.json"
-obj_ephem_key = "de421.bsp"
-lambda_tmp = "/tmp"
+
+# parsed catalog snapshot, see write_snapshot() and snapshot_path()
+SNAPSHOT_PATH = snapshot_path(__file__)
 
 
 def test_local(local_dir, lat, lon, time_utc, span_hours=24):
@@ -43,12 +57,46 @@ def test_local(local_dir, lat, lon, time_utc, span_hours=24):
     print(res)
 
 
+def test_precision(local_dir, lat, lon, time_utc, span_hours=24):
+    """
+    Compares the pass search with float32 observer relative positions
+    (PRECISION "float32") against float64, using path as a stand-in for bucket
+    """
+    lla = np.array([lat, lon, 0])
+    catalog, ephem = load_catalog_and_ephemeris(local_dir)
+
+    saved = geometry.COMPUTE_DTYPE
+    res = {}
+
+    try:
+        for dtype in [np.float64, np.float32]:
+            geometry.COMPUTE_DTYPE = dtype
+            start = time.perf_counter()
+            res[dtype] = find_passes(catalog, time_utc, span_hours, ephem, lla)
+            print("{}: {} passes in {:.2f} s".format(np.dtype(dtype).name, len(res[dtype]), time.perf_counter() - start))
+    finally:
+        geometry.COMPUTE_DTYPE = saved
+
+    passes64 = {(p["name"], p["start_utc"]): p for p in res[np.float64]}
+    passes32 = {(p["name"], p["start_utc"]): p for p in res[np.float32]}
+    common = passes64.keys() & passes32.keys()
+
+    max_step = max([abs(passes64[k][f] - passes32[k][f]) for k in common for f in passes64[k] if f.endswith(("_az", "_el"))], default=0)
+    differ = sum(passes64[k] != passes32[k] for k in common)
+
+    print("Passes only in float64: {}, only in float32: {}".format(len(passes64.keys() - common), len(passes32.keys() - common)))
+    print("Common passes that differ after rounding to whole deg: {} of {} (by at most {} deg)".format(differ, len(common), max_step))
+
+
 def lambda_handler(event, context):
     """
     For GET request, parameters are in event['queryStringParameters']
 
     {"lat": lat_degrees, "lon": lon_degrees, "time_utc": YYYY-MM-DD HH:MM:SS string, "span_hours": hours to look ahead}
 
+    Optional:
+    {"min_el": only return passes that peak above this elevation in deg}
+
     Returns:
     list of dicts {"name": str, "start/stop/peak_utc": str, "start/stop/peak_az": float, "start/stop/peak_el": float}
     """
@@ -57,212 +105,278 @@ def lambda_handler(event, context):
     else:
         local_dir = None
 
-    lat = float(event["queryStringParameters"]["lat"])
-    lon = float(event["queryStringParameters"]["lon"])
-    time_utc = event["queryStringParameters"]["time_utc"]
-    span_hours = float(event["queryStringParameters"]["span_hours"])
+    with request_metrics("get_opportunities", event) as metrics:
+        metrics["mode"] = "single"
 
-    print("Get visible for lat: {}, lon:{} from time: {} for {} hours".format(lat, lon, time_utc, span_hours))
+        lat = float(event["queryStringParameters"]["lat"])
+        lon = float(event["queryStringParameters"]["lon"])
+        time_utc = event["queryStringParameters"]["time_utc"]
+        span_hours = float(event["queryStringParameters"]["span_hours"])
+        min_el = float(event["queryStringParameters"].get("min_el", 0))
 
-    lla = np.array([lat, lon, 0])
-    sats = read_satellite_data(local_dir)
-    ephem = load_ephemeris(local_dir)
-    sats_ecef, sunlit = propagate_ecef_sunlit(sats, time_utc, ephem)
-    sun_ecef = get_sun_direction_ecef(time_utc, ephem)
-    viz = visible_local(list(sats.keys()), sats_ecef, sun_ecef, sunlit, lla)
+        print("Get visible for lat: {}, lon:{} from time: {} for {} hours".format(lat, lon, time_utc, span_hours))
+
+        lla = np.array([lat, lon, 0])
+        catalog, ephem = load_catalog_and_ephemeris(local_dir)
+        passes = find_passes(catalog, time_utc, span_hours, ephem, lla, min_el)
+
+        count_metric("results", len(passes))
 
-    print("Found: {}".format(viz))
+        if LOG_RESULTS == "on":
+            print("Found: {}".format(passes))
 
-    return viz
+        return passes
 
 
-def visible_local(sat_names, sats_ecef, sun_ecef, sunlit, lla):
+def find_passes(catalog, time_utc, span_hours, ephem, lla, min_el=0.0):
     """
-    Returns names of satellites that are in view of lla location
+    Find visible passes of every satellite over the next span_hours
+
+    The whole catalog is propagated on a DT_COARSE grid in one batched call.
+    Coarse intervals where a satellite comes within HORIZON_BUFFER deg of the
+    horizon while the observer is dark are then re-propagated on the DT_FINE
+    grid, one propagator call per satellite, and rise/peak/set are read off the fine
+    samples. Times are good to DT_FINE seconds. With PARALLEL "fork" both stages
+    are sharded over worker processes, see run_sharded().
+
+    A pass is the part of a trip above the horizon where the satellite is sunlit
+    (sunlit_mask(), the same test as get_visible and id_visible) and the sun is
+    below SUN_EL_MAX at the observer.
 
     Parameters:
-    sat_names: N, list of satellite names
-    sats_ecef: N,3 np.array of satellite ECEF positions in meters
-    sun_ecef: 3, np.array unit vector
-    sunlit: N, list of bools
+    catalog: dict with names and satrecs of N satellites, see load_catalog()
+    time_utc: string in format YYYY-MM-DD HH:MM:SS of search start time
+    span_hours: hours to look ahead
+    ephem: ephemeris object with sun data from load_ephemeris()
     lla: 3, np.array lat/lon/alt in deg/deg/alt
+    min_el: only return passes that peak above this elevation in deg
 
     Returns:
-    list of dicts {"name": str, "sunlit": bool, "sunphase": int, "az": float, "el": float
-        sunlit: describes whether the satellite is in the sun
-        sunphase: the angle between satellite and sun wrt location (180 good, 0 bad)
-        az: azimuth of satellite at location. 0 deg is north, 90 east, 180 south, 270 west
-        el: elivation of satellite above horizon
+    list of dicts {"name": str, "start/stop/peak_utc": str, "start/stop/peak_az": float, "start/stop/peak_el": float}
+        sorted by start time
     """
+    with timed("pass_grid"):
+        grid = pass_time_grid(time_utc, span_hours, ephem, lla)
+
     pos = lla_to_ecef(lla)
     normal = lla_to_ecef_normal(lla)
 
-    # north and east unit vectors used for azimuth calcs
-    north = np.array([0,0,1])
-    north = north - np.dot(north, normal) * normal
-    north = north / np.linalg.norm(north)
-    east = np.cross(north, normal)
+    # coarse grid shares fine grid samples so darkness lines up
+    step = int(DT_COARSE // DT_FINE)
+    coarse_idx = np.arange(0, grid["n_fine"], step)
+    if coarse_idx[-1] != grid["n_fine"] - 1:
+        coarse_idx = np.append(coarse_idx, grid["n_fine"] - 1)
 
-    inview = []
-    
-    for i in range(sats_ecef.shape[0]):
-        sat_pos = sats_ecef[i, :]
-        sat_rel = sat_pos - pos
-        sat_rel_unit = sat_rel / np.linalg.norm(sat_rel)
+    n = len(catalog["names"])
+    dark_cumsum = np.concatenate([[0], np.cumsum(grid["dark"])])
+    dark_interval = dark_cumsum[coarse_idx[1:] + 1] - dark_cumsum[coarse_idx[:-1]] > 0
 
-        # theta is angle off of zenith
-        cos_theta = np.dot(normal, sat_rel_unit)
+    # observer and zenith in TEME at each coarse time (rot is TEME -> ITRS), so
+    # the N,T,3 grid is never rotated
+    pos_teme_m = np.einsum("tji,j->ti", grid["rot"][coarse_idx], pos)
+    normal_teme = np.einsum("tji,j->ti", grid["rot"][coarse_idx], normal).astype(geometry.COMPUTE_DTYPE)
 
-        if cos_theta > 0:
-            # az/el in local frame, az CW from NORTH 
-            el = 90.0 - np.arccos(cos_theta) * RAD2DEG
+    def coarse(start, stop, out):
+        satrecs = catalog["satrecs"] if stop - start == n else propagator_subset(catalog, np.arange(start, stop))
+        err, pos_teme_km, _ = propagate_teme(satrecs, grid["jd"][coarse_idx], grid["fr"][coarse_idx])
 
-            sat_north = np.dot(sat_rel_unit, north)
-            sat_east = np.dot(sat_rel_unit, east)
-            az = np.arctan2(sat_east, sat_north) * RAD2DEG
+        # N,T,3 line of sight, differenced in float64 in place (no extra copy)
+        # then stored as COMPUTE_DTYPE
+        pos_teme_km *= 1000.0
+        pos_teme_km -= pos_teme_m
+        sat_rel = pos_teme_km.astype(geometry.COMPUTE_DTYPE, copy=False)
+        sat_rel[err != 0] = np.nan
 
-            # angle between sun and sat dirs (180 is good, 0 is bad)
-            sunphase = np.arccos(np.dot(sat_rel_unit, sun_ecef)) * RAD2DEG
+        sin_el = np.einsum("ntj,tj->nt", sat_rel, normal_teme) / np.linalg.norm(sat_rel, axis=2)
 
-            inview.append({"name": sat_names[i],
-                           "sunlit": sunlit[i],
-                           "sunphase": int(sunphase),
-                           "az": int(az),
-                           "el": int(el)})
-    return inview
+        # an interval is a candidate if either end is near the horizon and the
+        # observer is dark somewhere within it
+        near = sin_el > np.sin(-HORIZON_BUFFER * DEG2RAD)
+        near_interval = near[:, :-1] | near[:, 1:]
 
+        out["candidates"][:] = near_interval & dark_interval
 
-def read_satellite_data(local_dir=None):
-    """
-    Read satellite data from data.json file stored in S3, return as dict
+    with timed("coarse_search"):
+        arrays, _ = run_sharded(n, coarse, {"candidates": ((coarse_idx.size - 1,), bool)})
+    candidates = arrays["candidates"]
+    candidate_sats = np.flatnonzero(np.any(candidates, axis=1))
 
-    Parameters:
+    count_metric("satellites", n)
+    count_metric("candidate_satellites", candidate_sats.size)
 
-    Returns:
-    sat dict with name keys and tle tuple values
-    """
-    if local_dir is None:
-        data_s3 = s3.get_object(Bucket=obj_bucket, Key=obj_sats_key)
-        return json.loads(data_s3["Body"].read().decode("UTF-8"))
-    else:
-        with open(local_dir + "/" + obj_sats_key) as fptr:
-            data_local = json.load(fptr)
-        return data_local
+    def fine(start, stop, out):
+        chunk_passes = []
 
+        for i in candidate_sats[start:stop]:
+            intervals = np.flatnonzero(candidates[i])
+            fine_idx = np.unique(np.concatenate([np.arange(coarse_idx[k], coarse_idx[k + 1] + 1) for k in intervals]))
 
-def load_ephemeris(local_dir=None):
-    """
-    Use skyfield to load ephemeris from s3
-    """
-    if local_dir is None:
-        lambda_path = lambda_tmp + "/" + obj_ephem_key
-        if not os.path.exists(lambda_path):
-            print("Downloading ephem file from S3")
-            s3.download_file(Bucket=obj_bucket, Key=obj_ephem_key, Filename=lambda_path)
+            err_fine, pos_fine_km, _ = propagate_teme(propagator_subset(catalog, [i]), grid["jd"][fine_idx], grid["fr"][fine_idx])
+            pos_fine_m = pos_fine_km[0] * 1000.0
+            pos_fine_m[err_fine[0] != 0] = np.nan
 
-        return load_file(lambda_path)
+            sat_ecef = np.einsum("tij,tj->ti", grid["rot"][fine_idx], pos_fine_m)
+            lit = sunlit_mask(sat_ecef, grid["sun_m"][fine_idx])
+            az, el = ecef_to_az_el(sat_ecef, lla)
 
-    else:
-        local_path = local_dir + "/" + obj_ephem_key
-        return load_file(local_path)
+            visible = (el > 0) & lit & grid["dark"][fine_idx]
+
+            for run in contiguous_runs(fine_idx, visible):
+                peak = run[np.argmax(el[run])]
+                if el[peak] < min_el:
+                    continue
+
+                record = {"name": catalog["names"][i]}
+                for label, j in [("start", run[0]), ("peak", peak), ("stop", run[-1])]:
+                    record[label + "_utc"] = grid["utc"][fine_idx[j]]
+                    record[label + "_az"] = int(az[j])
+                    record[label + "_el"] = int(el[j])
+                chunk_passes.append(record)
+
+        return chunk_passes
 
+    # the fine search costs far more per satellite, so it is sharded in smaller chunks
+    with timed("fine_search"):
+        _, chunk_passes = run_sharded(candidate_sats.size, fine, chunk=PARALLEL_PASS_CHUNK)
+    passes = [record for chunk in chunk_passes for record in chunk]
 
-def propagate_ecef_sunlit(sats, time_utc, ephem):
+    passes.sort(key=lambda p: (p["start_utc"], p["name"]))
+    return passes
+
+
+def pass_time_grid(time_utc, span_hours, ephem, lla):
     """
-    Calc ECEF position and sunlit status of each sat in sats dict at time
+    Everything about the fine time grid that is shared by all satellites
 
     Parameters:
-    sats: dict of sat name (key) and tle (value)
-    time_utc: string in format YYYY-MM-DD HH:MM:SS of propagation end time
+    time_utc: string in format YYYY-MM-DD HH:MM:SS of search start time
+    span_hours: hours to look ahead
     ephem: ephemeris object with sun data from load_ephemeris()
-    
+    lla: 3, np.array lat/lon/alt in deg/deg/alt
+
     Returns:
-    N,3 ECEF position array in meters
-    N, boolean list of whether satellite is sunlit in position
+    dict with
+        n_fine: number of fine samples T, spaced DT_FINE apart
+        utc: T, list of YYYY-MM-DD HH:MM:SS strings
+        jd/fr: T, np.array UTC julian date whole and fraction for sgp4
+        rot: T,3,3 np.array TEME -> ITRS rotations
+        sun_m: T,3 np.array sun ECEF positions in meters (interpolated between DT_COARSE)
+        dark: T, boolean np.array of whether sun is below SUN_EL_MAX at lla
     """
-    # convert time to skyfield time format
-    timescale = load.timescale(builtin=True)
-    time_dt = datetime.strptime(time_utc, "%Y-%m-%d %H:%M:%S")
-    time_ts = timescale.utc(time_dt.replace(tzinfo=utc))
+    time_dt, _ = utc_time(time_utc)
+    n_fine = int(span_hours * 3600 // DT_FINE) + 1
+    offsets_s = np.arange(n_fine) * DT_FINE
 
-    pos_list = []
-    sunlit_list = []
+    time_ts = get_timescale().utc(time_dt.year, time_dt.month, time_dt.day,
+                            time_dt.hour, time_dt.minute, time_dt.second + offsets_s)
 
-    for sat_name, tle in sats.items():
-        sat = EarthSatellite(line1=tle[0], line2=tle[1])
-        pos = sat.at(time_ts)
-        pos_list.append(pos.frame_xyz(itrs).m)
-        sunlit_list.append(bool(pos.is_sunlit(ephem)))
+    jd, fr = jday(time_dt.year, time_dt.month, time_dt.day,
+                  time_dt.hour, time_dt.minute, time_dt.second)
 
-    return np.array(pos_list), sunlit_list
+    rot = np.moveaxis(teme_to_itrs_rotation(time_ts), -1, 0)
 
+    # the sun only needs to be exact every DT_COARSE, interpolating in between
+    # avoids computing nutation at every fine sample
+    sun_idx = np.unique(np.append(np.arange(0, n_fine, int(DT_COARSE // DT_FINE)), n_fine - 1))
+    sun_coarse_m = get_sun_position_ecef_m(time_ts[sun_idx], ephem)
+    sun_m = np.column_stack([np.interp(offsets_s, offsets_s[sun_idx], sun_coarse_m[:, k]) for k in range(3)])
 
-def get_sun_direction_ecef(time_utc, ephem):
+    sun_unit = sun_m / np.linalg.norm(sun_m, axis=1, keepdims=True)
+    dark = sun_unit @ lla_to_ecef_normal(lla) < np.sin(SUN_EL_MAX * DEG2RAD)
+
+    return {"n_fine": n_fine,
+            "utc": [(time_dt + timedelta(seconds=int(dt))).strftime("%Y-%m-%d %H:%M:%S") for dt in offsets_s],
+            "jd": np.full(n_fine, jd),
+            "fr": fr + offsets_s / 86400.0,
+            "rot": rot,
+            "sun_m": sun_m,
+            "dark": dark}
+
+
+def contiguous_runs(fine_idx, mask):
     """
-    Get the sun unit vector in ECEF frame
+    Split masked samples into runs that are consecutive on the fine grid
 
     Parameters:
-    time_utc: string in format YYYY-MM-DD HH:MM:SS of propagation end time
-    ephem: ephemeris object with sun data from load_ephemeris()
+    fine_idx: T, sorted np.array of fine grid indices
+    mask: T, boolean np.array
 
     Returns:
-    3, numpy array of sun unit vector from ECEF
+    list of np.arrays of positions into fine_idx, one per run
     """
-    # convert time to skyfield time format
-    timescale = load.timescale(builtin=True)
-    time_dt = datetime.strptime(time_utc, "%Y-%m-%d %H:%M:%S")
-    time_ts = timescale.utc(time_dt.replace(tzinfo=utc))
-    
-    sun, earth = ephem["sun"], ephem["earth"]
+    pos = np.flatnonzero(mask)
+    if pos.size == 0:
+        return []
 
-    pos = earth.at(time_ts).observe(sun)
-    pos_ecef = pos.frame_xyz(itrs).au
-    return pos_ecef / np.linalg.norm(pos_ecef)
+    breaks = np.flatnonzero(np.diff(fine_idx[pos]) != 1) + 1
+    return np.split(pos, breaks)
+
+
+def read_satellite_data(local_dir=None):
+    """
+    Read satellite data from data.json file stored in S3, return as dict
 
+    Parameters:
+    local_dir: path to use as a stand-in for bucket
 
-def lla_to_ecef(lla):
+    Returns:
+    sat dict with name keys and tle tuple values
     """
-    Convert lat/lon/alt to earth-centered position vector
+    _, data = read_object_if_changed(obj_sats_key, None, local_dir)
+    return json.loads(bytes(maybe_gunzip(data)).decode("UTF-8"))
+
 
-    See https://en.wikipedia.org/wiki/Geographic_coordinate_conversion#From_geodetic_to_ECEF_coordinates
+def load_catalog(local_dir=None):
+    """
+    Return the propagation-ready catalog, see load_catalog_object(). With
+    MASTER_CATALOG "on" this is a view of every group of the master catalog
+    (see group_view()) instead of obj_sats_key
 
     Parameters:
-    lla: 3, np.array in deg/deg/m
-    
+    local_dir: path to use as a stand-in for bucket
+
     Returns:
-    3, np.array in meters
+    catalog dict from load_catalog_object(), or the view
     """
-    sin_lat = np.sin(lla[0] * DEG2RAD)
-    cos_lat = np.cos(lla[0] * DEG2RAD)
-    sin_lon = np.sin(lla[1] * DEG2RAD)
-    cos_lon = np.cos(lla[1] * DEG2RAD)
+    load_snapshot(SNAPSHOT_PATH)
+    catalog = load_catalog_object(catalog_key(), local_dir)
 
-    ratio_square = (RE_SEMIMINOR_M ** 2) / (RE_SEMIMAJOR_M ** 2)
-    ecc_square = 1 - ratio_square
+    if MASTER_CATALOG == "on":
+        return group_view(catalog, catalog["groups"])
 
-    N = RE_SEMIMAJOR_M / np.sqrt(1 - ecc_square * sin_lat * sin_lat)
+    return catalog
 
-    x = (N + lla[2]) * cos_lat * cos_lon
-    y = (N + lla[2]) * cos_lat * sin_lon
-    z = (ratio_square * N + lla[2]) * sin_lat
 
-    return np.array([x, y, z])
+def catalog_key():
+    """
+    Object key of the catalog read by this lambda
+    """
+    return master_catalog_group + ".json" if MASTER_CATALOG == "on" else obj_sats_key
 
 
-def lla_to_ecef_normal(lla):
+def write_snapshot(local_dir=None, path=SNAPSHOT_PATH):
     """
-    Normal/zenith direction in ECEF frame
+    Snapshot the timescale and the parsed catalog for cold starts, see
+    dump_snapshot(). Run before zipping the lambda, the snapshot goes next to
+    lambda_function.py
 
     Parameters:
-    lla: 3, np.array lat/lon/alt in deg/deg/m
+    local_dir: path to use as a stand-in for bucket
+    path: output file
+    """
+    dump_snapshot({catalog_key(): load_catalog_object(catalog_key(), local_dir)}, path)
+
+
+def load_catalog_and_ephemeris(local_dir=None):
+    """
+    Load catalog and ephemeris for a request, see load_with_ephemeris()
 
     Returns:
-    3, np.array unit normal vector of lla position
+    catalog dict from load_catalog()
+    ephemeris object from load_ephemeris()
     """
-    lat = lla[0] * DEG2RAD
-    lon = lla[1] * DEG2RAD
-    
-    return np.array([np.cos(lat) * np.cos(lon),
-                     np.cos(lat) * np.sin(lon),
-                     np.sin(lat)])
+    return load_with_ephemeris(lambda: load_catalog(local_dir), local_dir)
+
 
+if STARTUP == "eager":
+    warm_start(SNAPSHOT_PATH)
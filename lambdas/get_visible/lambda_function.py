@@ -1,28 +1,61 @@
 import os
 import json
-from datetime import datetime
-import boto3
+import hashlib
+import time
 
 import numpy as np
 
-from skyfield.api import load, utc, load_file
-from skyfield.sgp4lib import EarthSatellite
-from skyfield.framelib import itrs
+from sgp4.api import Satrec, SatrecArray, jday
 
-# Constants
-DEG2RAD = 0.017453292519943296
-RAD2DEG = 57.295779513082321
-RE_SEMIMAJOR_M = 6378137.0
-RE_SEMIMINOR_M = 6356752.0
-RE_MEAN_M = 6371008.0
+from satlib import geometry, sgp4_numpy
+from satlib.storage import lambda_tmp, read_object_if_changed, maybe_gunzip
+from satlib.metrics import LOG_RESULTS, request_metrics, timed, count_metric, cache_metric
+from satlib.events import request_parameters, quantize_request
+from satlib.geometry import (DEG2RAD, RAD2DEG, RE_SEMIMINOR_M, lla_to_ecef, lla_to_ecef_normal, local_frame,
+                             observer_relative, ecef_to_az_el)
+from satlib.ephemeris import (load_ephemeris, ephemeris_path, get_timescale, utc_time, teme_to_itrs_rotation,
+                              get_sun_position_ecef_m, get_sun_position_analytic_ecef_m, get_sun_direction_ecef)
+from satlib.propagation import propagator_subset, propagate_catalog_ecef_sunlit, propagate_track_ecef_sunlit
+from satlib.catalogs import (STARTUP, MASTER_CATALOG, master_catalog_group, load_catalog_object, group_view,
+                             load_with_ephemeris, snapshot_path, dump_snapshot, load_snapshot, warm_start)
+from satlib.ephem_grid import EPHEM_GRID
 
-s3 = boto3.client("s3")
-obj_bucket = "sat-finder-private"
-obj_ephem_key = "de421.bsp"
-lambda_tmp = "/tmp"
+# parsed catalog snapshot, see write_snapshot() and snapshot_path()
+SNAPSHOT_PATH = snapshot_path(__file__)
 
-obj_sats_key_brightest = "brightest.json"
-obj_sats_key_gps = "gps.json"
+# largest observers x satellites block evaluated at once by visible_local_batch
+BATCH_MAX_ELEMENTS = 500000
+
+# batch queries against at least FOOTPRINT_MIN_SATS satellites only run line of
+# sight math on satellites whose footprint can reach the observer, found with a
+# FOOTPRINT_CELL_DEG grid of sub-satellite points, see build_footprint_index()
+FOOTPRINT_MIN_SATS = int(os.environ.get("FOOTPRINT_MIN_SATS", "2000"))
+FOOTPRINT_CELL_DEG = 10.0
+# the footprint uses geocentric directions, which are up to 0.193 deg off the
+# geodetic zenith that elevations are measured from
+FOOTPRINT_MARGIN_DEG = 0.25
+
+# longest track a single request can ask for
+TRACK_MAX_STEPS = 2000
+
+# most cells a single map request can ask for (1 deg over the globe is 64800)
+MAP_MAX_CELLS = 100000
+
+# optional cache of single observer results, see visible_cached(). "off",
+# "memory" (this container) or "file" (RESULT_CACHE_DIR, shared by processes on
+# one host), see result_cache_backends. Requests are rounded to RESULT_CACHE_DEG
+# and RESULT_CACHE_SECONDS before computing, so nearby requests share an entry
+RESULT_CACHE = os.environ.get("RESULT_CACHE", "off")
+RESULT_CACHE_DEG = float(os.environ.get("RESULT_CACHE_DEG", "0.01"))
+RESULT_CACHE_SECONDS = int(os.environ.get("RESULT_CACHE_SECONDS", "5"))
+RESULT_CACHE_SIZE = int(os.environ.get("RESULT_CACHE_SIZE", "256"))
+RESULT_CACHE_TTL_S = float(os.environ.get("RESULT_CACHE_TTL_S", "300"))
+RESULT_CACHE_DIR = os.environ.get("RESULT_CACHE_DIR", lambda_tmp + "/result_cache")
+result_cache = {}
+result_cache_stats = {"hits": 0, "misses": 0}
+
+# groups written by refresh_data, stored as <group>.json and <group>.bin
+sat_groups = ["brightest", "gps", "stations", "active"]
 
 
 def test_local(local_dir, lat, lon, time_utc, group):
@@ -41,49 +74,838 @@ def test_local(local_dir, lat, lon, time_utc, group):
     print(res)
 
 
+def test_sgp4_numpy(local_dir, group, start_utc, hours=24, step_minutes=30, tolerance_m=1e-3):
+    """
+    Compares the sgp4_numpy propagator against skyfield's EarthSatellite (ITRS
+    positions) and sgp4's SatrecArray (TEME positions) over a time grid, for
+    every TLE in a group using path as a stand-in for bucket. Asserts that the
+    error codes match SatrecArray and TEME positions agree to tolerance_m
+    """
+    from skyfield.sgp4lib import EarthSatellite
+    from skyfield.framelib import itrs
+
+    sats = read_satellite_data(group, local_dir)
+    satrec_list = [Satrec.twoline2rv(tle[0], tle[1]) for tle in sats.values()]
+    rec = sgp4_numpy.sgp4init(sgp4_numpy.elements_from_satrecs(satrec_list))
+
+    start_dt, _ = utc_time(start_utc)
+    minutes = np.arange(0, hours * 60 + 1, step_minutes)
+    time_ts = get_timescale().utc(start_dt.year, start_dt.month, start_dt.day,
+                                  start_dt.hour, start_dt.minute + minutes, start_dt.second)
+    jd, fr = jday(start_dt.year, start_dt.month, start_dt.day, start_dt.hour, start_dt.minute, start_dt.second)
+    jd = np.full(minutes.size, jd)
+    fr = fr + minutes / 1440.0
+
+    err_np, pos_np_km, _ = sgp4_numpy.sgp4(rec, jd, fr)
+    err_sa, pos_sa_km, _ = SatrecArray(satrec_list).sgp4(jd, fr)
+
+    rot = np.moveaxis(teme_to_itrs_rotation(time_ts), -1, 0)
+    pos_np_m = np.einsum("tij,ntj->nti", rot, pos_np_km * 1000.0)
+    pos_sky_m = np.array([EarthSatellite(line1=tle[0], line2=tle[1]).at(time_ts).frame_xyz(itrs).m.T
+                          for tle in sats.values()])
+
+    valid = (err_np == 0) & (err_sa == 0)
+    teme_err = np.linalg.norm(pos_np_km - pos_sa_km, axis=2)[valid] * 1000.0
+    itrs_err = np.linalg.norm(pos_np_m - pos_sky_m, axis=2)[valid]
+
+    print("Satellites: {}, deep space: {}, times: {}".format(len(satrec_list), int(np.sum(rec["deep"])), minutes.size))
+    print("Error code mismatches vs SatrecArray: {}".format(int(np.sum(err_np != err_sa))))
+    print("Max TEME difference vs SatrecArray (m): {}".format(np.max(teme_err, initial=0.0)))
+    print("Max ITRS difference vs skyfield (m): {}".format(np.max(itrs_err, initial=0.0)))
+
+    assert np.array_equal(err_np, err_sa), "sgp4_numpy error codes differ from SatrecArray"
+    assert np.max(teme_err, initial=0.0) < tolerance_m, "sgp4_numpy TEME positions differ by more than {} m".format(tolerance_m)
+
+
+def test_sgp4_numpy_corpus(minutes=1440, step_minutes=10, tolerance_m=1e-3):
+    """
+    Compares the sgp4_numpy propagator against sgp4's Satrec for the fixed TLEs
+    in sgp4_test_tles.json (taken from the SGP4 verification set: near earth,
+    deep space and resonant orbits, and objects that decay or hit error codes
+    within a day), from each TLE's epoch. Asserts that error codes match and
+    positions agree to tolerance_m
+    """
+    with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), "sgp4_test_tles.json")) as f:
+        sats = json.load(f)
+
+    offsets = np.arange(0, minutes + 1, step_minutes) / 1440.0
+
+    for name, tle in sats.items():
+        satrec = Satrec.twoline2rv(tle[0], tle[1])
+        rec = sgp4_numpy.sgp4init(sgp4_numpy.elements_from_satrecs([satrec]))
+        jd = np.full(offsets.size, satrec.jdsatepoch)
+        fr = satrec.jdsatepochF + offsets
+
+        err_np, pos_np_km, _ = sgp4_numpy.sgp4(rec, jd, fr)
+        err_sr, pos_sr_km, _ = satrec.sgp4_array(jd, fr)
+
+        valid = (err_np[0] == 0) & (err_sr == 0)
+        pos_err = np.linalg.norm(pos_np_km[0] - pos_sr_km, axis=1)[valid] * 1000.0
+
+        print("{}: deep space: {}, error codes: {}, max difference (m): {}".format(
+            name, bool(rec["deep"][0]), sorted(set(err_sr.tolist())), np.max(pos_err, initial=0.0)))
+
+        assert np.array_equal(err_np[0], err_sr), "{}: sgp4_numpy error codes differ from Satrec".format(name)
+        assert np.max(pos_err, initial=0.0) < tolerance_m, "{}: sgp4_numpy differs by more than {} m".format(name, tolerance_m)
+
+
+def test_sun_model(local_dir, start_utc="2015-02-27 00:00:00", stop_utc="2015-03-07 00:00:00", step_hours=1,
+                   max_arcmin=1.0, max_distance_err=1e-4):
+    """
+    Compares the analytic sun model against the SPK kernel in local_dir, which
+    must cover start_utc to stop_utc (the default is the span of the de421.bsp
+    stored in the bucket). Asserts the direction error stays below max_arcmin
+    and the relative distance error below max_distance_err
+    """
+    from skyfield.api import load_file
+
+    ephem = load_file(ephemeris_path(local_dir))
+
+    start_dt, _ = utc_time(start_utc)
+    stop_dt, _ = utc_time(stop_utc)
+    hours = np.arange(0, (stop_dt - start_dt).total_seconds() / 3600.0, step_hours)
+    time_ts = get_timescale().utc(start_dt.year, start_dt.month, start_dt.day, start_dt.hour + hours)
+
+    sun_spk = get_sun_position_ecef_m(time_ts, ephem)
+    sun_analytic = get_sun_position_analytic_ecef_m(time_ts)
+
+    cos_err = np.sum(sun_spk * sun_analytic, axis=1) / (np.linalg.norm(sun_spk, axis=1) * np.linalg.norm(sun_analytic, axis=1))
+    err_arcmin = np.arccos(np.clip(cos_err, -1.0, 1.0)) * RAD2DEG * 60.0
+    dist_err = np.abs(np.linalg.norm(sun_analytic, axis=1) / np.linalg.norm(sun_spk, axis=1) - 1.0)
+
+    print("Sun direction error (arcmin) max: {:.3f}, mean: {:.3f}".format(np.max(err_arcmin), np.mean(err_arcmin)))
+    print("Sun distance relative error max: {:.2e}".format(np.max(dist_err)))
+
+    assert np.max(err_arcmin) < max_arcmin, "analytic sun direction off by more than {} arcmin".format(max_arcmin)
+    assert np.max(dist_err) < max_distance_err, "analytic sun distance off by more than {}".format(max_distance_err)
+
+
+def test_precision(local_dir, lat, lon, time_utc, group, duration=600, step=10):
+    """
+    Compares az/el from float32 observer relative positions (PRECISION
+    "float32") against float64 for a track of every satellite in a group
+    and for the visible_local results, using path as a stand-in for bucket
+    """
+    lla = np.array([lat, lon, 0])
+    catalog, ephem = load_catalog_and_ephemeris(group, local_dir)
+    sats_ecef, sunlit = propagate_track_ecef_sunlit(catalog["satrecs"], time_utc, step * np.arange(duration // step + 1), ephem)
+    sun_ecef = get_sun_direction_ecef(time_utc, ephem)
+
+    saved = geometry.COMPUTE_DTYPE
+    res = {}
+
+    try:
+        for dtype in [np.float64, np.float32]:
+            geometry.COMPUTE_DTYPE = dtype
+            az, el = ecef_to_az_el(sats_ecef, lla)
+            viz = visible_local(catalog["names"], sats_ecef[0], sun_ecef, sunlit[0], lla)
+            res[dtype] = (az, el, viz)
+    finally:
+        geometry.COMPUTE_DTYPE = saved
+
+    az64, el64, viz64 = res[np.float64]
+    az32, el32, viz32 = res[np.float32]
+
+    valid = np.isfinite(el64)
+    el_err = np.abs(el32 - el64)[valid]
+    # azimuth error as an angle on the sky, which is what matters near the zenith
+    az_err = np.abs((az32 - az64 + 180.0) % 360.0 - 180.0)[valid] * np.cos(el64[valid] * DEG2RAD)
+
+    fields = ["az", "el", "sunphase", "sunlit"]
+    int_diff = sum(any(a[f] != b[f] for f in fields) for a, b in zip(viz64, viz32))
+    max_step = max([abs(a[f] - b[f]) for a, b in zip(viz64, viz32) for f in ["az", "el", "sunphase"]], default=0)
+
+    print("Samples: {} ({} sats x {} times)".format(int(np.sum(valid)), el64.shape[1], el64.shape[0]))
+    print("Elevation error (deg) max: {:.2e}, mean: {:.2e}".format(np.max(el_err), np.mean(el_err)))
+    print("Azimuth error on sky (deg) max: {:.2e}, mean: {:.2e}".format(np.max(az_err), np.mean(az_err)))
+    print("visible_local: {} vs {} results, {} differ after rounding to whole deg (by at most {} deg)".format(
+        len(viz64), len(viz32), int_diff, max_step))
+
+
+def test_cold_start(local_dir, lat, lon, time_utc, group, repeats=5):
+    """
+    Measures cold starts in fresh interpreters using path as a stand-in for
+    bucket: time per module imported by lambda_function (python -X importtime),
+    then import and first request time for lazy/eager STARTUP with and without
+    a snapshot. Medians over repeats, after one untimed run to compile .pyc files
+    """
+    import subprocess
+    import sys
+    import tempfile
+
+    here = os.path.dirname(os.path.abspath(__file__))
+    event = {"localTestDir": local_dir,
+             "queryStringParameters": {"lat": lat, "lon": lon, "time_utc": time_utc, "group": group}}
+
+    def run(args, env_update):
+        # satlib is next to lambda_function.py in the deployment package and one up locally
+        env = dict(os.environ, **env_update)
+        env["PYTHONPATH"] = os.pathsep.join(filter(None, [os.path.dirname(here), os.environ.get("PYTHONPATH")]))
+        return subprocess.run([sys.executable] + args, cwd=here, env=env, capture_output=True, text=True, check=True)
+
+    # -X importtime lines: "import time: self [us] | cumulative | <indent>module",
+    # children are printed (one indent level deeper) before their parent
+    module_us = {}
+    for i in range(repeats + 1):
+        lines = run(["-X", "importtime", "-c", "import lambda_function"], {"STARTUP": "lazy"}).stderr.splitlines()
+        children = []
+        for line in lines:
+            parts = line.split("|")
+            if i == 0 or len(parts) != 3 or not parts[0].startswith("import time:") or "self" in parts[0]:
+                continue
+            name = parts[2].strip()
+            depth = len(parts[2]) - len(parts[2].lstrip()) - 1
+            if depth == 2:
+                children.append((name, int(parts[0].split(":")[1]), int(parts[1])))
+            elif depth == 0:
+                if name == "lambda_function":
+                    for child, self_us, cumulative_us in children:
+                        module_us.setdefault(child, []).append((self_us, cumulative_us))
+                children = []
+
+    print("Import time of modules imported by lambda_function (ms, median self / cumulative):")
+    for module, times in sorted(module_us.items(), key=lambda item: -np.median([t[1] for t in item[1]])):
+        times = np.array(times) / 1000.0
+        print("  {:<24} {:8.1f} {:8.1f}".format(module, np.median(times[:, 0]), np.median(times[:, 1])))
+
+    script = ("import json, sys, time\n"
+              "t0 = time.perf_counter()\n"
+              "import lambda_function\n"
+              "t1 = time.perf_counter()\n"
+              "lambda_function.lambda_handler(json.loads(sys.argv[1]), None)\n"
+              "t2 = time.perf_counter()\n"
+              "print(json.dumps([t1 - t0, t2 - t1]))\n")
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        snapshot_path = os.path.join(tmp_dir, "snapshot.pkl")
+        write_snapshot(local_dir, [group], snapshot_path)
+
+        print("Cold start (ms, median import / first request / total):")
+        for startup in ["lazy", "eager"]:
+            for label, path in [("no snapshot", os.path.join(tmp_dir, "missing.pkl")), ("snapshot", snapshot_path)]:
+                env_update = {"STARTUP": startup, "SNAPSHOT_PATH": path}
+                times = []
+                for i in range(repeats + 1):
+                    out = run(["-c", script, json.dumps(event)], env_update).stdout
+                    if i > 0:
+                        times.append(json.loads(out.strip().splitlines()[-1]))
+                import_ms, request_ms = np.median(np.array(times), axis=0) * 1000.0
+                print("  {:<6} {:<12} {:8.1f} {:8.1f} {:8.1f}".format(startup, label, import_ms, request_ms, import_ms + request_ms))
+
+
 def lambda_handler(event, context):
     """
     For GET request, parameters are in event['queryStringParameters']
 
     {"lat": lat_degrees, "lon": lon_degrees, "time_utc": YYYY-MM-DD HH:MM:SS string, "group": string}
 
+    Optional filters (see visible_local):
+    {"min_el": deg, "max_el": deg, "sunlit_only": true/false, "az_min": deg, "az_max": deg, "max_results": int}
+
+    Batch form, as query string or JSON body, evaluates many observers and times
+    against one catalog. Each distinct time is propagated once:
+
+    {"group": string, "queries": [{"lat": lat_degrees, "lon": lon_degrees, "time_utc": string}, ...], filters}
+
+    Track form propagates over a time vector starting at time_utc, for either
+    the named satellites or every satellite that rises above min_el during it:
+
+    {"lat": lat_degrees, "lon": lon_degrees, "time_utc": string, "group": string,
+     "duration": seconds, "step": seconds, "names": optional comma separated sat names,
+     "min_el": optional deg, "max_results": optional int}
+
     Returns:
     list of dicts {"name": str, "sunlit": bool, "sunphase": int, "az": float, "el": float
+
+    Track returns:
+    dict {"time_utc": str, "step": float, "n_steps": int,
+          "sats": [{"name": str, "az": [float], "el": [float], "sunlit": [bool]}, ...]}
+
+    Batch returns:
+    list of dicts {"lat": float, "lon": float, "time_utc": str, "visible": list as above}, in query order
+
+    Map form counts visible satellites for every cell of a lat/lon grid from one
+    propagation, see visible_map():
+
+    {"time_utc": string, "group": string, "grid_deg": cell size in deg,
+     "lat_min", "lat_max", "lon_min", "lon_max": optional bounds in deg,
+     "min_el", "max_el": optional deg, "sunphase": optional true/false}
+
+    Map returns:
+    dict {"time_utc": str, "grid_deg": float, "lat": [float], "lon": [float],
+          "visible": [[int]], "sunlit": [[int]], "sunphase": [[int]] (only if asked for)}
+
+    With RESULT_CACHE on, single observer requests are answered through the
+    result cache, see visible_cached():
+    dict {"cached": bool, "visible": list of dicts as above}
     """
     if "localTestDir" in event:
         local_dir = event["localTestDir"]
     else:
         local_dir = None
 
-    lat = float(event["queryStringParameters"]["lat"])
-    lon = float(event["queryStringParameters"]["lon"])
-    time_utc = event["queryStringParameters"]["time_utc"]
-    group = event["queryStringParameters"]["group"]
+    with request_metrics("get_visible", event) as metrics:
+        params = request_parameters(event)
+        if "queries" in params:
+            metrics["mode"] = "batch"
+            return visible_batch(params, local_dir)
+        if "duration" in params:
+            metrics["mode"] = "track"
+            return visible_track(params, local_dir)
+        if "grid_deg" in params:
+            metrics["mode"] = "map"
+            return visible_map(params, local_dir)
+
+        lat = float(event["queryStringParameters"]["lat"])
+        lon = float(event["queryStringParameters"]["lon"])
+        time_utc = event["queryStringParameters"]["time_utc"]
+        group = event["queryStringParameters"]["group"]
+
+        print("Get visible from group {} for lat: {}, lon:{} at time: {}".format(group, lat, lon, time_utc))
+
+        filters = parse_visible_filters(event["queryStringParameters"])
+
+        if RESULT_CACHE != "off":
+            metrics["mode"] = "cached"
+            return visible_cached(lat, lon, time_utc, group, filters, local_dir)
+
+        metrics["mode"] = "single"
+        lla = np.array([lat, lon, 0])
+        catalog, ephem = load_catalog_and_ephemeris(group, local_dir)
 
-    print("Get visible from group {} for lat: {}, lon:{} at time: {}".format(group, lat, lon, time_utc))
+        with timed("propagate"):
+            sats_ecef, sunlit = propagate_catalog_ecef_sunlit(catalog, time_utc, ephem)
+            sun_ecef = get_sun_direction_ecef(time_utc, ephem)
+
+        with timed("visible"):
+            viz = visible_local(catalog["names"], sats_ecef, sun_ecef, sunlit, lla, **filters)
+
+        count_metric("satellites", len(catalog["names"]))
+        count_metric("results", len(viz))
+
+        if LOG_RESULTS == "on":
+            print("Found: {}".format(viz))
+
+        return viz
+
+
+def visible_batch(params, local_dir=None):
+    """
+    Batch form of lambda_handler: group queries by time, propagate each distinct
+    time once and evaluate all of its observers with visible_local_batch
+
+    Parameters:
+    params: request parameters with "group", "queries" and optional filters
+    local_dir: path to use as a stand-in for bucket
+
+    Returns:
+    list of dicts {"lat": float, "lon": float, "time_utc": str, "visible": list}, in query order
+    """
+    group = params["group"]
+    queries = params["queries"]
+    if isinstance(queries, str):
+        queries = json.loads(queries)
+
+    filters = parse_visible_filters(params)
+
+    query_times = {}
+    for i, query in enumerate(queries):
+        query_times.setdefault(query["time_utc"], []).append(i)
+
+    print("Get visible from group {} for {} queries at {} times".format(group, len(queries), len(query_times)))
+
+    catalog, ephem = load_catalog_and_ephemeris(group, local_dir)
+    res = [None] * len(queries)
+
+    for time_utc, query_idx in query_times.items():
+        with timed("propagate"):
+            sats_ecef, sunlit = propagate_catalog_ecef_sunlit(catalog, time_utc, ephem)
+            sun_ecef = get_sun_direction_ecef(time_utc, ephem)
+
+        with timed("visible"):
+            llas = np.array([[float(queries[i]["lat"]), float(queries[i]["lon"]), 0] for i in query_idx])
+            viz = visible_local_batch(catalog["names"], sats_ecef, sun_ecef, sunlit, llas, **filters)
+
+        for i, lla, v in zip(query_idx, llas, viz):
+            res[i] = {"lat": float(lla[0]), "lon": float(lla[1]), "time_utc": time_utc, "visible": v}
+
+    count_metric("satellites", len(catalog["names"]))
+    count_metric("time_steps", len(query_times))
+    count_metric("queries", len(queries))
+    count_metric("results", sum(len(r["visible"]) for r in res))
+
+    if LOG_RESULTS == "on":
+        print("Found: {}".format(res))
+
+    return res
+
+
+def visible_track(params, local_dir=None):
+    """
+    Track form of lambda_handler: propagate the selected satellites over the
+    whole time vector in one call and return per satellite az/el/sunlit arrays
+
+    Parameters:
+    params: request parameters with lat, lon, time_utc, group, duration, step
+        and optional names, min_el, max_results
+    local_dir: path to use as a stand-in for bucket
+
+    Returns:
+    dict {"time_utc": str, "step": float, "n_steps": int, "sats": list of dicts}
+    """
+    lat = float(params["lat"])
+    lon = float(params["lon"])
+    time_utc = params["time_utc"]
+    group = params["group"]
+    duration = float(params["duration"])
+    step = float(params["step"])
+    min_el = float(params.get("min_el", 0.0))
+    max_results = int(params["max_results"]) if params.get("max_results") not in (None, "") else None
+
+    if step <= 0:
+        raise ValueError("step must be positive")
+
+    n_steps = int(duration // step) + 1
+    if n_steps > TRACK_MAX_STEPS:
+        raise ValueError("Track of {} steps is longer than {}".format(n_steps, TRACK_MAX_STEPS))
+
+    print("Get track from group {} for lat: {}, lon:{} at time: {} for {} steps of {} s".format(
+        group, lat, lon, time_utc, n_steps, step))
 
     lla = np.array([lat, lon, 0])
-    sats = read_satellite_data(group, local_dir)
-    ephem = load_ephemeris(local_dir)
-    sats_ecef, sunlit = propagate_ecef_sunlit(sats, time_utc, ephem)
-    sun_ecef = get_sun_direction_ecef(time_utc, ephem)
-    viz = visible_local(list(sats.keys()), sats_ecef, sun_ecef, sunlit, lla)
+    catalog, ephem = load_catalog_and_ephemeris(group, local_dir)
+
+    if params.get("names"):
+        names = params["names"]
+        if isinstance(names, str):
+            names = names.split(",")
+        name_idx = {name: i for i, name in enumerate(catalog["names"])}
+        idx = np.array([name_idx[name] for name in names if name in name_idx], dtype=int)
+        satrecs = propagator_subset(catalog, idx)
+    else:
+        idx = np.arange(len(catalog["names"]))
+        satrecs = catalog["satrecs"]
+
+    with timed("propagate"):
+        sats_ecef, sunlit = propagate_track_ecef_sunlit(satrecs, time_utc, step * np.arange(n_steps), ephem)
+
+    with timed("visible"):
+        az, el = ecef_to_az_el(sats_ecef, lla)
+
+    # without explicit names, only satellites that get above min_el at some
+    # point are returned, highest first picked for max_results
+    keep = np.arange(idx.size)
+    if not params.get("names"):
+        peak_el = np.nanmax(np.where(np.isfinite(el), el, -90.0), axis=0)
+        keep = np.flatnonzero(peak_el > min_el)
+        if max_results is not None and keep.size > max_results:
+            keep = np.sort(keep[np.argsort(-peak_el[keep], kind="stable")[:max_results]])
+
+    # satellites that fail to propagate anywhere in the track are dropped
+    keep = keep[np.all(np.isfinite(el[:, keep]), axis=0)]
+
+    tracks = []
+
+    for j in keep:
+        # rounded in float64 so float32 (PRECISION) tracks serialize the same
+        tracks.append({"name": catalog["names"][idx[j]],
+                       "az": np.round(az[:, j].astype(float), 1).tolist(),
+                       "el": np.round(el[:, j].astype(float), 1).tolist(),
+                       "sunlit": sunlit[:, j].tolist()})
+
+    count_metric("satellites", idx.size)
+    count_metric("time_steps", n_steps)
+    count_metric("results", len(tracks))
+
+    res = {"time_utc": time_utc, "step": step, "n_steps": n_steps, "sats": tracks}
+
+    if LOG_RESULTS == "on":
+        print("Found: {}".format(res))
+
+    return res
+
+
+def visible_map(params, local_dir=None):
+    """
+    Map form of lambda_handler: propagate the catalog once and count the
+    visible and sunlit satellites at the center of every cell of a lat/lon grid
+
+    Cells are grid_deg on a side starting at lat_min/lon_min, the last row or
+    column runs past lat_max/lon_max if the span is not a whole number of cells
+
+    Parameters:
+    params: request parameters with time_utc, group, grid_deg and optional
+        lat_min/lat_max (default -90/90), lon_min/lon_max (default -180/180),
+        min_el, max_el and sunphase (also return the best sunphase per cell)
+    local_dir: path to use as a stand-in for bucket
+
+    Returns:
+    dict {"time_utc": str, "grid_deg": float, "min_el": float, "lat": [float], "lon": [float],
+          "visible": [[int]], "sunlit": [[int]], "sunphase": [[int]]}
+        lat and lon are cell centers, the count grids are rows of lat by
+        columns of lon. sunphase (only if asked for) is the largest sunphase of
+        any visible sunlit satellite in the cell, -1 if there is none
+    """
+    time_utc = params["time_utc"]
+    group = params["group"]
+    grid_deg = float(params["grid_deg"])
+    min_el = float(params.get("min_el", 0.0))
+    max_el = float(params.get("max_el", 90.0))
+    with_sunphase = str(params.get("sunphase", "false")).lower() in ["1", "true", "yes"]
+
+    if grid_deg <= 0:
+        raise ValueError("grid_deg must be positive")
+
+    lats = grid_centers(float(params.get("lat_min", -90.0)), float(params.get("lat_max", 90.0)), grid_deg)
+    lons = grid_centers(float(params.get("lon_min", -180.0)), float(params.get("lon_max", 180.0)), grid_deg)
+
+    if lats.size * lons.size > MAP_MAX_CELLS:
+        raise ValueError("Map of {} cells is larger than {}".format(lats.size * lons.size, MAP_MAX_CELLS))
+
+    print("Get map from group {} at time: {} for {} x {} cells of {} deg".format(
+        group, time_utc, lats.size, lons.size, grid_deg))
+
+    catalog, ephem = load_catalog_and_ephemeris(group, local_dir)
+
+    with timed("propagate"):
+        sats_ecef, sunlit = propagate_catalog_ecef_sunlit(catalog, time_utc, ephem)
+        sun_ecef = get_sun_direction_ecef(time_utc, ephem)
+
+    lat_grid, lon_grid = np.meshgrid(lats, lons, indexing="ij")
+    llas = np.stack([lat_grid.ravel(), lon_grid.ravel(), np.zeros(lat_grid.size)])
+
+    with timed("map"):
+        counts = visible_counts(sats_ecef, sunlit, sun_ecef, llas, min_el, max_el, with_sunphase)
+
+    count_metric("satellites", len(catalog["names"]))
+    count_metric("cells", lat_grid.size)
+
+    res = {"time_utc": time_utc,
+           "grid_deg": grid_deg,
+           "min_el": min_el,
+           "lat": np.round(lats, 6).tolist(),
+           "lon": np.round(lons, 6).tolist()}
+
+    for key, values in counts.items():
+        res[key] = values.reshape(lat_grid.shape).tolist()
+
+    if LOG_RESULTS == "on":
+        print("Found: {}".format(res))
+
+    return res
+
+
+def grid_centers(start, stop, grid_deg):
+    """
+    Centers of grid_deg cells covering start to stop
+    """
+    n = max(1, int(np.ceil((stop - start) / grid_deg - 1e-9)))
+    return start + (np.arange(n) + 0.5) * grid_deg
+
+
+def visible_counts(sats_ecef, sunlit, sun_ecef, llas, min_el=0.0, max_el=90.0, with_sunphase=False):
+    """
+    Number of visible and of visible sunlit satellites for each of M observers
+
+    Line of sight lengths and elevations come from matrix products of the
+    satellite positions with the observer positions and zenith vectors
+    (|sat - pos|^2 = |sat|^2 - 2 sat.pos + |pos|^2), so no observers x
+    satellites x 3 array is built. Observers are processed in chunks so no
+    observers x satellites array is bigger than BATCH_MAX_ELEMENTS
+
+    With at least FOOTPRINT_MIN_SATS satellites, observers are grouped into
+    FOOTPRINT_CELL_DEG blocks and each block only looks at the satellites whose
+    footprint can reach it, see footprint_blocks(). Counts are the same either way
+
+    Parameters:
+    sats_ecef: N,3 np.array of satellite ECEF positions in meters, nan rows are never visible
+    sunlit: N, np.array of bools
+    sun_ecef: 3, np.array unit vector
+    llas: 3,M np.array lat/lon/alt in deg/deg/m of each observer
+    min_el/max_el: elevation limits in deg, see visible_mask()
+    with_sunphase: also return the best sunphase
+
+    Returns:
+    dict of M, np.arrays
+        visible: int count of satellites within the elevation limits
+        sunlit: int count of those that are sunlit
+        sunphase: int largest sunphase of the sunlit ones in deg, -1 if none (only with_sunphase)
+    """
+    pos = lla_to_ecef(llas).T
+    normal = lla_to_ecef_normal(llas).T
+
+    # always float64 (whatever PRECISION is), |sat|^2 and |pos|^2 nearly cancel
+    sunlit = np.asarray(sunlit, dtype=bool)
+    sat_norm_sq = np.sum(sats_ecef * sats_ecef, axis=1)
+    sat_sun = sats_ecef @ sun_ecef
+
+    m_total = pos.shape[0]
+
+    res = {"visible": np.zeros(m_total, dtype=int), "sunlit": np.zeros(m_total, dtype=int)}
+    if with_sunphase:
+        res["sunphase"] = np.full(m_total, -1, dtype=int)
+
+    if sats_ecef.shape[0] >= FOOTPRINT_MIN_SATS:
+        blocks = footprint_blocks(build_footprint_index(sats_ecef, min_el), pos)
+    else:
+        blocks = [(np.arange(m_total), np.arange(sats_ecef.shape[0]))]
+
+    for obs, cand in blocks:
+        sats = sats_ecef[cand]
+        chunk = max(1, BATCH_MAX_ELEMENTS // max(cand.size, 1))
+
+        for start in range(0, obs.size, chunk):
+            o = obs[start:start + chunk]
+            p = pos[o]
+            n = normal[o]
+
+            # m,K line of sight length and its component along the zenith
+            rel_norm = np.sqrt(np.maximum(sat_norm_sq[cand][None, :] - 2.0 * (p @ sats.T) + np.sum(p * p, axis=1)[:, None], 0.0))
+            rel_up = n @ sats.T - np.sum(p * n, axis=1)[:, None]
+
+            with np.errstate(invalid="ignore", divide="ignore"):
+                cos_theta = rel_up / rel_norm
+
+            mask = visible_mask(cos_theta, sunlit[cand][None, :], min_el, max_el)
+            lit = mask & sunlit[cand][None, :]
+
+            res["visible"][o] = np.count_nonzero(mask, axis=1)
+            res["sunlit"][o] = np.count_nonzero(lit, axis=1)
+
+            if with_sunphase:
+                # largest sunphase is the smallest cos between line of sight and sun
+                with np.errstate(invalid="ignore", divide="ignore"):
+                    cos_phase = (sat_sun[cand][None, :] - (p @ sun_ecef)[:, None]) / rel_norm
+                best = np.min(np.where(lit, cos_phase, np.inf), axis=1)
+                found = np.isfinite(best)
+                res["sunphase"][o[found]] = (np.arccos(np.clip(best[found], -1.0, 1.0)) * RAD2DEG).astype(int)
+
+    return res
+
 
-    print("Found: {}".format(viz))
+def footprint_blocks(index, pos, cell_deg=FOOTPRINT_CELL_DEG):
+    """
+    Group observers into cell_deg lat/lon blocks and find the satellites whose
+    footprint can reach some observer in each block: the central angle from
+    the block center to the satellite is at most its footprint radius plus the
+    block radius (see build_footprint_index())
+
+    Parameters:
+    index: dict from build_footprint_index()
+    pos: M,3 np.array observer ECEF positions in meters
+    cell_deg: block size in deg
+
+    Returns:
+    list of (observer indices, satellite indices in catalog order), one per block
+    """
+    r_obs = np.linalg.norm(pos, axis=1)
+    obs_unit = pos / r_obs[:, None]
+
+    lat = np.arcsin(np.clip(obs_unit[:, 2], -1.0, 1.0)) * RAD2DEG
+    lon = np.arctan2(obs_unit[:, 1], obs_unit[:, 0]) * RAD2DEG
+    block = ((lat + 90.0) // cell_deg).astype(int) * 1000 + ((lon + 180.0) // cell_deg).astype(int)
+
+    order = np.argsort(block, kind="stable")
+    splits = np.flatnonzero(np.diff(block[order])) + 1
+
+    all_sats = np.arange(index["sat_unit"].shape[0])
+    radius = np.arccos(np.clip(index["cos_radius"], -1.0, 1.0))
+
+    blocks = []
+    for obs in np.split(order, splits):
+        if np.any(r_obs[obs] < RE_SEMIMINOR_M):
+            # footprints only bound observers on or above the ellipsoid
+            blocks.append((obs, all_sats))
+            continue
+
+        center = np.sum(obs_unit[obs], axis=0)
+        center = center / np.linalg.norm(center)
+        block_radius = np.max(np.arccos(np.clip(obs_unit[obs] @ center, -1.0, 1.0)))
+
+        # with a little slack for rounding, satellites that failed to propagate never match
+        reach = np.cos(np.minimum(radius + block_radius, np.pi)) - 1e-9
+        blocks.append((obs, np.flatnonzero(index["sat_unit"] @ center >= reach)))
+
+    return blocks
+
+
+def visible_cached(lat, lon, time_utc, group, filters, local_dir=None):
+    """
+    Single observer request through the result cache. lat/lon/time are rounded
+    by quantize_request() and the result is computed for the rounded values, so
+    an entry is the same whichever request filled it. The key includes the
+    catalog version, so entries from before a catalog refresh are never served
+
+    Parameters:
+    lat, lon: observer in degrees
+    time_utc: string in format YYYY-MM-DD HH:MM:SS
+    group: name of satellite group
+    filters: dict from parse_visible_filters()
+    local_dir: path to use as a stand-in for bucket
+
+    Returns:
+    dict {"cached": true if served from the cache, "visible": list of dicts
+    from visible_local()}. Hits and misses also go to the request metrics
+    (result cache) and the log
+    """
+    lat, lon, time_utc = quantize_request(lat, lon, time_utc, RESULT_CACHE_DEG, RESULT_CACHE_SECONDS)
+    catalog = load_group_catalog(group, local_dir)
+    key = json.dumps([lat, lon, time_utc, group, catalog["version"], sorted(filters.items())])
+
+    with timed("result_cache"):
+        viz = result_cache_get(key)
+    hit = viz is not None
+    cache_metric("result", hit)
+    print("Result cache {}".format("hit" if hit else "miss"))
+
+    if hit:
+        result_cache_stats["hits"] += 1
+    else:
+        result_cache_stats["misses"] += 1
+        ephem = load_ephemeris(local_dir)
+
+        with timed("propagate"):
+            sats_ecef, sunlit = propagate_catalog_ecef_sunlit(catalog, time_utc, ephem)
+            sun_ecef = get_sun_direction_ecef(time_utc, ephem)
+
+        with timed("visible"):
+            viz = visible_local(catalog["names"], sats_ecef, sun_ecef, sunlit, np.array([lat, lon, 0]), **filters)
+
+        with timed("result_cache"):
+            result_cache_put(key, viz)
+
+        count_metric("satellites", len(catalog["names"]))
+
+    count_metric("results", len(viz))
+
+    if LOG_RESULTS == "on":
+        print("Found: {}".format(viz))
+
+    return {"cached": hit, "visible": viz}
+
+
+def result_cache_get(key):
+    """
+    Cached result for key from the RESULT_CACHE backend, None if missing or
+    older than RESULT_CACHE_TTL_S
+    """
+    return result_cache_backends[RESULT_CACHE]["get"](key)
+
+
+def result_cache_put(key, value):
+    """
+    Store a JSON serializable result for key in the RESULT_CACHE backend
+    """
+    result_cache_backends[RESULT_CACHE]["put"](key, value)
+
+
+def memory_cache_get(key):
+    """
+    In-process backend: LRU over result_cache, which keeps insertion order so
+    entries are moved to the end when used. Entries still expire
+    RESULT_CACHE_TTL_S after they were stored, as in the file backend
+    """
+    entry = result_cache.pop(key, None)
+    if entry is None or time.time() - entry[0] > RESULT_CACHE_TTL_S:
+        return None
+
+    result_cache[key] = entry
+    return entry[1]
 
-    return viz
 
+def memory_cache_put(key, value):
+    result_cache[key] = (time.time(), value)
 
-def visible_local(sat_names, sats_ecef, sun_ecef, sunlit, lla):
+    # drop the least recently used entries once the cache is full
+    while len(result_cache) > RESULT_CACHE_SIZE:
+        result_cache.pop(next(iter(result_cache)))
+
+
+def file_cache_path(key):
+    return os.path.join(RESULT_CACHE_DIR, hashlib.sha1(key.encode("UTF-8")).hexdigest() + ".json")
+
+
+def file_cache_get(key):
+    """
+    File backend: one JSON file per key in RESULT_CACHE_DIR, the modified time
+    is when it was stored
+    """
+    path = file_cache_path(key)
+
+    try:
+        if time.time() - os.stat(path).st_mtime > RESULT_CACHE_TTL_S:
+            return None
+        with open(path) as f:
+            stored = json.load(f)
+    except (FileNotFoundError, ValueError):
+        return None
+
+    # the file name is a hash, check for a collision
+    if stored["key"] != key:
+        return None
+
+    return stored["value"]
+
+
+def file_cache_put(key, value):
+    os.makedirs(RESULT_CACHE_DIR, exist_ok=True)
+    path = file_cache_path(key)
+
+    # write then rename so readers in other processes never see a partial file
+    tmp_path = "{}.{}.tmp".format(path, os.getpid())
+    with open(tmp_path, "w") as f:
+        json.dump({"key": key, "value": value}, f)
+    os.replace(tmp_path, path)
+
+    # only stat the files once the cache is full, then drop the oldest
+    names = [name for name in os.listdir(RESULT_CACHE_DIR) if name.endswith(".json")]
+    if len(names) <= RESULT_CACHE_SIZE:
+        return
+
+    entries = []
+    for name in names:
+        old_path = os.path.join(RESULT_CACHE_DIR, name)
+        try:
+            entries.append((os.stat(old_path).st_mtime, old_path))
+        except FileNotFoundError:
+            pass
+    for _, old_path in sorted(entries)[:max(len(entries) - RESULT_CACHE_SIZE, 0)]:
+        try:
+            os.remove(old_path)
+        except FileNotFoundError:
+            pass
+
+
+# RESULT_CACHE name: get(key) and put(key, value) functions. Keys are strings
+# and values JSON serializable, so a shared store (e.g. redis) only needs the
+# same two functions
+result_cache_backends = {"memory": {"get": memory_cache_get, "put": memory_cache_put},
+                         "file": {"get": file_cache_get, "put": file_cache_put}}
+
+
+def visible_local(sat_names, sats_ecef, sun_ecef, sunlit, lla, min_el=0.0, max_el=90.0,
+                  sunlit_only=False, az_min=None, az_max=None, max_results=None, index=None):
     """
     Returns names of satellites that are in view of lla location
 
+    Geometry is computed for all satellites at once. The optional filters are
+    applied as masks on dot products before any trig runs, so only satellites
+    that pass them get az/el/sunphase computed.
+
     Parameters:
     sat_names: N, list of satellite names
     sats_ecef: N,3 np.array of satellite ECEF positions in meters
     sun_ecef: 3, np.array unit vector
-    sunlit: N, list of bools
+    sunlit: N, list or np.array of bools
     lla: 3, np.array lat/lon/alt in deg/deg/alt
+    min_el: only return satellites above this elevation in deg
+    max_el: only return satellites at or below this elevation in deg
+    sunlit_only: only return satellites that are sunlit
+    az_min/az_max: only return satellites in the azimuth sector running clockwise
+        from az_min to az_max in deg (e.g. 300 to 60 covers north), both or neither
+    max_results: only return this many satellites, highest elevation first picked
+    index: footprint index of sats_ecef for min_el from build_footprint_index(),
+        only the satellites it can not rule out are looked at (same result)
 
     Returns:
     list of dicts {"name": str, "sunlit": bool, "sunphase": int, "az": float, "el": float
@@ -92,180 +914,444 @@ def visible_local(sat_names, sats_ecef, sun_ecef, sunlit, lla):
         az: azimuth of satellite at location. 0 deg is north, 90 east, 180 south, 270 west
         el: elivation of satellite above horizon
     """
-    pos = lla_to_ecef(lla)
-    normal = lla_to_ecef_normal(lla)
+    pos, normal, north, east = local_frame(lla)
 
-    # north and east unit vectors used for azimuth calcs
-    north = np.array([0,0,1])
-    north = north - np.dot(north, normal) * normal
-    north = north / np.linalg.norm(north)
-    east = np.cross(north, normal)
+    sunlit = np.asarray(sunlit, dtype=bool)
 
-    inview = []
-    
-    for i in range(sats_ecef.shape[0]):
-        sat_pos = sats_ecef[i, :]
-        sat_rel = sat_pos - pos
-        sat_rel_unit = sat_rel / np.linalg.norm(sat_rel)
-
-        # theta is angle off of zenith
-        cos_theta = np.dot(normal, sat_rel_unit)
-
-        if cos_theta > 0:
-            # az/el in local frame, az CW from NORTH 
-            el = 90.0 - np.arccos(cos_theta) * RAD2DEG
-
-            sat_north = np.dot(sat_rel_unit, north)
-            sat_east = np.dot(sat_rel_unit, east)
-            az = np.arctan2(sat_east, sat_north) * RAD2DEG
-
-            # angle between sun and sat dirs (180 is good, 0 is bad)
-            sunphase = np.arccos(np.dot(sat_rel_unit, sun_ecef)) * RAD2DEG
-
-            inview.append({"name": sat_names[i],
-                           "sunlit": sunlit[i],
-                           "sunphase": int(sunphase),
-                           "az": int(az),
-                           "el": int(el)})
-    return inview
+    # only satellites whose footprint can reach the observer, in catalog order
+    if index is None:
+        cand = np.arange(sats_ecef.shape[0])
+    else:
+        cand = footprint_candidates(index, pos)
 
+    sat_rel = observer_relative(sats_ecef[cand], pos)
+    sat_rel_unit = sat_rel / np.linalg.norm(sat_rel, axis=1, keepdims=True)
 
-def read_satellite_data(group, local_dir=None):
+    # theta is angle off of zenith, cos_theta is sin(el) so elevation limits
+    # become thresholds on the dot product
+    cos_theta = sat_rel_unit @ normal
+
+    mask = visible_mask(cos_theta, sunlit[cand], min_el, max_el, sunlit_only)
+    keep = np.flatnonzero(mask)
+
+    return describe_visible(sat_names, sat_rel_unit[keep], cos_theta[keep], cand[keep], sunlit, sun_ecef,
+                            north, east, az_min, az_max, max_results)
+
+
+def visible_local_batch(sat_names, sats_ecef, sun_ecef, sunlit, llas, min_el=0.0, max_el=90.0,
+                        sunlit_only=False, az_min=None, az_max=None, max_results=None):
     """
-    Read satellite data from data.json file stored in S3, return as dict
+    visible_local for many observers against one propagated snapshot. Line of
+    sight and elevation masks are computed as an observers x satellites
+    broadcast, in chunks of observers so that no array is bigger than
+    BATCH_MAX_ELEMENTS rows
+
+    Catalogs of at least FOOTPRINT_MIN_SATS satellites are instead indexed once
+    with build_footprint_index() and each observer only looks at the satellites
+    that can be above its horizon. Results are the same either way
 
     Parameters:
+    llas: M,3 np.array lat/lon/alt in deg/deg/alt of each observer
+    others: see visible_local()
 
     Returns:
-    sat dict with name keys and tle tuple values
+    M, list of visible_local() results, one per observer
     """
-    if group == "brightest":
-        obj_sats_key = obj_sats_key_brightest
-    elif group == "gps":
-        obj_sats_key = obj_sats_key_gps
+    pos, normal, north, east = local_frame(llas.T)
+    pos, normal, north, east = pos.T, normal.T, north.T, east.T
 
-    if local_dir is None:
-        data_s3 = s3.get_object(Bucket=obj_bucket, Key=obj_sats_key)
-        return json.loads(data_s3["Body"].read().decode("UTF-8"))
-    else:
-        with open(local_dir + "/" + obj_sats_key) as fptr:
-            data_local = json.load(fptr)
-        return data_local
+    sunlit = np.asarray(sunlit, dtype=bool)
+
+    if sats_ecef.shape[0] >= FOOTPRINT_MIN_SATS:
+        index = build_footprint_index(sats_ecef, min_el)
+        res = []
+
+        for m in range(llas.shape[0]):
+            cand = footprint_candidates(index, pos[m])
+            sat_rel = observer_relative(sats_ecef[cand], pos[m])
+            sat_rel_unit = sat_rel / np.linalg.norm(sat_rel, axis=1, keepdims=True)
+            cos_theta = sat_rel_unit @ normal[m]
 
+            keep = np.flatnonzero(visible_mask(cos_theta, sunlit[cand], min_el, max_el, sunlit_only))
+            res.append(describe_visible(sat_names, sat_rel_unit[keep], cos_theta[keep], cand[keep], sunlit, sun_ecef,
+                                        north[m], east[m], az_min, az_max, max_results))
 
-def load_ephemeris(local_dir=None):
+        return res
+    chunk = max(1, BATCH_MAX_ELEMENTS // max(sats_ecef.shape[0], 1))
+
+    res = []
+
+    for start in range(0, llas.shape[0], chunk):
+        stop = min(start + chunk, llas.shape[0])
+
+        # m,N,3 line of sight from each observer in chunk to each satellite
+        sat_rel = observer_relative(sats_ecef[None, :, :], pos[start:stop, None, :])
+        sat_rel_unit = sat_rel / np.linalg.norm(sat_rel, axis=2, keepdims=True)
+        cos_theta = np.einsum("mnk,mk->mn", sat_rel_unit, normal[start:stop].astype(sat_rel.dtype))
+
+        mask = visible_mask(cos_theta, sunlit[None, :], min_el, max_el, sunlit_only)
+
+        for m in range(stop - start):
+            idx = np.flatnonzero(mask[m])
+            res.append(describe_visible(sat_names, sat_rel_unit[m, idx], cos_theta[m, idx], idx, sunlit, sun_ecef,
+                                        north[start + m], east[start + m], az_min, az_max, max_results))
+
+    return res
+
+
+def build_footprint_index(sats_ecef, min_el=0.0, cell_deg=FOOTPRINT_CELL_DEG):
     """
-    Use skyfield to load ephemeris from s3
+    Index a propagated snapshot on sub-satellite points so that an observer can
+    find the satellites that may be above min_el without looking at the others
+
+    A satellite at radius r is at least e above the horizon of an observer at
+    radius R only if the central angle between them is at most its footprint
+    radius 90 deg - e - asin(R cos(e) / r). Using the smallest ground radius
+    (RE_SEMIMINOR_M) and e = min_el - FOOTPRINT_MARGIN_DEG makes the radius an
+    upper bound for any observer on or above the ellipsoid. Satellites are
+    bucketed on a cell_deg lat/lon grid, each cell keeps how far its
+    satellites can reach past the cell center
+
+    Parameters:
+    sats_ecef: N,3 np.array of satellite ECEF positions in meters
+    min_el: elevation in deg the index is built for
+    cell_deg: grid cell size in deg
+
+    Returns:
+    dict with
+        order: K, satellite indices sorted by cell (satellites that failed to propagate are left out)
+        starts: C+1, offsets into order of each cell
+        cell_unit: C,3 np.array cell center unit vectors
+        cos_cell_reach: C, np.array cos of the largest footprint radius in the
+            cell plus the cell half diagonal (above 1 for empty cells)
+        sat_unit: N,3 np.array satellite unit vectors
+        cos_radius: N, np.array cos of each footprint radius
     """
-    if local_dir is None:
-        lambda_path = lambda_tmp + "/" + obj_ephem_key
-        if not os.path.exists(lambda_path):
-            print("Downloading ephem file from S3")
-            s3.download_file(Bucket=obj_bucket, Key=obj_ephem_key, Filename=lambda_path)
+    r = np.linalg.norm(sats_ecef, axis=1)
+    sat_unit = sats_ecef / r[:, None]
+    valid = np.flatnonzero(np.isfinite(r))
 
-        return load_file(lambda_path)
+    # footprint radius, the whole sphere if the bound breaks down (e.g. at or
+    # below -90 deg or a satellite under the surface)
+    el = (min_el - FOOTPRINT_MARGIN_DEG) * DEG2RAD
+    ratio = RE_SEMIMINOR_M * np.cos(el) / r
+    radius = np.full(r.shape, np.pi)
+    ok = (ratio <= 1.0) & (np.cos(el) > 0)
+    radius[ok] = np.pi / 2 - el - np.arcsin(ratio[ok])
+    radius = np.clip(radius, 0.0, np.pi)
 
-    else:
-        local_path = local_dir + "/" + obj_ephem_key
-        return load_file(local_path)
+    n_lat = int(np.ceil(180.0 / cell_deg))
+    n_lon = int(np.ceil(360.0 / cell_deg))
+
+    lat = np.arcsin(np.clip(sat_unit[valid, 2], -1.0, 1.0)) * RAD2DEG
+    lon = np.arctan2(sat_unit[valid, 1], sat_unit[valid, 0]) * RAD2DEG
+    i_lat = np.clip(((lat + 90.0) // cell_deg).astype(int), 0, n_lat - 1)
+    i_lon = np.clip(((lon + 180.0) // cell_deg).astype(int), 0, n_lon - 1)
+    cell = i_lat * n_lon + i_lon
+
+    order = valid[np.argsort(cell, kind="stable")]
+    starts = np.searchsorted(np.sort(cell), np.arange(n_lat * n_lon + 1))
+
+    cell_radius = np.full(n_lat * n_lon, -np.inf)
+    np.maximum.at(cell_radius, cell, radius[valid])
+
+    # cell centers and the farthest corner or edge midpoint from each center
+    lat_edges = np.minimum(np.arange(n_lat + 1) * cell_deg - 90.0, 90.0)
+    lon_edges = np.minimum(np.arange(n_lon + 1) * cell_deg - 180.0, 180.0)
+    lat_lo, lon_lo = np.meshgrid(lat_edges[:-1], lon_edges[:-1], indexing="ij")
+    lat_hi, lon_hi = np.meshgrid(lat_edges[1:], lon_edges[1:], indexing="ij")
+    lat_c = (lat_lo + lat_hi) / 2
+    lon_c = (lon_lo + lon_hi) / 2
+    cell_unit = geocentric_unit(lat_c, lon_c).reshape(-1, 3)
+
+    half_diag = np.zeros(n_lat * n_lon)
+    for lat_p in [lat_lo, lat_c, lat_hi]:
+        for lon_p in [lon_lo, lon_c, lon_hi]:
+            cos_d = np.sum(geocentric_unit(lat_p, lon_p).reshape(-1, 3) * cell_unit, axis=1)
+            half_diag = np.maximum(half_diag, np.arccos(np.clip(cos_d, -1.0, 1.0)))
+
+    # slack for rounding, empty cells never match
+    cos_cell_reach = np.full(n_lat * n_lon, 2.0)
+    filled = np.isfinite(cell_radius)
+    cos_cell_reach[filled] = np.cos(np.minimum(cell_radius[filled] + half_diag[filled], np.pi)) - 1e-9
+
+    return {"order": order,
+            "starts": starts,
+            "cell_unit": cell_unit,
+            "cos_cell_reach": cos_cell_reach,
+            "sat_unit": sat_unit,
+            "cos_radius": np.cos(radius)}
 
 
-def propagate_ecef_sunlit(sats, time_utc, ephem):
+def footprint_candidates(index, pos):
     """
-    Calc ECEF position and sunlit status of each sat in sats dict at time
+    Satellites whose footprint can cover an observer, see build_footprint_index()
 
     Parameters:
-    sats: dict of sat name (key) and tle (value)
-    time_utc: string in format YYYY-MM-DD HH:MM:SS of propagation end time
-    ephem: ephemeris object with sun data from load_ephemeris()
-    
+    index: dict from build_footprint_index()
+    pos: 3, np.array observer ECEF position in meters
+
     Returns:
-    N,3 ECEF position array in meters
-    N, boolean list of whether satellite is sunlit in position
+    np.array satellite indices in catalog order
     """
-    # convert time to skyfield time format
-    timescale = load.timescale(builtin=True)
-    time_dt = datetime.strptime(time_utc, "%Y-%m-%d %H:%M:%S")
-    time_ts = timescale.utc(time_dt.replace(tzinfo=utc))
+    r_obs = np.linalg.norm(pos)
+    if r_obs < RE_SEMIMINOR_M:
+        # footprints only bound observers on or above the ellipsoid
+        return np.arange(index["sat_unit"].shape[0])
+
+    obs_unit = pos / r_obs
+
+    # cells close enough for their widest footprint to reach the observer
+    cells = np.flatnonzero(index["cell_unit"] @ obs_unit >= index["cos_cell_reach"])
 
-    pos_list = []
-    sunlit_list = []
+    # concatenate order[starts[c]:starts[c + 1]] over those cells
+    counts = index["starts"][cells + 1] - index["starts"][cells]
+    first = np.repeat(index["starts"][cells] - np.concatenate([[0], np.cumsum(counts)[:-1]]), counts)
+    cand = index["order"][first + np.arange(first.size)]
 
-    for sat_name, tle in sats.items():
-        sat = EarthSatellite(line1=tle[0], line2=tle[1])
-        pos = sat.at(time_ts)
-        pos_list.append(pos.frame_xyz(itrs).m)
-        sunlit_list.append(bool(pos.is_sunlit(ephem)))
+    # then each satellite's own footprint, with a little slack for rounding
+    cand = cand[index["sat_unit"][cand] @ obs_unit >= index["cos_radius"][cand] - 1e-9]
+    return np.sort(cand)
 
-    return np.array(pos_list), sunlit_list
+
+def geocentric_unit(lat, lon):
+    """
+    Unit vectors of geocentric lat/lon in deg, shape (...) -> (..., 3)
+    """
+    lat = lat * DEG2RAD
+    lon = lon * DEG2RAD
+    return np.stack([np.cos(lat) * np.cos(lon), np.cos(lat) * np.sin(lon), np.sin(lat)], axis=-1)
 
 
-def get_sun_direction_ecef(time_utc, ephem):
+def visible_mask(cos_theta, sunlit, min_el=0.0, max_el=90.0, sunlit_only=False):
     """
-    Get the sun unit vector in ECEF frame
+    Elevation and sunlit filters as a mask on cos_theta (sin of elevation)
 
     Parameters:
-    time_utc: string in format YYYY-MM-DD HH:MM:SS of propagation end time
-    ephem: ephemeris object with sun data from load_ephemeris()
+    cos_theta: N, (or M,N) np.array of cos of angle off zenith
+    sunlit: np.array of bools that broadcasts against cos_theta
+    others: see visible_local()
 
     Returns:
-    3, numpy array of sun unit vector from ECEF
+    boolean np.array shaped like cos_theta
     """
-    # convert time to skyfield time format
-    timescale = load.timescale(builtin=True)
-    time_dt = datetime.strptime(time_utc, "%Y-%m-%d %H:%M:%S")
-    time_ts = timescale.utc(time_dt.replace(tzinfo=utc))
-    
-    sun, earth = ephem["sun"], ephem["earth"]
+    mask = cos_theta > np.sin(min_el * DEG2RAD)
+    if max_el < 90.0:
+        mask &= cos_theta <= np.sin(max_el * DEG2RAD)
+    if sunlit_only:
+        mask &= sunlit
+    return mask
 
-    pos = earth.at(time_ts).observe(sun)
-    pos_ecef = pos.frame_xyz(itrs).au
-    return pos_ecef / np.linalg.norm(pos_ecef)
 
+def describe_visible(sat_names, sat_rel_unit, cos_theta, idx, sunlit, sun_ecef, north, east,
+                     az_min=None, az_max=None, max_results=None):
+    """
+    Apply the azimuth sector and max_results filters to satellites that passed
+    visible_mask(), then compute az/el/sunphase for whatever is left
+
+    Parameters:
+    sat_names: N, list of satellite names
+    sat_rel_unit: K,3 np.array line of sight unit vectors of passing sats
+    cos_theta: K, np.array cos of angle off zenith of passing sats
+    idx: K, np.array index of passing sats into sat_names/sunlit
+    sunlit: N, np.array of bools
+    sun_ecef: 3, np.array unit vector
+    north/east: 3, np.array local unit vectors of observer
+    others: see visible_local()
 
-def lla_to_ecef(lla):
+    Returns:
+    list of dicts, see visible_local()
     """
-    Convert lat/lon/alt to earth-centered position vector
+    sat_north = sat_rel_unit @ north
+    sat_east = sat_rel_unit @ east
+
+    if az_min is not None and az_max is not None:
+        in_sector = in_azimuth_sector(sat_east, sat_north, az_min, az_max)
+        idx = idx[in_sector]
+        sat_rel_unit = sat_rel_unit[in_sector]
+        cos_theta = cos_theta[in_sector]
+        sat_north = sat_north[in_sector]
+        sat_east = sat_east[in_sector]
+
+    if max_results is not None and idx.size > max_results:
+        # keep the highest sats, but return them in catalog order
+        keep = np.sort(np.argsort(-cos_theta, kind="stable")[:max_results])
+        idx = idx[keep]
+        sat_rel_unit = sat_rel_unit[keep]
+        cos_theta = cos_theta[keep]
+        sat_north = sat_north[keep]
+        sat_east = sat_east[keep]
 
-    See https://en.wikipedia.org/wiki/Geographic_coordinate_conversion#From_geodetic_to_ECEF_coordinates
+    # az/el in local frame, az CW from NORTH 
+    el = 90.0 - np.arccos(np.clip(cos_theta, -1.0, 1.0)) * RAD2DEG
+    az = np.arctan2(sat_east, sat_north) * RAD2DEG
+
+    # angle between sun and sat dirs (180 is good, 0 is bad)
+    sunphase = np.arccos(np.clip(sat_rel_unit @ sun_ecef, -1.0, 1.0)) * RAD2DEG
+
+    inview = []
+
+    for j, i in enumerate(idx):
+        inview.append({"name": sat_names[i],
+                       "sunlit": bool(sunlit[i]),
+                       "sunphase": int(sunphase[j]),
+                       "az": int(az[j]),
+                       "el": int(el[j])})
+    return inview
+
+
+def in_azimuth_sector(sat_east, sat_north, az_min, az_max):
+    """
+    Check which local horizontal directions fall in an azimuth sector, using
+    cross products against the sector edges rather than computing azimuths
 
     Parameters:
-    lla: 3, np.array in deg/deg/m
-    
+    sat_east: N, np.array east component of direction
+    sat_north: N, np.array north component of direction
+    az_min: sector start azimuth in deg (clockwise from North)
+    az_max: sector end azimuth in deg, sector runs clockwise from az_min
+
     Returns:
-    3, np.array in meters
+    N, boolean np.array of whether each direction is in the sector
     """
-    sin_lat = np.sin(lla[0] * DEG2RAD)
-    cos_lat = np.cos(lla[0] * DEG2RAD)
-    sin_lon = np.sin(lla[1] * DEG2RAD)
-    cos_lon = np.cos(lla[1] * DEG2RAD)
+    width = (az_max - az_min) % 360.0
+    if width == 0.0:
+        return np.ones(sat_east.shape, dtype=bool)
+
+    start_east, start_north = np.sin(az_min * DEG2RAD), np.cos(az_min * DEG2RAD)
+    stop_east, stop_north = np.sin(az_max * DEG2RAD), np.cos(az_max * DEG2RAD)
 
-    ratio_square = (RE_SEMIMINOR_M ** 2) / (RE_SEMIMAJOR_M ** 2)
-    ecc_square = 1 - ratio_square
+    # positive when direction b is clockwise of direction a (by less than 180 deg)
+    after_start = start_north * sat_east - start_east * sat_north >= 0
+    before_stop = sat_north * stop_east - sat_east * stop_north >= 0
 
-    N = RE_SEMIMAJOR_M / np.sqrt(1 - ecc_square * sin_lat * sin_lat)
+    if width <= 180.0:
+        return after_start & before_stop
+    else:
+        return after_start | before_stop
 
-    x = (N + lla[2]) * cos_lat * cos_lon
-    y = (N + lla[2]) * cos_lat * sin_lon
-    z = (ratio_square * N + lla[2]) * sin_lat
 
-    return np.array([x, y, z])
+def parse_visible_filters(params):
+    """
+    Pull the optional visible_local filters out of query string parameters
 
+    Parameters:
+    params: dict of query string parameters, all values may be strings
 
-def lla_to_ecef_normal(lla):
+    Returns:
+    dict of keyword arguments for visible_local
     """
-    Normal/zenith direction in ECEF frame
+    filters = {}
+
+    for key in ["min_el", "max_el", "az_min", "az_max"]:
+        if params.get(key) is not None:
+            filters[key] = float(params[key])
+
+    if params.get("sunlit_only") is not None:
+        filters["sunlit_only"] = str(params["sunlit_only"]).lower() in ["1", "true", "yes"]
+
+    if params.get("max_results") is not None:
+        filters["max_results"] = int(params["max_results"])
+
+    return filters
+
+
+def read_satellite_data(group, local_dir=None):
+    """
+    Read satellite data from data.json file stored in S3, return as dict
+
+    Parameters:
+    group: name of satellite group, one of sat_groups
+    local_dir: path to use as a stand-in for bucket
+
+    Returns:
+    sat dict with name keys and tle tuple values
+    """
+    _, data = read_object_if_changed(satellite_data_key(group), None, local_dir)
+    return json.loads(bytes(maybe_gunzip(data)).decode("UTF-8"))
+
+
+def satellite_data_key(group):
+    """
+    Object key of the satellite data file for group
+    """
+    if group not in sat_groups and group != master_catalog_group:
+        raise ValueError("Unknown satellite group {}".format(group))
+
+    return group + ".json"
+
+
+def load_group_catalog(group, local_dir=None):
+    """
+    Catalog for the group parameter of a request, one group or (with
+    MASTER_CATALOG "on") a comma separated union of groups
 
     Parameters:
-    lla: 3, np.array lat/lon/alt in deg/deg/m
+    group: group name(s), see satellite_data_key()
+    local_dir: path to use as a stand-in for bucket
 
     Returns:
-    3, np.array unit normal vector of lla position
+    catalog dict, see load_catalog() and group_view()
     """
-    lat = lla[0] * DEG2RAD
-    lon = lla[1] * DEG2RAD
-    
-    return np.array([np.cos(lat) * np.cos(lon),
-                     np.cos(lat) * np.sin(lon),
-                     np.sin(lat)])
+    groups = group.split(",")
+
+    if MASTER_CATALOG == "on":
+        return group_view(load_catalog(master_catalog_group, local_dir), groups)
+
+    if len(groups) > 1:
+        raise ValueError("Several groups can only be queried with MASTER_CATALOG on")
+
+    return load_catalog(group, local_dir)
+
+
+def load_catalog(group, local_dir=None):
+    """
+    Return the propagation-ready catalog of a group, see load_catalog_object()
+
+    Parameters:
+    group: name of satellite group, see satellite_data_key()
+    local_dir: path to use as a stand-in for bucket
+
+    Returns:
+    catalog dict from load_catalog_object(), with grid if EPHEM_GRID is "on"
+    """
+    load_snapshot(SNAPSHOT_PATH)
+    return load_catalog_object(satellite_data_key(group), local_dir, EPHEM_GRID == "on")
+
+
+def write_snapshot(local_dir=None, groups=None, path=SNAPSHOT_PATH):
+    """
+    Snapshot the timescale and the parsed catalogs for cold starts, see
+    dump_snapshot(). Run before zipping the lambda, the snapshot goes next to
+    lambda_function.py
+
+    Parameters:
+    local_dir: path to use as a stand-in for bucket
+    groups: list of groups to include, default every group in sat_groups and the
+        master catalog that exists
+    path: output file
+    """
+    catalogs = {}
+    for group in sat_groups + [master_catalog_group] if groups is None else groups:
+        try:
+            catalogs[satellite_data_key(group)] = load_catalog(group, local_dir)
+        except FileNotFoundError:
+            if groups is not None:
+                raise
+
+    dump_snapshot(catalogs, path)
+
+
+def load_catalog_and_ephemeris(group, local_dir=None):
+    """
+    Load catalog and ephemeris for a request, see load_with_ephemeris()
+
+    Returns:
+    catalog dict from load_group_catalog()
+    ephemeris object from load_ephemeris()
+    """
+    return load_with_ephemeris(lambda: load_group_catalog(group, local_dir), local_dir)
+
 
+if STARTUP == "eager":
+    warm_start(SNAPSHOT_PATH)
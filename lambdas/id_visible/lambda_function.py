@@ -1,26 +1,46 @@
 import os
 import json
-from datetime import datetime
-import boto3
+from datetime import datetime, timedelta
 
 import numpy as np
 
-from skyfield.api import load, utc, load_file
-from skyfield.sgp4lib import EarthSatellite
-from skyfield.framelib import itrs
+from satlib.storage import read_object_if_changed, maybe_gunzip
+from satlib.metrics import LOG_RESULTS, request_metrics, timed, count_metric, cache_metric
+from satlib.events import request_parameters, quantize_request
+from satlib.geometry import DEG2RAD, RAD2DEG, RE_SEMIMAJOR_M, local_frame, observer_relative
+from satlib.propagation import propagator_subset, propagate_catalog_ecef_sunlit, propagate_track_ecef_sunlit
+from satlib.catalogs import (STARTUP, MASTER_CATALOG, master_catalog_group, load_catalog_object, group_view,
+                             load_with_ephemeris, snapshot_path, dump_snapshot, load_snapshot, warm_start)
+from satlib.ephem_grid import EPHEM_GRID
+
+SKY_CELL_DEG = 5.0
+SKY_INDEX_CACHE_SIZE = 16
+# sky indexes are built for the observer rounded to SKY_INDEX_DEG and the time
+# rounded down to SKY_INDEX_SECONDS, so a phone sweeping the sky from one place
+# keeps hitting the same index. The index only picks candidates, which are then
+# propagated for the exact observer and time, see sky_index_slack()
+SKY_INDEX_DEG = float(os.environ.get("SKY_INDEX_DEG", "0.01"))
+SKY_INDEX_SECONDS = int(os.environ.get("SKY_INDEX_SECONDS", "5"))
+# closest range of a satellite, bounds the parallax of the rounded observer
+SKY_INDEX_MIN_RANGE_M = 150000.0
+
+# trace mode (see identify_trace()): fastest apparent motion of a satellite
+# across the sky, which bounds how far one can be from its position at the
+# middle of the trace (LEO passing overhead at 200 km is about 2.2 deg/s)
+TRACE_MAX_RATE_DEG_S = 2.5
+# deg of path error that one deg/s of angular rate error costs in the score.
+# Rate is what separates a moving satellite from neighbours when the pointing
+# has a few deg of bias, but on a phone it is only good to ~0.1-0.2 deg/s
+TRACE_RATE_WEIGHT_S = 30.0
+TRACE_MAX_SAMPLES = 200
 
-# Constants
-DEG2RAD = 0.017453292519943296
-RAD2DEG = 57.295779513082321
-RE_SEMIMAJOR_M = 6378137.0
-RE_SEMIMINOR_M = 6356752.0
-RE_MEAN_M = 6371008.0
-
-s3 = boto3.client("s3")
-obj_bucket = "sat-finder-private"
 obj_sats_key = "sats.json"
-obj_ephem_key = "de421.bsp"
-lambda_tmp = "/tmp"
+
+# parsed catalog snapshot, see write_snapshot() and snapshot_path()
+SNAPSHOT_PATH = snapshot_path(__file__)
+
+# sky indexes kept between warm invocations, keyed on (rounded lat, lon, time_utc, catalog version)
+sky_index_cache = {}
 
 
 def test_local(local_dir, lat, lon, az, el, time_utc):
@@ -46,236 +66,558 @@ def lambda_handler(event, context):
 
     {"lat": lat_degrees, "lon": lon_degrees, "az": az_degrees, "el": el_degrees, "time_utc": YYYY-MM-DD HH:MM:SS string}
 
+    Optional:
+    {"threshold": max error in deg, "top_k": max number of results}
+
     Returns:
-    list of dicts {"name": str, "err": float, "az": float, "el": float}
+    list of dicts {"name": str, "err": float, "az": float, "el": float}, smallest err first
+
+    Trace form, as query string or JSON body, identifies from a short pointing
+    trace (e.g. a few seconds of samples from scripts/point.js) by matching the
+    path and angular rate of each satellite, see identify_trace():
+
+    {"lat": lat_degrees, "lon": lon_degrees, "time_utc": string of trace start,
+     "trace": [{"t": seconds after time_utc, "az": az_degrees, "el": el_degrees}, ...],
+     "threshold": optional max path error in deg, "top_k": optional int}
+
+    Trace returns:
+    list of dicts {"name": str, "err": float, "rate_err": float, "score": float,
+                   "az": float, "el": float}, best score first
     """
     if "localTestDir" in event:
         local_dir = event["localTestDir"]
     else:
         local_dir = None
 
-    lat = float(event["queryStringParameters"]["lat"])
-    lon = float(event["queryStringParameters"]["lon"])
-    az = float(event["queryStringParameters"]["az"])
-    el = float(event["queryStringParameters"]["el"])
-    time_utc = event["queryStringParameters"]["time_utc"]
+    with request_metrics("id_visible", event) as metrics:
+        params = request_parameters(event)
+        if "trace" in params:
+            metrics["mode"] = "trace"
+            return identify_trace_request(params, local_dir)
+
+        metrics["mode"] = "single"
+
+        lat = float(event["queryStringParameters"]["lat"])
+        lon = float(event["queryStringParameters"]["lon"])
+        az = float(event["queryStringParameters"]["az"])
+        el = float(event["queryStringParameters"]["el"])
+        time_utc = event["queryStringParameters"]["time_utc"]
+        threshold = float(event["queryStringParameters"].get("threshold", 20))
+        top_k = event["queryStringParameters"].get("top_k")
+        top_k = None if top_k is None else int(top_k)
+
+        print("Identify object from location lat: {}, lon:{} at time: {}".format(lat, lon, time_utc))
+        print("Object direction az: {}, el: {}".format(az, el))
 
-    print("Identify object from location lat: {}, lon:{} at time: {}".format(lat, lon, time_utc))
-    print("Object direction az: {}, el: {}".format(az, el))
+        lla = np.array([lat, lon, 0])
+        res = identify_pointing(lla, time_utc, az, el, threshold, top_k, local_dir)
+
+        count_metric("results", len(res))
+
+        if LOG_RESULTS == "on":
+            print("Results: {}".format(res))
+
+        return res
+
+
+def identify_trace_request(params, local_dir=None):
+    """
+    Trace form of lambda_handler, see identify_trace()
+
+    Parameters:
+    params: request parameters with "lat", "lon", "time_utc" and "trace"
+    local_dir: path to use as a stand-in for bucket
+
+    Returns:
+    list of dicts, see identify_trace()
+    """
+    lat = float(params["lat"])
+    lon = float(params["lon"])
+    time_utc = params["time_utc"]
+    threshold = float(params.get("threshold", 20))
+    top_k = params.get("top_k")
+    top_k = None if top_k is None else int(top_k)
+
+    trace = params["trace"]
+    if isinstance(trace, str):
+        trace = json.loads(trace)
+    if not 0 < len(trace) <= TRACE_MAX_SAMPLES:
+        raise ValueError("trace needs 1 to {} samples".format(TRACE_MAX_SAMPLES))
+
+    trace = sorted(trace, key=lambda sample: float(sample["t"]))
+    offsets_s = np.array([float(sample["t"]) for sample in trace])
+    dir_az = np.array([float(sample["az"]) for sample in trace])
+    dir_el = np.array([float(sample["el"]) for sample in trace])
+
+    print("Identify object from location lat: {}, lon:{} with {} samples from time: {}".format(
+        lat, lon, offsets_s.size, time_utc))
 
     lla = np.array([lat, lon, 0])
-    sats = read_satellite_data(local_dir)
-    ephem = load_ephemeris(local_dir)
-    sats_ecef, sunlit = propagate_ecef_sunlit(sats, time_utc, ephem)
-    res = identify_object(az, el, list(sats.keys()), sats_ecef, sunlit, lla)
+    res = identify_trace(lla, time_utc, offsets_s, dir_az, dir_el, threshold, top_k, local_dir)
 
-    if len(res) == 0:
-        print("No nearby results found")
-    else:
+    count_metric("time_steps", offsets_s.size)
+    count_metric("results", len(res))
+
+    if LOG_RESULTS == "on":
         print("Results: {}".format(res))
 
     return res
 
 
-def identify_object(dir_az, dir_el, sat_names, sats_ecef, sunlit, lla, threshold=20):
+def identify_pointing(lla, time_utc, dir_az, dir_el, threshold=20, top_k=None, local_dir=None):
     """
-    Returns names of satellites that are in view of lla location
+    Satellites within threshold deg of one pointing direction, ranked by error.
+    A trace of a single sample, see identify_trace()
 
     Parameters:
+    lla: 3, np.array lat/lon/alt in deg/deg/alt
+    time_utc: string in format YYYY-MM-DD HH:MM:SS
     dir_az: object azimuth (clockwise from North) in deg
     dir_el: object elevation in deg
-    sat_names: N, list of satellite names
-    sats_ecef: N,3 np.array of satellite ECEF positions in meters
-    sun_ecef: 3, np.array unit vector
-    sunlit: N, list of bools
-    lla: 3, np.array lat/lon/alt in deg/deg/alt
-    threshold: number of degrees error to return in list
+    threshold: max err in deg to return
+    top_k: max number of results to return, None for all within threshold
+    local_dir: path to use as a stand-in for bucket
 
     Returns:
-    list of dicts {"name": str, "err": float, "az": float, "el": float}
+    list of dicts {"name": str, "err": float, "az": float, "el": float}, smallest err first
     """
     # check to make sure we're pointing above horizon
     if dir_el < 0:
-        print("identify_object: returning empty because pointing direction is below horizon (el < 0)")
+        print("identify_pointing: returning empty because pointing direction is below horizon (el < 0)")
+        return []
+
+    res = identify_trace(lla, time_utc, np.zeros(1), np.array([dir_az]), np.array([dir_el]), threshold, top_k, local_dir)
+    return [{"name": r["name"], "err": r["err"], "az": r["az"], "el": r["el"]} for r in res]
+
+
+def identify_trace(lla, time_utc, offsets_s, dir_az, dir_el, threshold=20, top_k=None, local_dir=None):
+    """
+    Rank satellites by how well their motion across the sky matches a pointing
+    trace, which separates neighbours a single noisy sample cannot
+
+    Candidates come from a cone query against the sky index at the middle of
+    the trace, wide enough for the spread of the trace plus TRACE_MAX_RATE_DEG_S
+    of motion to either end and the rounding of the index (sky_index_slack()),
+    so only a fraction of the satellites get propagated (in one call over all
+    sample times). Each is scored on
+    err: RMS angle in deg between pointing and satellite over the samples
+    rate_err: deg/s difference between the angular velocity of a straight line
+        fit to the trace and to the satellite, which a constant pointing bias
+        (e.g. compass error) does not affect
+    score: err + TRACE_RATE_WEIGHT_S * rate_err
+    Satellites that are not sunlit at any sample are left out.
+
+    Parameters:
+    lla: 3, np.array lat/lon/alt in deg/deg/alt
+    time_utc: string in format YYYY-MM-DD HH:MM:SS of trace start
+    offsets_s: T, np.array sample times in seconds after time_utc, ascending
+    dir_az: T, np.array pointing azimuth (clockwise from North) in deg
+    dir_el: T, np.array pointing elevation in deg
+    threshold: max err in deg to return
+    top_k: max number of results to return, None for all within threshold
+    local_dir: path to use as a stand-in for bucket
+
+    Returns:
+    list of dicts {"name": str, "err": float, "rate_err": float, "score": float,
+                   "az": float, "el": float}, best score first, az/el of the
+    satellite at the last sample
+    """
+    dir_local = np.column_stack([np.cos(dir_el * DEG2RAD) * np.sin(dir_az * DEG2RAD),
+                                 np.cos(dir_el * DEG2RAD) * np.cos(dir_az * DEG2RAD),
+                                 np.sin(dir_el * DEG2RAD)])
+
+    # coarse cone around the mean pointing direction at the middle of the trace
+    center = np.mean(dir_local, axis=0)
+    if np.linalg.norm(center) < 1e-6 or center[2] < -np.sin(threshold * DEG2RAD):
+        print("identify_trace: returning empty because pointing direction is below horizon")
         return []
+    center = center / np.linalg.norm(center)
 
-    pos = lla_to_ecef(lla)
-    
-    # define local frame, compute object direction in ECEF
-    normal = lla_to_ecef_normal(lla) # z
-    north = np.array([0,0,1]) # y
-    north = north - np.dot(north, normal) * normal
-    north = north / np.linalg.norm(north)
-    east = np.cross(north, normal) # x
+    mid_s = 0.5 * (offsets_s[0] + offsets_s[-1])
+    mid_offset_s = int(round(mid_s))
+    spread = np.max(np.arccos(np.clip(dir_local @ center, -1.0, 1.0))) * RAD2DEG
+    motion = TRACE_MAX_RATE_DEG_S * np.max(np.abs(offsets_s - mid_offset_s))
 
-    dir_local_x = np.cos(dir_el * DEG2RAD) * np.sin(dir_az * DEG2RAD)
-    dir_local_y = np.cos(dir_el * DEG2RAD) * np.cos(dir_az * DEG2RAD)
-    dir_local_z = np.sin(dir_el * DEG2RAD)
+    time_dt = datetime.strptime(time_utc, "%Y-%m-%d %H:%M:%S")
+    mid_utc = (time_dt + timedelta(seconds=mid_offset_s)).strftime("%Y-%m-%d %H:%M:%S")
+    index = get_sky_index(lla, mid_utc, local_dir)
+
+    center_az = np.arctan2(center[0], center[1]) * RAD2DEG
+    center_el = np.arcsin(center[2]) * RAD2DEG
+
+    radius = min(threshold + spread + motion + sky_index_slack(), 180.0)
+    cand, _ = sky_cone(index, center_az, center_el, radius)
+    sat_idx = index["sat_idx"][cand]
 
-    dir_ecef = dir_local_x * east + dir_local_y * north + dir_local_z * normal
+    count_metric("satellites", sat_idx.size)
+
+    if sat_idx.size == 0:
+        return []
 
-    cos_threshold = np.cos(threshold * DEG2RAD)
+    catalog, ephem = load_catalog_and_ephemeris(local_dir)
+
+    with timed("propagate"):
+        satrecs = propagator_subset(catalog, sat_idx)
+        sats_ecef, sunlit = propagate_track_ecef_sunlit(satrecs, time_utc, offsets_s, ephem)
+
+    with timed("identify"):
+        pos, normal, north, east = local_frame(lla)
+        sat_rel = observer_relative(sats_ecef, pos)
+        sat_rel_unit = sat_rel / np.linalg.norm(sat_rel, axis=-1, keepdims=True)
+        los = sat_rel_unit @ np.column_stack([east, north, normal]).astype(sat_rel.dtype)
+
+        # T,N angle between pointing and satellite at every sample
+        cos_err = np.einsum("tni,ti->tn", los, dir_local.astype(los.dtype))
+        err = np.sqrt(np.mean(np.arccos(np.clip(cos_err, -1.0, 1.0)) ** 2, axis=0)) * RAD2DEG
+
+        # slope of the least squares line through the unit vectors, the angular
+        # velocity in rad/s for short traces, zero for a single sample
+        dt = offsets_s - np.mean(offsets_s)
+        dt_norm = np.sum(dt ** 2)
+        if dt_norm > 0:
+            rate_obs = dt @ dir_local / dt_norm
+            rate_sat = np.einsum("t,tni->ni", dt.astype(los.dtype), los) / dt_norm
+            rate_err = np.linalg.norm(rate_sat - rate_obs, axis=1) * RAD2DEG
+        else:
+            rate_err = np.zeros(sat_idx.size)
+
+        score = err + TRACE_RATE_WEIGHT_S * rate_err
+
+        # only satellites sunlit during the trace can be identified
+        within = np.flatnonzero(np.isfinite(score) & (err < threshold) & np.any(sunlit, axis=0))
+        ranked = within[np.argsort(score[within], kind="stable")]
+        if top_k is not None:
+            ranked = ranked[:top_k]
+
+        az = np.arctan2(los[-1, :, 0], los[-1, :, 1]) * RAD2DEG
+        el = np.arcsin(np.clip(los[-1, :, 2], -1.0, 1.0)) * RAD2DEG
 
     res = []
-    
-    for i in range(sats_ecef.shape[0]):
-        sat_pos = sats_ecef[i, :]
-        sat_rel = sat_pos - pos
-        sat_rel_unit = sat_rel / np.linalg.norm(sat_rel)
-
-        cos_err = np.dot(sat_rel_unit, dir_ecef)
-
-        # only append if this satellite is within threshold of pointing direction, sunlit, above horizon
-        if (cos_err > cos_threshold) and sunlit[i]:
-            err = np.arccos(cos_err) * RAD2DEG
-
-            # az/el in local frame, az CW from NORTH 
-            cos_theta = np.dot(normal, sat_rel_unit)
-            sat_el = 90.0 - np.arccos(cos_theta) * RAD2DEG
-
-            sat_north = np.dot(sat_rel_unit, north)
-            sat_east = np.dot(sat_rel_unit, east)
-            sat_az = np.arctan2(sat_east, sat_north) * RAD2DEG
-
-            res.append({"name": sat_names[i],
-                        "err": int(err),
-                        "az": int(sat_az),
-                        "el": int(sat_el)})
-    
+
+    for j in ranked:
+        res.append({"name": catalog["names"][sat_idx[j]],
+                    "err": int(err[j]),
+                    "rate_err": round(float(rate_err[j]), 2),
+                    "score": round(float(score[j]), 1),
+                    "az": int(az[j]),
+                    "el": int(el[j])})
+
     return res
 
 
-def read_satellite_data(local_dir=None):
+def identify_object(dir_az, dir_el, sat_names, sats_ecef, sunlit, lla, threshold=20, top_k=None):
     """
-    Read satellite data from data.json file stored in S3, return as dict
+    Returns names of satellites that are in view of lla location
+
+    Builds a one-off sky index, use get_sky_index/query_sky_index directly to
+    reuse the index for repeated pointing queries against the same snapshot.
 
     Parameters:
+    dir_az: object azimuth (clockwise from North) in deg
+    dir_el: object elevation in deg
+    sat_names: N, list of satellite names
+    sats_ecef: N,3 np.array of satellite ECEF positions in meters
+    sunlit: N, list of bools
+    lla: 3, np.array lat/lon/alt in deg/deg/alt
+    threshold: number of degrees error to return in list
+    top_k: max number of results to return, None for all within threshold
 
     Returns:
-    sat dict with name keys and tle tuple values
+    list of dicts {"name": str, "err": float, "az": float, "el": float}, smallest err first
     """
-    if local_dir is None:
-        data_s3 = s3.get_object(Bucket=obj_bucket, Key=obj_sats_key)
-        return json.loads(data_s3["Body"].read().decode("UTF-8"))
-    else:
-        with open(local_dir + "/" + obj_sats_key) as fptr:
-            data_local = json.load(fptr)
-        return data_local
+    index = build_sky_index(sat_names, sats_ecef, sunlit, lla)
+    return query_sky_index(index, dir_az, dir_el, threshold, top_k)
 
 
-def load_ephemeris(local_dir=None):
+def get_sky_index(lla, time_utc, local_dir=None):
     """
-    Use skyfield to load ephemeris from s3
+    Return the sky index for observer and time, building it (propagate, bucket)
+    only if it is not already cached in this container for the current catalog.
+    The index is for the observer rounded to SKY_INDEX_DEG and the time rounded
+    down to SKY_INDEX_SECONDS (see quantize_request()), so positions in it can
+    be off by up to sky_index_slack()
+
+    Parameters:
+    lla: 3, np.array lat/lon/alt in deg/deg/alt
+    time_utc: string in format YYYY-MM-DD HH:MM:SS
+    local_dir: path to use as a stand-in for bucket
+
+    Returns:
+    sky index dict from build_sky_index()
     """
-    if local_dir is None:
-        lambda_path = lambda_tmp + "/" + obj_ephem_key
-        if not os.path.exists(lambda_path):
-            print("Downloading ephem file from S3")
-            s3.download_file(Bucket=obj_bucket, Key=obj_ephem_key, Filename=lambda_path)
+    catalog, ephem = load_catalog_and_ephemeris(local_dir)
+    lat, lon, time_utc = quantize_request(float(lla[0]), float(lla[1]), time_utc, SKY_INDEX_DEG, SKY_INDEX_SECONDS)
+    key = (lat, lon, time_utc, catalog["version"])
 
-        return load_file(lambda_path)
+    cache_metric("sky_index", key in sky_index_cache)
 
-    else:
-        local_path = local_dir + "/" + obj_ephem_key
-        return load_file(local_path)
+    if key in sky_index_cache:
+        return sky_index_cache[key]
+
+    with timed("propagate"):
+        sats_ecef, sunlit = propagate_catalog_ecef_sunlit(catalog, time_utc, ephem)
+
+    with timed("sky_index"):
+        index = build_sky_index(catalog["names"], sats_ecef, sunlit, np.array([lat, lon, lla[2]]))
+
+    count_metric("satellites", len(catalog["names"]))
+
+    # drop the oldest snapshot once the cache is full
+    if len(sky_index_cache) >= SKY_INDEX_CACHE_SIZE:
+        sky_index_cache.pop(next(iter(sky_index_cache)))
+    sky_index_cache[key] = index
+
+    return index
+
+
+def sky_index_slack():
+    """
+    Deg a satellite can be from its direction in an index from get_sky_index():
+    its motion over the rounded off time plus the parallax of the rounded off
+    observer for a satellite SKY_INDEX_MIN_RANGE_M away
+    """
+    parallax = SKY_INDEX_DEG * DEG2RAD * RE_SEMIMAJOR_M / SKY_INDEX_MIN_RANGE_M * RAD2DEG
+    return TRACE_MAX_RATE_DEG_S * SKY_INDEX_SECONDS + parallax
 
 
-def propagate_ecef_sunlit(sats, time_utc, ephem):
+def build_sky_index(sat_names, sats_ecef, sunlit, lla, cell_deg=SKY_CELL_DEG):
     """
-    Calc ECEF position and sunlit status of each sat in sats dict at time
+    Bucket the line-of-sight unit vectors of satellites into an az/el sky grid,
+    so cone queries only look at nearby cells. Satellites below the horizon are
+    indexed too, a cone around a low pointing direction reaches below it. So
+    are unlit ones, which may be lit by the exact request time (see
+    get_sky_index()), query_sky_index() skips them
 
     Parameters:
-    sats: dict of sat name (key) and tle (value)
-    time_utc: string in format YYYY-MM-DD HH:MM:SS of propagation end time
-    ephem: ephemeris object with sun data from load_ephemeris()
-    
+    sat_names: N, list of satellite names
+    sats_ecef: N,3 np.array of satellite ECEF positions in meters
+    sunlit: N, list of bools
+    lla: 3, np.array lat/lon/alt in deg/deg/alt
+    cell_deg: size of grid cells in deg
+
     Returns:
-    N,3 ECEF position array in meters
-    N, boolean list of whether satellite is sunlit in position
+    dict with
+        names: M, list of indexed satellite names
+        sat_idx: M, np.array of the indexed satellites' positions in sat_names
+        los: M,3 np.array of east/north/up line-of-sight unit vectors
+        sunlit: M, boolean np.array of whether satellite is sunlit
+        az/el: M, np.array of satellite az (CW from North, -180 to 180) and el in deg
+        order: M, np.array of satellite indices sorted by grid cell
+        cell_starts: n_el*n_az+1, np.array of start of each cell in order
+        n_az/n_el/cell_deg: grid dimensions
     """
-    # convert time to skyfield time format
-    timescale = load.timescale(builtin=True)
-    time_dt = datetime.strptime(time_utc, "%Y-%m-%d %H:%M:%S")
-    time_ts = timescale.utc(time_dt.replace(tzinfo=utc))
+    pos, normal, north, east = local_frame(lla)
+
+    sat_rel = observer_relative(sats_ecef, pos)
+    sat_rel_unit = sat_rel / np.linalg.norm(sat_rel, axis=1, keepdims=True)
+    los = sat_rel_unit @ np.column_stack([east, north, normal]).astype(sat_rel.dtype)
+
+    # failed propagations are nan
+    keep = np.all(np.isfinite(los), axis=1)
+    los = los[keep]
+
+    # az/el in local frame, az CW from NORTH 
+    el = 90.0 - np.arccos(np.clip(los[:, 2], -1.0, 1.0)) * RAD2DEG
+    az = np.arctan2(los[:, 0], los[:, 1]) * RAD2DEG
 
-    pos_list = []
-    sunlit_list = []
+    n_az = int(np.ceil(360.0 / cell_deg))
+    n_el = int(np.ceil(180.0 / cell_deg))
+    cells = sky_cell(az, el, cell_deg, n_az, n_el)
 
-    for sat_name, tle in sats.items():
-        sat = EarthSatellite(line1=tle[0], line2=tle[1])
-        pos = sat.at(time_ts)
-        pos_list.append(pos.frame_xyz(itrs).m)
-        sunlit_list.append(bool(pos.is_sunlit(ephem)))
+    order = np.argsort(cells, kind="stable")
+    cell_starts = np.searchsorted(cells[order], np.arange(n_az * n_el + 1))
 
-    return np.array(pos_list), sunlit_list
+    return {"names": [name for name, k in zip(sat_names, keep) if k],
+            "sat_idx": np.flatnonzero(keep),
+            "los": los,
+            "sunlit": np.asarray(sunlit, dtype=bool)[keep],
+            "az": az,
+            "el": el,
+            "order": order,
+            "cell_starts": cell_starts,
+            "n_az": n_az,
+            "n_el": n_el,
+            "cell_deg": cell_deg}
 
 
-def get_sun_direction_ecef(time_utc, ephem):
+def sky_cell(az, el, cell_deg, n_az, n_el):
     """
-    Get the sun unit vector in ECEF frame
+    Grid cell number of az/el directions
 
     Parameters:
-    time_utc: string in format YYYY-MM-DD HH:MM:SS of propagation end time
-    ephem: ephemeris object with sun data from load_ephemeris()
+    az: N, np.array azimuth in deg
+    el: N, np.array elevation in deg, -90 to 90
+    cell_deg: size of grid cells in deg
+    n_az/n_el: number of grid cells in az and el
 
     Returns:
-    3, numpy array of sun unit vector from ECEF
+    N, np.array of int cell numbers
     """
-    # convert time to skyfield time format
-    timescale = load.timescale(builtin=True)
-    time_dt = datetime.strptime(time_utc, "%Y-%m-%d %H:%M:%S")
-    time_ts = timescale.utc(time_dt.replace(tzinfo=utc))
-    
-    sun, earth = ephem["sun"], ephem["earth"]
+    az_bin = np.floor((np.asarray(az) % 360.0) / cell_deg).astype(int) % n_az
+    el_bin = np.clip(np.floor((np.asarray(el) + 90.0) / cell_deg).astype(int), 0, n_el - 1)
+    return el_bin * n_az + az_bin
 
-    pos = earth.at(time_ts).observe(sun)
-    pos_ecef = pos.frame_xyz(itrs).au
-    return pos_ecef / np.linalg.norm(pos_ecef)
 
+def query_sky_index(index, dir_az, dir_el, threshold=20, top_k=None):
+    """
+    Cone query against a sky index: satellites within threshold deg of the
+    pointing direction, ranked by error
 
-def lla_to_ecef(lla):
+    Parameters:
+    index: sky index dict from build_sky_index()
+    dir_az: object azimuth (clockwise from North) in deg
+    dir_el: object elevation in deg
+    threshold: cone half angle in deg
+    top_k: max number of results to return, None for all within threshold
+
+    Returns:
+    list of dicts {"name": str, "err": float, "az": float, "el": float}, smallest err first
     """
-    Convert lat/lon/alt to earth-centered position vector
+    # check to make sure we're pointing above horizon
+    if dir_el < 0:
+        print("identify_object: returning empty because pointing direction is below horizon (el < 0)")
+        return []
+
+    cand, err = sky_cone(index, dir_az, dir_el, threshold)
+
+    # only sunlit satellites can be identified
+    lit = index["sunlit"][cand]
+    cand, err = cand[lit], err[lit]
+
+    ranked = np.argsort(err, kind="stable")
+    if top_k is not None:
+        ranked = ranked[:top_k]
 
-    See https://en.wikipedia.org/wiki/Geographic_coordinate_conversion#From_geodetic_to_ECEF_coordinates
+    res = []
+
+    for j in ranked:
+        i = cand[j]
+        res.append({"name": index["names"][i],
+                    "err": int(err[j]),
+                    "az": int(index["az"][i]),
+                    "el": int(index["el"][i])})
+
+    return res
+
+
+def sky_cone(index, dir_az, dir_el, threshold):
+    """
+    Indexed satellites within threshold deg of a direction, looking only at the
+    grid cells the cone touches
+
+    Parameters:
+    index: sky index dict from build_sky_index()
+    dir_az: azimuth (clockwise from North) in deg
+    dir_el: elevation in deg, -90 to 90
+    threshold: cone half angle in deg
+
+    Returns:
+    K, np.array of positions in the index of satellites inside the cone
+    K, np.array of their angle from the direction in deg
+    """
+    cell_deg = index["cell_deg"]
+    n_az = index["n_az"]
+    n_el = index["n_el"]
+
+    # el bands touched by the cone
+    el_lo = max(dir_el - threshold, -90.0)
+    el_hi = min(dir_el + threshold, 90.0)
+    el_bins = np.arange(int((el_lo + 90.0) // cell_deg), min(int((el_hi + 90.0) // cell_deg), n_el - 1) + 1)
+
+    # az half width of the cone, whole circle once it reaches the zenith or nadir
+    if el_hi >= 90.0 or el_lo <= -90.0:
+        az_bins = np.arange(n_az)
+    else:
+        el_far = max(abs(el_lo), abs(el_hi))
+        half_width = np.arcsin(min(np.sin(threshold * DEG2RAD) / np.cos(el_far * DEG2RAD), 1.0)) * RAD2DEG
+        az_first = int(np.floor((dir_az - half_width) / cell_deg))
+        az_last = int(np.floor((dir_az + half_width) / cell_deg))
+        az_bins = np.unique(np.arange(az_first, az_last + 1) % n_az)
+
+    cells = (el_bins[:, None] * n_az + az_bins[None, :]).ravel()
+    starts = index["cell_starts"][cells]
+    stops = index["cell_starts"][cells + 1]
+    cand = np.concatenate([index["order"][a:b] for a, b in zip(starts, stops)] + [np.zeros(0, dtype=int)])
+
+    dir_local = np.array([np.cos(dir_el * DEG2RAD) * np.sin(dir_az * DEG2RAD),
+                          np.cos(dir_el * DEG2RAD) * np.cos(dir_az * DEG2RAD),
+                          np.sin(dir_el * DEG2RAD)])
+
+    cos_err = index["los"][cand] @ dir_local
+
+    # only keep satellites within threshold of pointing direction
+    within = cos_err > np.cos(threshold * DEG2RAD)
+    cand = cand[within]
+    err = np.arccos(np.clip(cos_err[within], -1.0, 1.0)) * RAD2DEG
+
+    return cand, err
+
+
+def read_satellite_data(local_dir=None):
+    """
+    Read satellite data from data.json file stored in S3, return as dict
+
+    Parameters:
+    local_dir: path to use as a stand-in for bucket
+
+    Returns:
+    sat dict with name keys and tle tuple values
+    """
+    _, data = read_object_if_changed(obj_sats_key, None, local_dir)
+    return json.loads(bytes(maybe_gunzip(data)).decode("UTF-8"))
+
+
+def load_catalog(local_dir=None):
+    """
+    Return the propagation-ready catalog, see load_catalog_object(). With
+    MASTER_CATALOG "on" this is a view of every group of the master catalog
+    (see group_view()) instead of obj_sats_key
 
     Parameters:
-    lla: 3, np.array in deg/deg/m
-    
+    local_dir: path to use as a stand-in for bucket
+
     Returns:
-    3, np.array in meters
+    catalog dict from load_catalog_object(), with grid if EPHEM_GRID is "on", or the view
     """
-    sin_lat = np.sin(lla[0] * DEG2RAD)
-    cos_lat = np.cos(lla[0] * DEG2RAD)
-    sin_lon = np.sin(lla[1] * DEG2RAD)
-    cos_lon = np.cos(lla[1] * DEG2RAD)
+    load_snapshot(SNAPSHOT_PATH)
+    catalog = load_catalog_object(catalog_key(), local_dir, EPHEM_GRID == "on")
 
-    ratio_square = (RE_SEMIMINOR_M ** 2) / (RE_SEMIMAJOR_M ** 2)
-    ecc_square = 1 - ratio_square
+    if MASTER_CATALOG == "on":
+        return group_view(catalog, catalog["groups"])
 
-    N = RE_SEMIMAJOR_M / np.sqrt(1 - ecc_square * sin_lat * sin_lat)
+    return catalog
 
-    x = (N + lla[2]) * cos_lat * cos_lon
-    y = (N + lla[2]) * cos_lat * sin_lon
-    z = (ratio_square * N + lla[2]) * sin_lat
 
-    return np.array([x, y, z])
+def catalog_key():
+    """
+    Object key of the catalog read by this lambda
+    """
+    return master_catalog_group + ".json" if MASTER_CATALOG == "on" else obj_sats_key
 
 
-def lla_to_ecef_normal(lla):
+def write_snapshot(local_dir=None, path=SNAPSHOT_PATH):
     """
-    Normal/zenith direction in ECEF frame
+    Snapshot the timescale and the parsed catalog for cold starts, see
+    dump_snapshot(). Run before zipping the lambda, the snapshot goes next to
+    lambda_function.py
 
     Parameters:
-    lla: 3, np.array lat/lon/alt in deg/deg/m
+    local_dir: path to use as a stand-in for bucket
+    path: output file
+    """
+    dump_snapshot({catalog_key(): load_catalog_object(catalog_key(), local_dir)}, path)
+
+
+def load_catalog_and_ephemeris(local_dir=None):
+    """
+    Load catalog and ephemeris for a request, see load_with_ephemeris()
 
     Returns:
-    3, np.array unit normal vector of lla position
+    catalog dict from load_catalog()
+    ephemeris object from load_ephemeris()
     """
-    lat = lla[0] * DEG2RAD
-    lon = lla[1] * DEG2RAD
-    
-    return np.array([np.cos(lat) * np.cos(lon),
-                     np.cos(lat) * np.sin(lon),
-                     np.sin(lat)])
+    return load_with_ephemeris(lambda: load_catalog(local_dir), local_dir)
+
 
+if STARTUP == "eager":
+    warm_start(SNAPSHOT_PATH)
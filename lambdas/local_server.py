@@ -0,0 +1,296 @@
+"""
+Long running HTTP service hosting the get_visible, id_visible and
+get_opportunities handlers in one service, for running sat-finder off lambda
+
+    python local_server.py --local-dir /path/to/data --port 8080
+
+Routes (GET with query string parameters, /visible and /identify also take a
+POST JSON body, same parameters as the lambdas):
+    /visible        get_visible lambda_handler
+    /identify       id_visible lambda_handler
+    /opportunities  get_opportunities lambda_handler
+
+The three lambda modules share the satlib catalog, ephemeris and timescale
+caches and one cache of propagated positions, so state stays warm between
+requests and across routes. Handlers run on a pool of worker processes: the sgp4 extension
+holds the GIL while it propagates, so threads would let one pass search stall
+every other route. The catalogs and ephemeris are loaded before the workers are
+forked, so each worker starts warm (sharing the parsed catalogs copy-on-write)
+and then keeps its own caches up to date. Workers are single threaded, so
+PARALLEL "fork" can shard inside them.
+
+app() is an ASGI application, so the service can also run under an ASGI server
+(e.g. uvicorn local_server:app) after configure() has been called.
+"""
+import os
+import sys
+import json
+import asyncio
+import argparse
+import importlib.util
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from urllib.parse import urlsplit, parse_qsl
+
+LAMBDAS_DIR = os.path.dirname(os.path.abspath(__file__))
+if LAMBDAS_DIR not in sys.path:
+    sys.path.insert(0, LAMBDAS_DIR)
+
+from satlib import propagation
+from satlib.ephemeris import load_ephemeris, get_timescale
+
+# route: lambda directory
+ROUTES = {"/visible": "get_visible",
+          "/identify": "id_visible",
+          "/opportunities": "get_opportunities"}
+
+PROPAGATION_CACHE_SIZE = 64
+MAX_BODY_BYTES = 10 * 1024 * 1024
+
+HTTP_STATUS = {200: "OK", 400: "Bad Request", 404: "Not Found", 405: "Method Not Allowed",
+               413: "Payload Too Large", 500: "Internal Server Error"}
+
+# filled in by configure()
+server_state = {"local_dir": None, "handlers": {}, "pool": None}
+
+# propagated positions shared by every route of a worker, see cached_propagation()
+propagation_cache = {}
+
+
+def configure(local_dir=None, workers=None):
+    """
+    Load the lambda modules, load the catalogs and ephemeris and then fork the
+    worker processes
+
+    Parameters:
+    local_dir: path to use as a stand-in for bucket, None reads from S3
+    workers: worker processes for handlers, default one per CPU
+    """
+    # satlib.propagation looks propagate_ecef_sunlit up as a module global, so
+    # wrapping it there covers every route
+    if not hasattr(propagation.propagate_ecef_sunlit, "uncached"):
+        propagation.propagate_ecef_sunlit = cached_propagation(propagation.propagate_ecef_sunlit)
+
+    modules = {}
+    for route, name in ROUTES.items():
+        modules[route] = load_lambda(name)
+
+    server_state["local_dir"] = local_dir
+    server_state["handlers"] = {route: module.lambda_handler for route, module in modules.items()}
+
+    warm_caches(modules, local_dir)
+
+    # with the fork context the pool forks all of its workers on the first
+    # submit, before it starts its manager thread, so they are forked here from
+    # a single threaded process with warm caches
+    pool = ProcessPoolExecutor(max_workers=workers or os.cpu_count() or 1, mp_context=multiprocessing.get_context("fork"))
+    pool.submit(os.getpid).result()
+    server_state["pool"] = pool
+
+
+def warm_caches(modules, local_dir=None):
+    """
+    Load every catalog the routes read, the ephemeris and the timescale into
+    the satlib caches. Missing catalogs are skipped, they load on first request
+    """
+    for route, module in modules.items():
+        if hasattr(module, "sat_groups"):
+            loads = [(module.load_catalog, (group, local_dir)) for group in module.sat_groups]
+        else:
+            loads = [(module.load_catalog, (local_dir,))]
+
+        for load, args in loads + [(load_ephemeris, (local_dir,))]:
+            try:
+                load(*args)
+            except (FileNotFoundError, OSError, ValueError) as e:
+                print("Not preloaded for {}: {}: {}".format(route, type(e).__name__, e))
+
+        get_timescale()
+
+
+def run_handler(route, event):
+    """
+    Body of a worker process request, the handlers are inherited from configure()
+    """
+    return server_state["handlers"][route](event, None)
+
+
+def load_lambda(name):
+    """
+    Import lambdas/<name>/lambda_function.py under its own module name, every
+    lambda uses the same file name so they can not share the plain import
+    """
+    lambda_dir = os.path.join(LAMBDAS_DIR, name)
+
+    spec = importlib.util.spec_from_file_location(name + "_lambda_function", os.path.join(lambda_dir, "lambda_function.py"))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def cached_propagation(propagate_ecef_sunlit):
+    """
+    Wrap satlib's propagate_ecef_sunlit so positions for a propagator, time
+    and ephemeris are computed once for all routes. Entries hold on to the
+    propagator and ephemeris objects, so an identity check keeps a replaced
+    catalog (new version) from reusing a stale entry. The returned arrays are
+    shared and made read-only
+    """
+    def propagate(sats, time_utc, ephem, satrecs=None):
+        if satrecs is None:
+            return propagate_ecef_sunlit(sats, time_utc, ephem, satrecs)
+
+        key = (id(satrecs), time_utc, id(ephem))
+        entry = propagation_cache.pop(key, None)
+        if entry is not None and entry[0] is satrecs and entry[1] is ephem:
+            propagation_cache[key] = entry
+            return entry[2]
+
+        result = propagate_ecef_sunlit(sats, time_utc, ephem, satrecs)
+        for array in result:
+            array.flags.writeable = False
+
+        propagation_cache[key] = (satrecs, ephem, result)
+        # drop the least recently used entries once the cache is full
+        while len(propagation_cache) > PROPAGATION_CACHE_SIZE:
+            propagation_cache.pop(next(iter(propagation_cache)))
+
+        return result
+
+    propagate.uncached = propagate_ecef_sunlit
+    return propagate
+
+
+async def dispatch(method, path, query, body):
+    """
+    Run the handler for path in a worker process
+
+    Parameters:
+    method: HTTP method
+    path: URL path
+    query: dict of query string parameters
+    body: request body bytes, may be empty
+
+    Returns:
+    status code, dict of headers, body bytes
+    """
+    if path not in server_state["handlers"]:
+        return json_response(404, {"error": "Unknown route {}".format(path)})
+    if method not in ["GET", "POST"]:
+        return json_response(405, {"error": "Method {} not allowed".format(method)})
+
+    event = {"queryStringParameters": query}
+    if server_state["local_dir"] is not None:
+        event["localTestDir"] = server_state["local_dir"]
+    if body:
+        event["body"] = body.decode("UTF-8")
+
+    loop = asyncio.get_running_loop()
+    try:
+        result = await loop.run_in_executor(server_state["pool"], run_handler, path, event)
+    except (KeyError, ValueError, TypeError) as e:
+        return json_response(400, {"error": "{}: {}".format(type(e).__name__, e)})
+    except Exception as e:
+        return json_response(500, {"error": "{}: {}".format(type(e).__name__, e)})
+
+    status, headers, body = json_response(200, result)
+    # result cache answers from get_visible say whether they were a hit
+    if isinstance(result, dict) and "cached" in result:
+        headers["X-Cache"] = "HIT" if result["cached"] else "MISS"
+    return status, headers, body
+
+
+def json_response(status, value):
+    return status, {"Content-Type": "application/json"}, json.dumps(value).encode("UTF-8")
+
+
+async def app(scope, receive, send):
+    """
+    ASGI application wrapping dispatch()
+    """
+    if scope["type"] != "http":
+        return
+
+    body = b""
+    more_body = True
+    while more_body:
+        message = await receive()
+        body += message.get("body", b"")
+        more_body = message.get("more_body", False)
+
+    query = dict(parse_qsl(scope.get("query_string", b"").decode("UTF-8")))
+    status, headers, payload = await dispatch(scope["method"], scope["path"], query, body)
+
+    await send({"type": "http.response.start",
+                "status": status,
+                "headers": [(k.lower().encode("latin-1"), str(v).encode("latin-1")) for k, v in headers.items()]})
+    await send({"type": "http.response.body", "body": payload})
+
+
+async def handle_connection(reader, writer):
+    """
+    Minimal HTTP/1.1 server for one connection, keeps the connection open
+    between requests unless the client asks to close it
+    """
+    try:
+        while True:
+            request_line = await reader.readline()
+            if not request_line:
+                break
+
+            method, target, version = request_line.decode("latin-1").rstrip("\r\n").split(" ", 2)
+
+            headers = {}
+            while True:
+                line = await reader.readline()
+                if line in [b"\r\n", b"\n", b""]:
+                    break
+                name, _, value = line.decode("latin-1").partition(":")
+                headers[name.strip().lower()] = value.strip()
+
+            length = int(headers.get("content-length", 0))
+            if length > MAX_BODY_BYTES:
+                status, resp_headers, payload = json_response(413, {"error": "Request body too large"})
+                keep_alive = False
+            else:
+                body = await reader.readexactly(length) if length else b""
+                url = urlsplit(target)
+                status, resp_headers, payload = await dispatch(method, url.path, dict(parse_qsl(url.query)), body)
+                keep_alive = headers.get("connection", "").lower() != "close" and version == "HTTP/1.1"
+
+            lines = ["HTTP/1.1 {} {}".format(status, HTTP_STATUS.get(status, "")),
+                     "Content-Length: {}".format(len(payload)),
+                     "Connection: {}".format("keep-alive" if keep_alive else "close")]
+            lines += ["{}: {}".format(k, v) for k, v in resp_headers.items()]
+            writer.write(("\r\n".join(lines) + "\r\n\r\n").encode("latin-1") + payload)
+            await writer.drain()
+
+            if not keep_alive:
+                break
+    except (ValueError, asyncio.IncompleteReadError, ConnectionError):
+        pass
+    finally:
+        writer.close()
+
+
+async def serve(host, port):
+    server = await asyncio.start_server(handle_connection, host, port)
+    print("Serving {} on http://{}:{}".format(", ".join(ROUTES), host, port))
+    async with server:
+        await server.serve_forever()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve the sat-finder lambdas over HTTP from one process")
+    parser.add_argument("--local-dir", default=None, help="path to use as a stand-in for bucket, default reads S3")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--workers", type=int, default=None, help="handler processes, default one per CPU")
+    args = parser.parse_args()
+
+    configure(args.local_dir, args.workers)
+    asyncio.run(serve(args.host, args.port))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,200 @@
+import os
+import struct
+from datetime import datetime, timedelta
+
+import numpy as np
+
+from sgp4.api import jday
+
+from satlib.formats import GRID_MAGIC
+from satlib.storage import store_object
+from satlib.ephem_grid import interpolate_grid
+from satlib.propagation import propagate_teme
+from satlib.catalogs import load_catalog_object
+
+# catalogs (object key without .json) gridded when the event does not name any
+GRID_CATALOGS = os.environ.get("GRID_CATALOGS", "brightest,gps,stations,active,sats,catalog").split(",")
+GRID_HOURS = float(os.environ.get("GRID_HOURS", "24"))
+GRID_STEP_S = float(os.environ.get("GRID_STEP_S", "300"))
+
+
+def test_local(local_dir, catalogs="all", start_utc=None):
+    """
+    Runs lambda_handler using path as a stand-in for bucket
+    """
+    event = {"localTestDir": local_dir,
+             "queryStringParameters": {"catalogs": catalogs}
+            }
+    if start_utc is not None:
+        event["queryStringParameters"]["start_utc"] = start_utc
+
+    res = lambda_handler(event, None)
+    print(res)
+
+
+def test_grid_error(local_dir, catalog_name, start_utc, hours=24, steps_s=(60, 120, 300, 600, 900, 1800), n_check=500):
+    """
+    Interpolation error against direct SGP4 for a range of grid cadences, using
+    path as a stand-in for bucket. Check times are random within the window, so
+    they land anywhere between samples. Also prints the grid size per day for
+    1000 satellites to weigh against the error
+    """
+    catalog = load_catalog_object(catalog_name + ".json", local_dir)
+    satrecs = catalog["satrecs"]
+    n = len(catalog["satnum"])
+
+    start_dt = datetime.strptime(start_utc, "%Y-%m-%d %H:%M:%S")
+    jd0, fr0 = jday(start_dt.year, start_dt.month, start_dt.day, start_dt.hour, start_dt.minute, start_dt.second)
+
+    rng = np.random.default_rng(0)
+    offsets_s = np.sort(rng.uniform(0, hours * 3600, n_check))
+    err, pos_km, _ = propagate_teme(satrecs, np.full(n_check, jd0), fr0 + offsets_s / 86400.0)
+    pos_km[err != 0] = np.nan
+
+    print("Satellites: {}, check times: {}".format(n, n_check))
+    print("{:>8} {:>12} {:>12} {:>12} {:>14}".format("step_s", "median_m", "p99_m", "max_m", "MB/day/1k sats"))
+
+    for step_s in steps_s:
+        n_steps = int(np.ceil(hours * 3600 / step_s)) + 1
+        grid = {"jd0": jd0, "fr0": fr0, "step_s": float(step_s), "n_steps": n_steps,
+                "states": build_grid_states(satrecs, jd0, fr0, step_s, n_steps)}
+
+        pos_grid_km = np.stack([interpolate_grid(grid, jd0, fr0 + dt / 86400.0) for dt in offsets_s], axis=1)
+        pos_err_m = np.linalg.norm(pos_grid_km - pos_km, axis=2) * 1000.0
+        # satellites that fail at a check time or a neighbouring sample have no error to report
+        pos_err_m = pos_err_m[np.isfinite(pos_err_m)]
+
+        mb_day = 86400.0 / step_s * 1000 * 6 * 8 / 1e6
+        print("{:>8} {:>12.3f} {:>12.3f} {:>12.3f} {:>14.1f}".format(step_s, np.median(pos_err_m), np.percentile(pos_err_m, 99),
+                                                                  np.max(pos_err_m), mb_day))
+
+
+def lambda_handler(event, context):
+    """
+    For GET request, parameters are in event['queryStringParameters']
+
+    {"catalog": string} or {"catalogs": comma separated strings, or "all"},
+    optionally {"start_utc": YYYY-MM-DD HH:MM:SS, "hours": float, "step_s": float}
+
+    With no parameters (scheduled event, e.g. after refresh_data) every
+    catalog in GRID_CATALOGS is gridded for GRID_HOURS from the current time,
+    rounded down to GRID_STEP_S. Catalogs that do not exist are skipped
+
+    Returns:
+    dict of catalog name: status string
+    """
+    if "localTestDir" in event:
+        local_dir = event["localTestDir"]
+    else:
+        local_dir = None
+
+    params = event.get("queryStringParameters") or {}
+
+    if "catalog" in params:
+        catalogs = [params["catalog"]]
+    elif params.get("catalogs", "all") == "all":
+        catalogs = GRID_CATALOGS
+    else:
+        catalogs = params["catalogs"].split(",")
+
+    hours = float(params.get("hours", GRID_HOURS))
+    step_s = float(params.get("step_s", GRID_STEP_S))
+
+    if "start_utc" in params:
+        start_dt = datetime.strptime(params["start_utc"], "%Y-%m-%d %H:%M:%S")
+    else:
+        now = datetime.utcnow().replace(microsecond=0)
+        since_midnight = now.hour * 3600 + now.minute * 60 + now.second
+        start_dt = now - timedelta(seconds=since_midnight % int(step_s))
+
+    print("Gridding catalogs {} from {} for {} hours every {} s".format(catalogs, start_dt, hours, step_s))
+
+    res = {}
+    for catalog_name in catalogs:
+        try:
+            res[catalog_name] = precompute_grid(catalog_name, start_dt, hours, step_s, local_dir)
+        except FileNotFoundError:
+            res[catalog_name] = "no catalog"
+
+    print(res)
+
+    return res
+
+
+def precompute_grid(catalog_name, start_dt, hours, step_s, local_dir=None):
+    """
+    Propagate a catalog over the window and store it as <catalog_name>.grid
+
+    Parameters:
+    catalog_name: catalog object key without .json
+    start_dt: datetime of the first sample
+    hours: window length
+    step_s: seconds between samples
+    local_dir: path to use as a stand-in for bucket
+
+    Returns:
+    status string
+    """
+    # read the way the query lambdas do (binary if it exists, otherwise JSON)
+    # so the grid carries the catalog version they will see
+    catalog = load_catalog_object(catalog_name + ".json", local_dir)
+
+    jd0, fr0 = jday(start_dt.year, start_dt.month, start_dt.day, start_dt.hour, start_dt.minute, start_dt.second)
+    n_steps = int(np.ceil(hours * 3600 / step_s)) + 1
+
+    states = build_grid_states(catalog["satrecs"], jd0, fr0, step_s, n_steps)
+    body = grid_to_binary(catalog["version"], catalog["satnum"], jd0, fr0, step_s, states)
+
+    store_object(catalog_name + ".grid", body, local_dir)
+
+    return "Object {}.grid updated ({} sats, {} steps, {:.1f} MB)".format(catalog_name, states.shape[1], n_steps, len(body) / 1e6)
+
+
+def build_grid_states(satrecs, jd0, fr0, step_s, n_steps):
+    """
+    TEME position and velocity of every satellite at every grid time, nan
+    where SGP4 fails (e.g. decayed)
+
+    Parameters:
+    satrecs: propagator for N satellites, see propagate_teme()
+    jd0/fr0: UTC julian date whole and fraction of the first sample
+    step_s: seconds between samples
+    n_steps: number of samples T
+
+    Returns:
+    T,N,6 np.array of position in km and velocity in km/s
+    """
+    err, pos_km, vel_km_s = propagate_teme(satrecs, np.full(n_steps, jd0), fr0 + np.arange(n_steps) * step_s / 86400.0)
+
+    states = np.concatenate([pos_km, vel_km_s], axis=2)
+    states[err != 0] = np.nan
+
+    return np.ascontiguousarray(np.swapaxes(states, 0, 1))
+
+
+def grid_to_binary(version, satnum, jd0, fr0, step_s, states):
+    """
+    Serialize an ephemeris grid so readers can memory map the states
+
+    Layout, all little endian:
+    header: GRID_MAGIC, uint32 N, uint32 T, float64 jd0, float64 fr0, float64 step_s,
+        uint32 length of catalog version
+    catalog version: utf-8 version (ETag or local file stamp) of the catalog gridded
+    zero padding to a multiple of 8 bytes
+    satnum: N uint32, zero padded to a multiple of 8 bytes
+    states: T,N,6 float64, TEME position km and velocity km/s, time major so a
+        query only touches the two samples around it
+
+    Returns:
+    bytes
+    """
+    version = version.encode("UTF-8")
+    n_steps, n = states.shape[:2]
+
+    header = GRID_MAGIC + struct.pack("<IIdddI", n, n_steps, jd0, fr0, step_s, len(version)) + version
+    header += b"\0" * (-len(header) % 8)
+
+    satnum = np.asarray(satnum, dtype="<u4").tobytes()
+    satnum += b"\0" * (-len(satnum) % 8)
+
+    return header + satnum + np.asarray(states, dtype="<f8").tobytes()
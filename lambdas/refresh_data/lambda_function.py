@@ -1,49 +1,247 @@
+import os
 import json
+import math
+import gzip
+import hashlib
+import struct
 import urllib.request
-import boto3
+import urllib.error
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date
 
-s3 = boto3.client("s3")
-obj_bucket = "sat-finder-private"
-brightest_obj_key = "brightest.json"
-gps_obj_key = "gps.json"
+from satlib.formats import CATALOG_MAGIC, GROUPS_MAGIC, CATALOG_COLUMNS
+from satlib.storage import read_object, read_stored_metadata, store_object, maybe_gunzip
+
+XPDOTP = 1440.0 / (2.0 * math.pi)
+DEG2RAD = 0.017453292519943296
+
+# group name: celestrak GROUP, stored as <group name>.json and <group name>.bin
+celestrak_url = os.environ.get("CELESTRAK_URL", "https://celestrak.org/NORAD/elements/gp.php")
+celestrak_groups = {"brightest": "VISUAL",
+                    "gps": "gps-ops",
+                    "stations": "stations",
+                    "active": "active"}
+
+# every group merged into one catalog keyed on NORAD number, with a membership
+# bit per group (bit i is the i-th group of celestrak_groups), stored as
+# <master_catalog>.bin, see refresh_master()
+master_catalog = "catalog"
+
+# groups refreshed when the event does not name any (e.g. scheduled refresh)
+REFRESH_GROUPS = os.environ.get("REFRESH_GROUPS", "brightest,gps,stations,active").split(",")
+REFRESH_WORKERS = 8
+
+
+def test_local(local_dir, groups="all"):
+    """
+    Runs lambda_handler using path as a stand-in for bucket. Set CELESTRAK_URL
+    to point at a local HTTP server to run without celestrak
+    """
+    event = {"localTestDir": local_dir,
+             "queryStringParameters": {"groups": groups}
+            }
+
+    res = lambda_handler(event, None)
+    print(res)
 
-brightest_url = "https://celestrak.org/NORAD/elements/gp.php?GROUP=VISUAL&FORMAT=TLE"
-gps_url = "http://celestrak.org/NORAD/elements/gp.php?GROUP=gps-ops&FORMAT=tle"
 
 def lambda_handler(event, context):
-    group = event["queryStringParameters"]["group"]
+    """
+    For GET request, parameters are in event['queryStringParameters']
+
+    {"group": string} or {"groups": comma separated strings, or "all"}
+
+    With no parameters (scheduled event) all REFRESH_GROUPS are refreshed.
+    Groups are fetched concurrently, and only rewritten when celestrak returns
+    new data. The master catalog is rebuilt when any group changed (or it does
+    not exist yet)
+
+    Returns:
+    dict of group name (and master_catalog): status string
+    """
+    if "localTestDir" in event:
+        local_dir = event["localTestDir"]
+    else:
+        local_dir = None
+
+    params = event.get("queryStringParameters") or {}
+
+    if "group" in params:
+        groups = [params["group"]]
+    elif params.get("groups", "all") == "all":
+        groups = REFRESH_GROUPS
+    else:
+        groups = params["groups"].split(",")
+
+    print("Updating sats groups: {}".format(groups))
+
+    with ThreadPoolExecutor(max_workers=min(len(groups), REFRESH_WORKERS)) as pool:
+        statuses = list(pool.map(lambda group: refresh_group(group, local_dir), groups))
+
+    res = dict(zip(groups, statuses))
+
+    if any(status.startswith("Objects") for status in statuses) or not read_stored_metadata(master_catalog + ".bin", local_dir):
+        res[master_catalog] = refresh_master(local_dir)
+
+    print(res)
+
+    return res
+
+
+def refresh_group(group, local_dir=None):
+    """
+    Fetch one group from celestrak and store it as gzipped JSON and an
+    uncompressed binary catalog, skipping the write when nothing changed
 
-    print("Updating {} sats group".format(group))
+    Celestrak is asked with If-None-Match/If-Modified-Since from the metadata of
+    the stored object, and the sha256 of the JSON is compared with the stored
+    one in case celestrak sends the same data anyway.
 
-    if group == "brightest":
-        obj_key = brightest_obj_key
-        group_url = brightest_url
-    elif group == "gps":
-        obj_key = gps_obj_key
-        group_url = gps_url
+    Parameters:
+    group: group name, key of celestrak_groups
+    local_dir: path to use as a stand-in for bucket
+
+    Returns:
+    status string
+    """
+    obj_key = group + ".json"
+    bin_key = group + ".bin"
+    group_url = "{}?GROUP={}&FORMAT=tle".format(celestrak_url, celestrak_groups[group])
 
-    sats_dict = fetch_satellite_data(group_url)
+    stored_meta = read_stored_metadata(obj_key, local_dir)
+
+    tle_text, source_meta = fetch_tle_text(group_url, stored_meta)
+    if tle_text is None:
+        return "not modified at source"
+
+    sats_dict = parse_tle_text(tle_text)
     sats_bytes = bytes(json.dumps(sats_dict, indent=2).encode("UTF-8"))
 
-    response = s3.put_object(Body=sats_bytes, Bucket=obj_bucket, Key=obj_key)
+    content_hash = hashlib.sha256(sats_bytes).hexdigest()
+    if content_hash == stored_meta.get("content-sha256"):
+        return "unchanged"
+
+    meta = dict(source_meta, **{"content-sha256": content_hash})
+
+    # array-backed copy for the visibility lambdas, left uncompressed so they
+    # can use the columns in place
+    store_object(obj_key, gzip.compress(sats_bytes), local_dir, meta, gzipped=True)
+    store_object(bin_key, catalog_to_binary(sats_dict), local_dir, meta)
+
+    return "Objects {}, {} updated ({} sats)".format(obj_key, bin_key, len(sats_dict))
+
+
+def refresh_master(local_dir=None):
+    """
+    Merge the stored group catalogs into the master catalog: one entry per
+    NORAD number (the newest TLE of any group, named as in the first group that
+    has it) with a bit per group it belongs to. Skips the write when nothing
+    changed
+
+    Parameters:
+    local_dir: path to use as a stand-in for bucket
+
+    Returns:
+    status string
+    """
+    bin_key = master_catalog + ".bin"
+    merged = {}
+
+    for bit, group in enumerate(celestrak_groups):
+        try:
+            data = maybe_gunzip(read_object(group + ".json", local_dir))
+        except FileNotFoundError:
+            continue
+
+        for name, tle in json.loads(data.decode("UTF-8")).items():
+            satnum = alpha5_to_int(tle[0][2:7])
+            entry = merged.get(satnum)
+
+            if entry is None:
+                merged[satnum] = [name, tle, 1 << bit]
+                continue
 
-    return "Object {} updated".format(obj_key)
+            entry[2] |= 1 << bit
+            if tle_to_elements(*tle)["epoch"] > tle_to_elements(*entry[1])["epoch"]:
+                entry[1] = tle
+
+    # names key the catalog dict, different objects can share one
+    sats_dict = {}
+    membership = []
+    for satnum, (name, tle, bits) in merged.items():
+        if name in sats_dict:
+            name = "{} ({})".format(name, satnum)
+        sats_dict[name] = tle
+        membership.append(bits)
+
+    body = catalog_to_binary(sats_dict, list(celestrak_groups), membership)
+
+    content_hash = hashlib.sha256(body).hexdigest()
+    if content_hash == read_stored_metadata(bin_key, local_dir).get("content-sha256"):
+        return "unchanged"
+
+    store_object(bin_key, body, local_dir, {"content-sha256": content_hash})
+
+    return "Object {} updated ({} sats)".format(bin_key, len(sats_dict))
+
+
+def fetch_tle_text(url, stored_meta):
+    """
+    Conditional GET of TLE text from celestrak
+
+    Parameters:
+    url: celestrak url
+    stored_meta: metadata of stored object, with source-etag and
+        source-last-modified from the last fetch if present
+
+    Returns:
+    TLE text, None if celestrak says it has not changed
+    dict of source-etag and source-last-modified of this response
+    """
+    headers = {}
+    if stored_meta.get("source-etag"):
+        headers["If-None-Match"] = stored_meta["source-etag"]
+    if stored_meta.get("source-last-modified"):
+        headers["If-Modified-Since"] = stored_meta["source-last-modified"]
+
+    try:
+        req = urllib.request.urlopen(urllib.request.Request(url, headers=headers))
+    except urllib.error.HTTPError as e:
+        if e.code == 304:
+            return None, {}
+        raise
+
+    source_meta = {"source-etag": req.headers.get("ETag", ""),
+                   "source-last-modified": req.headers.get("Last-Modified", "")}
+
+    return req.read().decode(), source_meta
 
 
 def fetch_satellite_data(url):
     """
     Grab satellite data in TLE format from celestrak.
 
-    By default grab brightest group.
+    Parameters:
+    url: celestrak url
+
+    Returns:
+    dict with object name as key: tuple of TLE strings as value
+    """
+    tle_text, _ = fetch_tle_text(url, {})
+    return parse_tle_text(tle_text)
+
+
+def parse_tle_text(tle_text):
+    """
+    Split three line TLE text into a dict
 
     Parameters:
-    None
+    tle_text: string of name/line1/line2 triples
 
     Returns:
     dict with object name as key: tuple of TLE strings as value
     """
-    req = urllib.request.urlopen(url)
-    tle_text = [t.strip() for t in req.read().decode().split("\n")]
+    tle_text = [t.strip() for t in tle_text.split("\n")]
 
     # sometimes list line of request is empty
     if tle_text[-1] == "":
@@ -62,3 +260,110 @@ def fetch_satellite_data(url):
 
     return sats
 
+
+def catalog_to_binary(sats, groups=None, membership=None):
+    """
+    Pack satellite data into the flat binary catalog read by the visibility
+    lambdas with np.frombuffer, so they never parse TLE text
+
+    Layout, all little endian:
+    header: CATALOG_MAGIC, uint32 N, uint32 length of names blob
+    satnum: N uint32
+    name offsets: N+1 uint32 byte offsets into names blob
+    zero padding to a multiple of 8 bytes
+    columns: one N float64 column per CATALOG_COLUMNS entry, in sgp4init units
+        (epoch in days since 1949 Dec 31 00:00 UT, angles in rad, no_kozai in rad/min)
+    names: utf-8 names blob
+
+    Master catalog only, readers that do not know it stop at the names blob:
+    GROUPS_MAGIC, uint32 length of group names, utf-8 comma separated group names
+    zero padding to a multiple of 4 bytes
+    membership: N uint32, bit i set if the satellite is in the i-th group
+
+    Parameters:
+    sats: dict with object name as key: tuple of TLE strings as value
+    groups: list of group names, master catalog only
+    membership: N, list of group bits, master catalog only
+
+    Returns:
+    bytes of binary catalog
+    """
+    names = [name.encode("UTF-8") for name in sats.keys()]
+    elements = [tle_to_elements(tle[0], tle[1]) for tle in sats.values()]
+
+    name_offsets = [0]
+    for name in names:
+        name_offsets.append(name_offsets[-1] + len(name))
+
+    n = len(names)
+    parts = [CATALOG_MAGIC,
+             struct.pack("<II", n, name_offsets[-1]),
+             struct.pack("<{}I".format(n), *[el["satnum"] for el in elements]),
+             struct.pack("<{}I".format(n + 1), *name_offsets)]
+
+    header_len = sum(len(part) for part in parts)
+    parts.append(bytes(-header_len % 8))
+
+    for column in CATALOG_COLUMNS:
+        parts.append(struct.pack("<{}d".format(n), *[el[column] for el in elements]))
+
+    parts.append(b"".join(names))
+
+    if groups is not None:
+        group_names = ",".join(groups).encode("UTF-8")
+        parts += [GROUPS_MAGIC, struct.pack("<I", len(group_names)), group_names]
+        parts.append(bytes(-sum(len(part) for part in parts) % 4))
+        parts.append(struct.pack("<{}I".format(n), *membership))
+
+    return b"".join(parts)
+
+
+def tle_to_elements(line1, line2):
+    """
+    Parse a TLE into the mean elements taken by sgp4init, same conversions
+    as sgp4's twoline2rv
+
+    Parameters:
+    line1, line2: TLE strings
+
+    Returns:
+    dict with "satnum" and each of CATALOG_COLUMNS
+    """
+    year = int(line1[18:20])
+    year += 2000 if year < 57 else 1900
+    day_of_year = float(line1[20:32])
+
+    return {"satnum": alpha5_to_int(line1[2:7]),
+            "epoch": (date(year, 1, 1) - date(1949, 12, 31)).days + day_of_year - 1.0,
+            "bstar": tle_exponent_field(line1[53:61]),
+            "ndot": float(line1[33:43]) / (XPDOTP * 1440.0),
+            "nddot": tle_exponent_field(line1[44:52]) / (XPDOTP * 1440.0 * 1440.0),
+            "ecco": float("0." + line2[26:33].strip()),
+            "argpo": float(line2[34:42]) * DEG2RAD,
+            "inclo": float(line2[8:16]) * DEG2RAD,
+            "mo": float(line2[43:51]) * DEG2RAD,
+            "no_kozai": float(line2[52:63]) / XPDOTP,
+            "nodeo": float(line2[17:25]) * DEG2RAD}
+
+
+def tle_exponent_field(field):
+    """
+    Value of TLE assumed-decimal exponent fields like " 12345-4" (0.12345e-4)
+    """
+    field = field.strip()
+    if field[0] in "+-":
+        sign, field = field[0], field[1:]
+    else:
+        sign = ""
+    return float(sign + "." + field[:-2]) * 10 ** int(field[-2:])
+
+
+def alpha5_to_int(field):
+    """
+    Catalog number from TLE field, including Alpha-5 numbers like "A0001" (100001)
+    """
+    field = field.strip()
+    if field[0].isalpha():
+        letters = "ABCDEFGHJKLMNPQRSTUVWXYZ"
+        return (letters.index(field[0]) + 10) * 10000 + int(field[1:])
+    return int(field)
@@ -0,0 +1,7 @@
+"""
+Code shared by the sat-finder lambdas: object storage, catalog parsing and
+caching, propagation, sun and frame math, sharding and request metrics.
+deploy.sh zips the package next to each lambda_function.py. For local runs
+lambdas/ has to be on the path (PYTHONPATH=lambdas), local_server.py and
+benchmark.py add it themselves
+"""
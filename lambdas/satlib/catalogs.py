@@ -0,0 +1,415 @@
+"""
+Satellite catalogs: reading the JSON or binary catalog objects, the parsed
+catalog cache kept between warm invocations and cold start snapshots
+"""
+import os
+import json
+import pickle
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from sgp4.api import Satrec, WGS72
+
+from satlib import sgp4_numpy
+from satlib.ephem_grid import load_grid
+from satlib.ephemeris import SUN_MODEL, ephem_cache, timescale_cache, load_ephemeris, ephemeris_path, get_timescale
+from satlib.formats import CATALOG_MAGIC, GROUPS_MAGIC, CATALOG_COLUMNS
+from satlib.metrics import timed, cache_metric
+from satlib.propagation import PROPAGATOR, build_propagator, propagator_subset
+from satlib.storage import get_s3, read_object_if_changed, maybe_gunzip
+
+# parsed catalogs kept between warm invocations, keyed on object key
+catalog_cache = {}
+catalog_cache_stats = {"hits": 0, "misses": 0}
+
+# parsed catalogs and timescale pickled ahead of time (see dump_snapshot()) and
+# shipped in the deployment package so a cold start skips parsing them
+SNAPSHOT_FORMAT = 2
+# snapshot paths already loaded, see load_snapshot()
+loaded_snapshots = set()
+
+# every group merged by refresh_data into one catalog keyed on NORAD number
+# with a membership bit per group, stored as <master_catalog_group>.bin. With
+# MASTER_CATALOG "on" the lambdas answer from views of it (see group_view()),
+# all views sharing one propagation per time. "off" reads each lambda's own
+# catalog objects
+master_catalog_group = "catalog"
+MASTER_CATALOG = os.environ.get("MASTER_CATALOG", "off")
+
+# "lazy" loads clients, catalogs and the timescale on first use, "eager" loads
+# them at import (i.e. during the lambda init phase, before the first request),
+# see warm_start()
+STARTUP = os.environ.get("STARTUP", "lazy")
+
+
+def load_catalog_object(obj_sats_key, local_dir=None, grid=False):
+    """
+    Return the propagation-ready catalog, reusing the parsed copy from a previous
+    warm invocation unless the stored object has changed (e.g. by refresh_data)
+
+    The binary catalog (.bin next to the .json) is used when it exists, since it
+    needs no TLE text parsing, otherwise the JSON TLEs are parsed. The format
+    found is kept with the cached catalog, so warm requests only read that
+    object (a .bin added later is picked up by the next cold start).
+
+    Parameters:
+    obj_sats_key: object key of the catalog JSON (e.g. sats.json), the binary
+        catalog is the same name with .bin
+    local_dir: path to use as a stand-in for bucket
+    grid: also load the catalog's ephemeris grid (EPHEM_GRID "on")
+
+    Returns:
+    dict with
+        version: ETag (or local file stamp) of the stored data
+        names: N, list of satellite names
+        satnum: N, np.array of NORAD catalog numbers
+        sats: sat dict with name keys and tle tuple values, None from binary catalog
+        satrec_list: N, list of sgp4 Satrec, None from binary catalog with PROPAGATOR "numpy"
+        satrecs: propagator for the whole catalog, see build_propagator()
+        grid: ephemeris grid from load_grid() (None without one), only if grid is True
+        groups, membership: group names and bits, only for the master catalog
+    """
+    cached = catalog_cache.get(obj_sats_key)
+    version = None if cached is None else cached["version"]
+
+    with timed("catalog_read"):
+        catalog_format, version, data = read_catalog_data(obj_sats_key, cached, local_dir)
+
+    cache_metric("catalog", data is None)
+
+    if data is None:
+        catalog_cache_stats["hits"] += 1
+        catalog = cached
+    else:
+        catalog_cache_stats["misses"] += 1
+
+        with timed("catalog_parse"):
+            catalog = catalog_formats[catalog_format](maybe_gunzip(data))
+            catalog["format"] = catalog_format
+            catalog["version"] = version
+            catalog["satrecs"] = build_propagator(catalog)
+
+        catalog_cache[obj_sats_key] = catalog
+
+    if grid:
+        with timed("grid_read"):
+            catalog["grid"] = load_grid(obj_sats_key, catalog, local_dir)
+
+    return catalog
+
+
+def read_catalog_data(obj_sats_key, cached, local_dir=None):
+    """
+    Conditional read of a catalog object in the format of the cached catalog,
+    or without one the binary catalog if there is one and otherwise the JSON
+
+    Parameters:
+    obj_sats_key: object key of the catalog JSON
+    cached: catalog from catalog_cache, None if not loaded yet
+    local_dir: path to use as a stand-in for bucket
+
+    Returns:
+    format ("bin" or "json", see catalog_formats)
+    version string of the stored data
+    bytes-like object contents, None if unchanged since the cached catalog
+    """
+    if cached is not None:
+        try:
+            version, data = read_object_if_changed(catalog_object_key(obj_sats_key, cached["format"]),
+                                                   cached["version"], local_dir)
+            return cached["format"], version, data
+        except FileNotFoundError:
+            # e.g. the .bin was removed, look for the catalog again
+            pass
+
+    # a missing .bin reads as AccessDenied from S3 without s3:ListBucket
+    try:
+        version, data = read_object_if_changed(catalog_object_key(obj_sats_key, "bin"), None, local_dir)
+        return "bin", version, data
+    except (FileNotFoundError, PermissionError):
+        version, data = read_object_if_changed(obj_sats_key, None, local_dir)
+        return "json", version, data
+
+
+def catalog_object_key(obj_sats_key, catalog_format):
+    return obj_sats_key[:-len(".json")] + "." + catalog_format
+
+
+def group_view(master, groups):
+    """
+    The satellites of the master catalog that are in any of groups, as a
+    catalog dict that can be used in place of the group's own catalog. The
+    view keeps the master and the indices into it, so
+    propagate_catalog_ecef_sunlit() propagates the whole master once per time
+    and slices. Views are kept on the master, so they go away with it when a
+    new version is loaded
+
+    Parameters:
+    master: master catalog dict from load_catalog_object(), with groups and membership
+    groups: list of group names
+
+    Returns:
+    catalog dict with version, names, satnum, sats (None), satrec_list,
+    satrecs, master and master_idx
+    """
+    key = ",".join(sorted(set(groups)))
+    views = master.setdefault("views", {})
+
+    if key not in views:
+        bits = 0
+        for group in groups:
+            if group not in master["groups"]:
+                raise ValueError("Unknown satellite group {}".format(group))
+            bits |= 1 << master["groups"].index(group)
+
+        idx = np.flatnonzero(master["membership"] & bits)
+
+        views[key] = {"version": master["version"],
+                      "names": [master["names"][i] for i in idx],
+                      "satnum": master["satnum"][idx],
+                      "sats": None,
+                      "satrec_list": None if master["satrec_list"] is None else [master["satrec_list"][i] for i in idx],
+                      "satrecs": propagator_subset(master, idx),
+                      "master": master,
+                      "master_idx": idx}
+
+    return views[key]
+
+
+
+def load_with_ephemeris(load_catalog, local_dir=None):
+    """
+    Load the catalog and the ephemeris for a request. On a cold start the
+    ephemeris download runs in a thread while the catalog is fetched and parsed
+
+    Parameters:
+    load_catalog: function taking no arguments that returns the request's catalog
+    local_dir: path to use as a stand-in for bucket
+
+    Returns:
+    catalog dict returned by load_catalog
+    ephemeris object from load_ephemeris()
+    """
+    if SUN_MODEL == "analytic" or ephemeris_path(local_dir) in ephem_cache:
+        return load_catalog(), load_ephemeris(local_dir)
+
+    with ThreadPoolExecutor(max_workers=1) as pool:
+        ephem_future = pool.submit(load_ephemeris, local_dir)
+        catalog = load_catalog()
+        # the load runs in the pool thread, the request only waits for what is left
+        cache_metric("ephemeris", False)
+        with timed("ephemeris"):
+            ephem = ephem_future.result()
+        return catalog, ephem
+
+
+def parse_json_catalog(data):
+    """
+    Parse JSON satellite data (name -> TLE lines) into catalog fields
+
+    Parameters:
+    data: bytes-like JSON contents
+
+    Returns:
+    dict with names, satnum, sats and satrec_list, see load_catalog_object()
+    """
+    sats = json.loads(bytes(data).decode("UTF-8"))
+    satrec_list = [Satrec.twoline2rv(tle[0], tle[1]) for tle in sats.values()]
+
+    return {"names": list(sats.keys()),
+            "satnum": np.array([sat.satnum for sat in satrec_list], dtype=np.int64),
+            "sats": sats,
+            "satrec_list": satrec_list}
+
+
+def parse_binary_catalog(data):
+    """
+    Parse the binary catalog written by refresh_data's catalog_to_binary(). The
+    element columns are views straight into data (no copies) and satellites are
+    initialized from mean elements without any TLE text parsing
+
+    Layout, all little endian:
+    header: CATALOG_MAGIC, uint32 N, uint32 length of names blob
+    satnum: N uint32
+    name offsets: N+1 uint32 byte offsets into names blob
+    zero padding to a multiple of 8 bytes
+    columns: one N float64 column per CATALOG_COLUMNS entry, in sgp4init units
+    names: utf-8 names blob
+
+    The master catalog continues with the groups (see refresh_data's
+    catalog_to_binary()):
+    GROUPS_MAGIC, uint32 length of group names, utf-8 comma separated group names
+    zero padding to a multiple of 4 bytes
+    membership: N uint32, bit i set if the satellite is in the i-th group
+
+    Parameters:
+    data: bytes-like binary catalog contents
+
+    Returns:
+    dict with names, satnum, sats (None), satrec_list and elements (dict of
+        CATALOG_COLUMNS arrays), see load_catalog_object(). The master catalog also has
+        groups (list of names) and membership (N, np.array of group bits)
+    """
+    if bytes(data[:8]) != CATALOG_MAGIC:
+        raise ValueError("Not a binary satellite catalog")
+
+    n, names_len = np.frombuffer(data, dtype="<u4", count=2, offset=8)
+    n = int(n)
+    offset = 16
+
+    satnum = np.frombuffer(data, dtype="<u4", count=n, offset=offset)
+    offset += 4 * n
+    name_offsets = np.frombuffer(data, dtype="<u4", count=n + 1, offset=offset)
+    offset += 4 * (n + 1)
+    offset += -offset % 8
+
+    columns = np.frombuffer(data, dtype="<f8", count=n * len(CATALOG_COLUMNS), offset=offset)
+    columns = columns.reshape(len(CATALOG_COLUMNS), n)
+    offset += 8 * n * len(CATALOG_COLUMNS)
+
+    names_blob = bytes(data[offset:offset + int(names_len)])
+    names = [names_blob[a:b].decode("UTF-8") for a, b in zip(name_offsets[:-1], name_offsets[1:])]
+    offset += int(names_len)
+
+    elements = dict(zip(CATALOG_COLUMNS, columns))
+
+    # the numpy propagator initializes straight from the columns instead
+    satrec_list = None if PROPAGATOR == "numpy" else satrecs_from_elements(satnum, elements)
+
+    catalog = {"names": names,
+               "satnum": satnum.astype(np.int64),
+               "sats": None,
+               "satrec_list": satrec_list,
+               "elements": elements}
+
+    if bytes(data[offset:offset + 8]) == GROUPS_MAGIC:
+        groups_len = int(np.frombuffer(data, dtype="<u4", count=1, offset=offset + 8)[0])
+        offset += 12
+        catalog["groups"] = bytes(data[offset:offset + groups_len]).decode("UTF-8").split(",")
+        offset += groups_len
+        offset += -offset % 4
+        catalog["membership"] = np.frombuffer(data, dtype="<u4", count=n, offset=offset).astype(np.int64)
+
+    return catalog
+
+
+# catalog object format (key suffix): parser
+catalog_formats = {"bin": parse_binary_catalog, "json": parse_json_catalog}
+
+
+def satrecs_from_elements(satnum, elements):
+    """
+    Initialize sgp4 Satrec objects from mean elements without any TLE text parsing
+
+    Parameters:
+    satnum: N, NORAD catalog numbers
+    elements: dict with an N array per CATALOG_COLUMNS entry, in sgp4init units
+
+    Returns:
+    N, list of sgp4 Satrec
+    """
+    # sgp4init takes the columns in CATALOG_COLUMNS order. sgp4 has no bulk
+    # initializer (SatrecArray only takes Satrec objects), so this loop, about
+    # 4 us per satellite in sgp4init itself, is most of the binary catalog load
+    # with PROPAGATOR "sgp4". PROPAGATOR "numpy" initializes from the columns
+    satrec_list = []
+    for row in zip(np.asarray(satnum).tolist(), *[np.asarray(elements[col]).tolist() for col in CATALOG_COLUMNS]):
+        sat = Satrec()
+        sat.sgp4init(WGS72, "i", *row)
+        satrec_list.append(sat)
+    return satrec_list
+
+
+def snapshot_catalog(catalog):
+    """
+    Picklable part of a catalog from load_catalog_object(): format, version,
+    names, satnum and the mean elements, plus groups and membership of the
+    master catalog
+    """
+    elements = catalog.get("elements")
+    if elements is None:
+        elements = sgp4_numpy.elements_from_satrecs(catalog["satrec_list"])
+
+    stored = {"format": catalog["format"],
+              "version": catalog["version"],
+              "names": list(catalog["names"]),
+              "satnum": np.array(catalog["satnum"]),
+              "elements": {col: np.array(values) for col, values in elements.items()}}
+
+    if "membership" in catalog:
+        stored["groups"] = list(catalog["groups"])
+        stored["membership"] = np.array(catalog["membership"])
+
+    return stored
+
+
+def snapshot_path(lambda_file):
+    """
+    Snapshot file of a lambda: SNAPSHOT_PATH if set, otherwise snapshot.pkl
+    next to its lambda_function.py (lambda_file), so it ships in the zip
+    """
+    return os.environ.get("SNAPSHOT_PATH", os.path.join(os.path.dirname(os.path.abspath(lambda_file)), "snapshot.pkl"))
+
+
+def dump_snapshot(catalogs, path):
+    """
+    Pickle the timescale and parsed catalogs so a cold start can load them with
+    load_snapshot() instead of building them, see write_snapshot() in the lambdas
+
+    Only the mean elements are stored (sgp4 Satrec objects do not pickle), the
+    propagator is rebuilt from them on load. Catalogs keep their version, so the
+    first request only revalidates with S3 instead of downloading
+
+    Parameters:
+    catalogs: dict of object key: catalog dict from load_catalog_object()
+    path: output file
+    """
+    with open(path, "wb") as f:
+        pickle.dump({"format": SNAPSHOT_FORMAT,
+                     "timescale": get_timescale(),
+                     "catalogs": {obj_key: snapshot_catalog(catalog) for obj_key, catalog in catalogs.items()}},
+                    f, protocol=pickle.HIGHEST_PROTOCOL)
+
+
+def load_snapshot(path):
+    """
+    Prime timescale_cache and catalog_cache from a snapshot written by
+    dump_snapshot(), at most once per path and container. Does nothing if there
+    is no snapshot file or it was written in another format
+    """
+    if path in loaded_snapshots:
+        return
+    loaded_snapshots.add(path)
+
+    if not os.path.exists(path):
+        return
+
+    with open(path, "rb") as f:
+        snapshot = pickle.load(f)
+
+    if snapshot.get("format") != SNAPSHOT_FORMAT:
+        return
+
+    timescale_cache.setdefault("builtin", snapshot["timescale"])
+
+    for obj_key, stored in snapshot["catalogs"].items():
+        if obj_key in catalog_cache:
+            continue
+        catalog = dict(stored, sats=None)
+        catalog["satrec_list"] = None if PROPAGATOR == "numpy" else satrecs_from_elements(catalog["satnum"], catalog["elements"])
+        catalog["satrecs"] = build_propagator(catalog)
+        catalog_cache[obj_key] = catalog
+
+
+def warm_start(snapshot_path):
+    """
+    Load everything a request needs that does not depend on the request: the
+    snapshot (or timescale), the S3 client and, inside lambda, the ephemeris.
+    Runs at import with STARTUP "eager"
+    """
+    load_snapshot(snapshot_path)
+    get_timescale()
+    get_s3()
+    if "AWS_LAMBDA_FUNCTION_NAME" in os.environ:
+        load_ephemeris()
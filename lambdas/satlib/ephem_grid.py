@@ -0,0 +1,210 @@
+"""
+Ephemeris grids written by precompute_grid: TEME states of a catalog at a
+fixed step, interpolated instead of propagating (EPHEM_GRID "on")
+"""
+import os
+import struct
+
+import numpy as np
+
+from satlib.formats import GRID_MAGIC
+from satlib.storage import read_object_if_changed, read_object_range
+
+# "on" answers whole-catalog queries by interpolating the ephemeris grid that
+# precompute_grid stores next to the catalog (<catalog>.grid), falling back to
+# propagating when there is no grid for the catalog version or the time is
+# outside it, "off" always propagates
+EPHEM_GRID = os.environ.get("EPHEM_GRID", "off")
+
+# bytes of the first ranged GET of a grid from S3: the header and, for catalogs
+# up to about 16k satellites, the satnum table
+GRID_HEAD_BYTES = 65536
+# pairs of samples fetched from S3 kept per grid, see grid_samples()
+GRID_SAMPLE_CACHE_SIZE = 4
+
+# object key: {"version", "grid"} where grid is None if it does not match its catalog
+grid_cache = {}
+
+
+def load_grid(obj_sats_key, catalog, local_dir=None):
+    """
+    Ephemeris grid written by precompute_grid for a catalog. Local grids are
+    memory mapped so only the samples around a query time are paged in. From S3
+    only the header and satnum table are read here, with ranged GETs, and
+    grid_samples() fetches the two samples around each query time. Reread only
+    when the stored grid changes
+
+    Parameters:
+    obj_sats_key: object key of the catalog JSON, the grid is <name>.grid
+    catalog: dict from load_catalog_object()
+    local_dir: path to use as a stand-in for bucket
+
+    Returns:
+    grid dict from parse_grid(), None if there is no grid or it was built from
+    another version of the catalog
+    """
+    grid_key = obj_sats_key.replace(".json", ".grid")
+    cached = grid_cache.get(grid_key)
+
+    byte_range = None if local_dir is not None else (0, GRID_HEAD_BYTES)
+
+    try:
+        version, data = read_object_if_changed(grid_key, None if cached is None else cached["version"], local_dir, byte_range)
+        if data is not None:
+            header = parse_grid_header(data)
+            satnum_stop = header["satnum_offset"] + 4 * header["n"]
+            if len(data) < satnum_stop:
+                data = read_object_range(grid_key, version, 0, satnum_stop, local_dir)
+                if data is None:
+                    # replaced between the two reads, the next request reads the new one
+                    return None
+    except FileNotFoundError:
+        return None
+
+    if data is not None:
+        grid = parse_grid(data)
+        grid.update(obj_key=grid_key, obj_version=version, local_dir=local_dir, samples={})
+        cached = {"version": version, "grid": grid}
+        grid_cache[grid_key] = cached
+
+    grid = cached["grid"]
+    if grid["version"] != catalog["version"] or not np.array_equal(grid["satnum"], catalog["satnum"]):
+        return None
+    return grid
+
+
+def parse_grid(data):
+    """
+    Parse an ephemeris grid written by precompute_grid's grid_to_binary(), the
+    states are a view into data
+
+    Layout, all little endian:
+    header: GRID_MAGIC, uint32 N, uint32 T, float64 jd0, float64 fr0, float64 step_s,
+        uint32 length of catalog version
+    catalog version: utf-8 version of the catalog gridded, zero padded to 8 bytes
+    satnum: N uint32, zero padded to 8 bytes
+    states: T,N,6 float64, TEME position km and velocity km/s
+
+    Parameters:
+    data: bytes-like grid, or only its start up to the end of the satnum table
+
+    Returns:
+    dict with version, satnum, jd0, fr0, step_s, n_steps, states_offset and
+    states (None if data stops before the states)
+    """
+    grid = parse_grid_header(data)
+    n = grid.pop("n")
+
+    satnum = np.frombuffer(data, dtype="<u4", count=n, offset=grid.pop("satnum_offset"))
+    grid["satnum"] = satnum.astype(np.int64)
+
+    if len(data) >= grid["states_offset"] + grid["n_steps"] * n * 6 * 8:
+        grid["states"] = np.frombuffer(data, dtype="<f8", count=grid["n_steps"] * n * 6,
+                                       offset=grid["states_offset"]).reshape(grid["n_steps"], n, 6)
+    else:
+        grid["states"] = None
+
+    return grid
+
+
+def parse_grid_header(data):
+    """
+    Header fields of a grid and where its satnum table and states start, see
+    parse_grid() for the layout
+
+    Returns:
+    dict with version, n, n_steps, jd0, fr0, step_s, satnum_offset and states_offset
+    """
+    if bytes(data[:8]) != GRID_MAGIC:
+        raise ValueError("Not an ephemeris grid")
+
+    n, n_steps, jd0, fr0, step_s, version_len = struct.unpack("<IIdddI", bytes(data[8:44]))
+    offset = 44
+    version = bytes(data[offset:offset + version_len]).decode("UTF-8")
+    offset += version_len
+    offset += -offset % 8
+    satnum_offset = offset
+
+    offset += 4 * n
+    offset += -offset % 8
+
+    return {"version": version,
+            "n": n,
+            "n_steps": n_steps,
+            "jd0": jd0,
+            "fr0": fr0,
+            "step_s": step_s,
+            "satnum_offset": satnum_offset,
+            "states_offset": offset}
+
+
+def grid_samples(grid, k):
+    """
+    Grid samples k and k+1. From S3 both come from one ranged GET (the states
+    are time major, so they are adjacent), and the last GRID_SAMPLE_CACHE_SIZE
+    pairs are kept on the grid
+
+    Parameters:
+    grid: dict from load_grid() or parse_grid()
+    k: sample index, 0 to n_steps - 2
+
+    Returns:
+    N,6 np.array states at sample k and at k+1, None if the stored grid has
+    been replaced since it was loaded
+    """
+    if grid["states"] is not None:
+        return grid["states"][k], grid["states"][k + 1]
+
+    samples = grid["samples"]
+    pair = samples.pop(k, None)
+
+    if pair is None:
+        n = len(grid["satnum"])
+        sample_bytes = n * 6 * 8
+        start = grid["states_offset"] + k * sample_bytes
+        data = read_object_range(grid["obj_key"], grid["obj_version"], start, start + 2 * sample_bytes, grid["local_dir"])
+        if data is None:
+            return None
+        pair = np.frombuffer(data, dtype="<f8").reshape(2, n, 6)
+
+    # least recently used pairs drop out once the cache is full
+    samples[k] = pair
+    while len(samples) > GRID_SAMPLE_CACHE_SIZE:
+        samples.pop(next(iter(samples)))
+
+    return pair[0], pair[1]
+
+
+def interpolate_grid(grid, jd, fr):
+    """
+    TEME positions at one time by cubic Hermite interpolation between the two
+    grid samples around it, using positions and velocities at both. Error
+    against SGP4 depends on the grid step, see test_grid_error() in precompute_grid
+
+    Parameters:
+    grid: dict from parse_grid()
+    jd/fr: UTC julian date whole and fraction
+
+    Returns:
+    N,3 np.array TEME positions in km (nan where a sample failed), None if the
+    time is outside the grid or the stored grid has been replaced
+    """
+    t = ((jd - grid["jd0"]) + (fr - grid["fr0"])) * 86400.0 / grid["step_s"]
+    if t < 0 or t > grid["n_steps"] - 1:
+        return None
+
+    k = min(int(t), grid["n_steps"] - 2)
+    tau = t - k
+    h = grid["step_s"]
+
+    samples = grid_samples(grid, k)
+    if samples is None:
+        return None
+    s0, s1 = samples
+
+    h00 = 2 * tau ** 3 - 3 * tau ** 2 + 1
+    h10 = tau ** 3 - 2 * tau ** 2 + tau
+    h01 = -2 * tau ** 3 + 3 * tau ** 2
+    h11 = tau ** 3 - tau ** 2
+
+    return h00 * s0[:, :3] + h10 * h * s0[:, 3:] + h01 * s1[:, :3] + h11 * h * s1[:, 3:]
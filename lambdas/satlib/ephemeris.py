@@ -0,0 +1,277 @@
+"""
+Time, the sun and the TEME to ECEF rotation: skyfield timescale and
+ephemeris (or the analytic sun model), sun positions and shadow tests
+"""
+import os
+from functools import lru_cache
+from datetime import datetime, timezone
+
+import numpy as np
+
+from satlib import sgp4_numpy
+from satlib.geometry import DEG2RAD, RE_SHADOW_M, AU_M, SUN_RADIUS_M
+from satlib.metrics import timed, cache_metric
+from satlib.storage import get_s3, obj_bucket, lambda_tmp
+
+# "spk" uses the JPL kernel for the sun, "analytic" uses a low precision solar
+# model (arcminute level) and never downloads the kernel
+SUN_MODEL = os.environ.get("SUN_MODEL", "spk")
+
+obj_ephem_key = "de421.bsp"
+
+# "center" counts a satellite as sunlit when the center of the sun is visible
+# from it (skyfield's is_sunlit), "penumbra" also when only part of the sun disc
+# is (see shadow_state()). Every handler gets sunlit flags from sunlit_mask()
+SUNLIT_MODEL = os.environ.get("SUNLIT_MODEL", "center")
+
+# shadow_state classes
+SHADOW_UMBRA = 0
+SHADOW_PENUMBRA = 1
+SHADOW_SUNLIT = 2
+
+# opened ephemeris kernels, their sun/earth bodies and the timescale, loaded
+# once per container
+ephem_cache = {}
+ephem_bodies_cache = {}
+timescale_cache = {}
+
+
+def load_ephemeris(local_dir=None):
+    """
+    Use skyfield to load ephemeris from s3, the opened kernel is kept for the
+    life of the container. Returns None when SUN_MODEL is "analytic", which the
+    sun functions take to mean use the analytic model
+    """
+    if SUN_MODEL == "analytic":
+        return None
+
+    path = ephemeris_path(local_dir)
+
+    cache_metric("ephemeris", path in ephem_cache)
+
+    if path in ephem_cache:
+        return ephem_cache[path]
+
+    with timed("ephemeris"):
+        if local_dir is None and not os.path.exists(path):
+            print("Downloading ephem file from S3")
+            get_s3().download_file(Bucket=obj_bucket, Key=obj_ephem_key, Filename=path)
+
+        from skyfield.api import load_file
+        ephem_cache[path] = load_file(path)
+    return ephem_cache[path]
+
+
+def ephemeris_path(local_dir=None):
+    """
+    Path of the ephemeris file, in lambda tmp unless running locally
+    """
+    if local_dir is None:
+        return lambda_tmp + "/" + obj_ephem_key
+    else:
+        return local_dir + "/" + obj_ephem_key
+
+
+def ephem_bodies(ephem):
+    """
+    Sun and earth bodies of an ephemeris, looked up once per kernel
+
+    Parameters:
+    ephem: ephemeris object from load_ephemeris()
+
+    Returns:
+    dict with "sun", "earth" and "sun_earth" (sun relative to earth) bodies
+    """
+    key = id(ephem)
+
+    if key not in ephem_bodies_cache or ephem_bodies_cache[key][0] is not ephem:
+        sun, earth = ephem["sun"], ephem["earth"]
+        ephem_bodies_cache[key] = (ephem, {"sun": sun, "earth": earth, "sun_earth": sun - earth})
+
+    return ephem_bodies_cache[key][1]
+
+
+def get_timescale():
+    """
+    Skyfield timescale with builtin leap second tables, loaded once per container
+    """
+    if "builtin" not in timescale_cache:
+        from skyfield.api import load
+        timescale_cache["builtin"] = load.timescale(builtin=True)
+    return timescale_cache["builtin"]
+
+
+@lru_cache(maxsize=32)
+def utc_time(time_utc):
+    """
+    Parse a request time once, shared by propagation and sun calcs
+
+    Parameters:
+    time_utc: string in format YYYY-MM-DD HH:MM:SS
+
+    Returns:
+    datetime of time_utc
+    skyfield time of time_utc
+    """
+    time_dt = datetime.strptime(time_utc, "%Y-%m-%d %H:%M:%S")
+    return time_dt, get_timescale().utc(time_dt.replace(tzinfo=timezone.utc))
+
+
+def teme_to_itrs_rotation(time_ts):
+    """
+    Rotation matrix taking TEME vectors (sgp4 output frame) into ITRS/ECEF.
+    Without polar motion this is a z rotation by GMST, so it matches
+    EarthSatellite.at().frame_xyz(itrs) without computing nutation
+
+    Parameters:
+    time_ts: skyfield time
+
+    Returns:
+    3,3 np.array rotation matrix (3,3,T if time_ts is an array)
+    """
+    return sgp4_numpy.teme_to_itrs_rotation(time_ts.whole, time_ts.ut1_fraction)
+
+
+def get_sun_position_ecef_m(time_ts, ephem):
+    """
+    Geometric Earth->Sun vector in ECEF frame, as used for shadow calcs
+
+    Parameters:
+    time_ts: skyfield time
+    ephem: ephemeris object with sun data from load_ephemeris(), None for analytic model
+
+    Returns:
+    3, np.array of sun position in meters (T,3 if time_ts is an array)
+    """
+    if ephem is None:
+        return get_sun_position_analytic_ecef_m(time_ts)
+
+    sun_gcrs_m = ephem_bodies(ephem)["sun_earth"].at(time_ts).xyz.m
+    from skyfield.framelib import itrs
+    return np.einsum("ij...,j...->...i", itrs.rotation_at(time_ts), sun_gcrs_m)
+
+
+def get_sun_position_analytic_ecef_m(time_ts):
+    """
+    Low precision analytic Earth->Sun vector in ECEF frame, from the Astronomical
+    Almanac solar coordinates (good to about 1 arcmin from 1950 to 2050)
+
+    The ecliptic longitude includes aberration, so this is closer to the apparent
+    than the geometric sun, which is well inside the model accuracy.
+
+    Parameters:
+    time_ts: skyfield time
+
+    Returns:
+    3, np.array of sun position in meters (T,3 if time_ts is an array)
+    """
+    # days from J2000
+    n = time_ts.tt - 2451545.0
+
+    mean_lon = (280.460 + 0.9856474 * n) * DEG2RAD
+    mean_anom = (357.528 + 0.9856003 * n) * DEG2RAD
+    ecl_lon = mean_lon + (1.915 * np.sin(mean_anom) + 0.020 * np.sin(2 * mean_anom)) * DEG2RAD
+    obliquity = (23.439 - 0.0000004 * n) * DEG2RAD
+    dist_m = (1.00014 - 0.01671 * np.cos(mean_anom) - 0.00014 * np.cos(2 * mean_anom)) * AU_M
+
+    # equatorial of date, close enough to TEME to share its rotation into ECEF
+    sun_eq_m = dist_m * np.array([np.cos(ecl_lon),
+                                  np.cos(obliquity) * np.sin(ecl_lon),
+                                  np.sin(obliquity) * np.sin(ecl_lon)])
+
+    return np.einsum("ij...,j...->...i", teme_to_itrs_rotation(time_ts), sun_eq_m)
+
+
+def get_sun_direction_ecef(time_utc, ephem):
+    """
+    Get the sun unit vector in ECEF frame
+
+    Parameters:
+    time_utc: string in format YYYY-MM-DD HH:MM:SS of propagation end time
+    ephem: ephemeris object with sun data from load_ephemeris(), None for analytic model
+
+    Returns:
+    3, numpy array of sun unit vector from ECEF
+    """
+    # convert time to skyfield time format
+    time_dt, time_ts = utc_time(time_utc)
+
+    if ephem is None:
+        pos_ecef = get_sun_position_analytic_ecef_m(time_ts)
+        return pos_ecef / np.linalg.norm(pos_ecef)
+    
+    from skyfield.framelib import itrs
+    bodies = ephem_bodies(ephem)
+
+    pos = bodies["earth"].at(time_ts).observe(bodies["sun"])
+    pos_ecef = pos.frame_xyz(itrs).au
+    return pos_ecef / np.linalg.norm(pos_ecef)
+
+
+def sunlit_mask(sats_ecef, sun_ecef_m):
+    """
+    Vectorized check of whether each satellite can see the sun past a spherical
+    Earth. Same geometry as skyfield's is_sunlit (sun center visible), for all
+    sats at once. With SUNLIT_MODEL "penumbra" anything outside the umbra is
+    sunlit instead. Works on T,N grids too when sun_ecef_m is shaped T,1,3
+
+    Parameters:
+    sats_ecef: N,3 (or ...,3) np.array of satellite ECEF positions in meters
+    sun_ecef_m: 3, np.array of sun ECEF position in meters, or array that broadcasts against sats_ecef
+
+    Returns:
+    N, (or ...,) boolean np.array of whether satellite is sunlit
+    """
+    if SUNLIT_MODEL == "penumbra":
+        return shadow_state(sats_ecef, sun_ecef_m) != SHADOW_UMBRA
+
+    # line from satellite towards sun, earth center relative to satellite
+    to_sun = sun_ecef_m - sats_ecef
+    to_sun_unit = to_sun / np.linalg.norm(to_sun, axis=-1, keepdims=True)
+    earth_rel = -sats_ecef
+
+    minus_b = 2.0 * np.sum(to_sun_unit * earth_rel, axis=-1)
+    c = np.sum(earth_rel * earth_rel, axis=-1) - RE_SHADOW_M * RE_SHADOW_M
+
+    with np.errstate(invalid="ignore"):
+        far = (minus_b + np.sqrt(minus_b * minus_b - 4 * c)) / 2.0
+
+    # no intersection (nan) or earth fully behind the satellite means sunlit,
+    # sats that failed to propagate are never sunlit
+    valid = np.all(np.isfinite(sats_ecef), axis=-1)
+    return (np.nan_to_num(far) <= 0) & valid
+
+
+def shadow_state(sats_ecef, sun_ecef_m):
+    """
+    Conical shadow model: classify each satellite as in umbra, penumbra or
+    sunlit from the apparent radii of the Earth and Sun discs seen from the
+    satellite and the angle between their centers. Works on T,N grids too when
+    sun_ecef_m is shaped T,1,3, so the sun is only computed once per time
+
+    Parameters:
+    sats_ecef: N,3 (or ...,3) np.array of satellite ECEF positions in meters
+    sun_ecef_m: 3, np.array of sun ECEF position in meters, or array that broadcasts against sats_ecef
+
+    Returns:
+    N, (or ...,) int np.array of SHADOW_UMBRA, SHADOW_PENUMBRA or SHADOW_SUNLIT,
+        sats that failed to propagate are SHADOW_UMBRA
+    """
+    to_sun = sun_ecef_m - sats_ecef
+    dist_sun = np.linalg.norm(to_sun, axis=-1)
+    dist_earth = np.linalg.norm(sats_ecef, axis=-1)
+
+    with np.errstate(invalid="ignore"):
+        earth_radius_ang = np.arcsin(np.minimum(RE_SHADOW_M / dist_earth, 1.0))
+        sun_radius_ang = np.arcsin(SUN_RADIUS_M / dist_sun)
+
+        # angle between earth center and sun center seen from the satellite
+        cos_sep = -np.sum(sats_ecef * to_sun, axis=-1) / (dist_earth * dist_sun)
+        sep = np.arccos(np.clip(cos_sep, -1.0, 1.0))
+
+        state = np.full(sep.shape, SHADOW_SUNLIT)
+        state[sep < earth_radius_ang + sun_radius_ang] = SHADOW_PENUMBRA
+        state[sep <= earth_radius_ang - sun_radius_ang] = SHADOW_UMBRA
+
+    state[~np.all(np.isfinite(sats_ecef), axis=-1)] = SHADOW_UMBRA
+    return state
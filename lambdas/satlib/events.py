@@ -0,0 +1,35 @@
+"""
+Lambda event helpers shared by the handlers
+"""
+import json
+from datetime import datetime, timedelta
+
+
+def request_parameters(event):
+    """
+    Query string parameters, merged with a JSON body if there is one (POST)
+    """
+    params = dict(event.get("queryStringParameters") or {})
+
+    if event.get("body"):
+        params.update(json.loads(event["body"]))
+
+    return params
+
+
+def quantize_request(lat, lon, time_utc, deg, seconds):
+    """
+    Round observer to a multiple of deg and time down to a multiple of seconds
+    (since midnight)
+
+    Returns:
+    lat, lon floats and time_utc string in format YYYY-MM-DD HH:MM:SS
+    """
+    lat = round(round(lat / deg) * deg, 9)
+    lon = round(round(lon / deg) * deg, 9)
+
+    time_dt = datetime.strptime(time_utc, "%Y-%m-%d %H:%M:%S")
+    time_s = time_dt.hour * 3600 + time_dt.minute * 60 + time_dt.second
+    time_dt = time_dt - timedelta(seconds=time_s % seconds)
+
+    return lat, lon, time_dt.strftime("%Y-%m-%d %H:%M:%S")
@@ -0,0 +1,13 @@
+"""
+Markers and column order of the binary objects in the bucket. Writers are
+refresh_data's catalog_to_binary() and precompute_grid's grid_to_binary(),
+readers are parse_binary_catalog() and parse_grid()
+"""
+
+# binary catalog, see satlib.catalogs.parse_binary_catalog()
+CATALOG_MAGIC = b"SATCAT01"
+GROUPS_MAGIC = b"SATGRP01"
+CATALOG_COLUMNS = ["epoch", "bstar", "ndot", "nddot", "ecco", "argpo", "inclo", "mo", "no_kozai", "nodeo"]
+
+# ephemeris grid, see satlib.ephem_grid.parse_grid()
+GRID_MAGIC = b"SATGRD01"
@@ -0,0 +1,140 @@
+"""
+Earth constants and observer geometry: geodetic positions, the local
+zenith/north/east frame and az/el of satellites
+"""
+import os
+
+import numpy as np
+
+# Constants
+DEG2RAD = 0.017453292519943296
+RAD2DEG = 57.295779513082321
+RE_SEMIMAJOR_M = 6378137.0
+RE_SEMIMINOR_M = 6356752.0
+RE_MEAN_M = 6371008.0
+RE_SHADOW_M = 6378136.6
+AU_M = 149597870700.0
+SUN_RADIUS_M = 695700000.0
+
+# "float32" keeps satellite positions relative to the observer, and the line of
+# sight vectors built from them, in single precision, halving the memory and
+# bandwidth of the large track (T,N,3), batch (M,N,3) and pass search arrays.
+# They are differenced in float64 first, so only the rounding of the difference
+# is lost (az/el error around 1e-5 deg, see test_precision() in get_visible).
+# SGP4, time, frame rotations, sun and shadow math and map mode (whose matrix
+# products cancel large terms) stay float64. "float64" uses double precision
+# throughout
+PRECISION = os.environ.get("PRECISION", "float64")
+COMPUTE_DTYPE = np.float32 if PRECISION == "float32" else np.float64
+
+
+def lla_to_ecef(lla):
+    """
+    Convert lat/lon/alt to earth-centered position vector
+
+    See https://en.wikipedia.org/wiki/Geographic_coordinate_conversion#From_geodetic_to_ECEF_coordinates
+
+    Parameters:
+    lla: 3, np.array in deg/deg/m
+    
+    Returns:
+    3, np.array in meters
+    """
+    sin_lat = np.sin(lla[0] * DEG2RAD)
+    cos_lat = np.cos(lla[0] * DEG2RAD)
+    sin_lon = np.sin(lla[1] * DEG2RAD)
+    cos_lon = np.cos(lla[1] * DEG2RAD)
+
+    ratio_square = (RE_SEMIMINOR_M ** 2) / (RE_SEMIMAJOR_M ** 2)
+    ecc_square = 1 - ratio_square
+
+    N = RE_SEMIMAJOR_M / np.sqrt(1 - ecc_square * sin_lat * sin_lat)
+
+    x = (N + lla[2]) * cos_lat * cos_lon
+    y = (N + lla[2]) * cos_lat * sin_lon
+    z = (ratio_square * N + lla[2]) * sin_lat
+
+    return np.array([x, y, z])
+
+
+def lla_to_ecef_normal(lla):
+    """
+    Normal/zenith direction in ECEF frame
+
+    Parameters:
+    lla: 3, np.array lat/lon/alt in deg/deg/m
+
+    Returns:
+    3, np.array unit normal vector of lla position
+    """
+    lat = lla[0] * DEG2RAD
+    lon = lla[1] * DEG2RAD
+    
+    return np.array([np.cos(lat) * np.cos(lon),
+                     np.cos(lat) * np.sin(lon),
+                     np.sin(lat)])
+
+
+def local_frame(lla):
+    """
+    Observer position and local zenith/north/east unit vectors in ECEF
+
+    Parameters:
+    lla: 3, np.array lat/lon/alt in deg/deg/m (or 3,M for M observers)
+
+    Returns:
+    3, (or 3,M) np.array position in meters
+    3, (or 3,M) np.array normal (zenith) unit vector
+    3, (or 3,M) np.array north unit vector
+    3, (or 3,M) np.array east unit vector
+    """
+    pos = lla_to_ecef(lla)
+    normal = lla_to_ecef_normal(lla)
+
+    # north and east unit vectors used for azimuth calcs
+    north = np.zeros_like(normal)
+    north[2] = 1.0
+    north = north - np.sum(north * normal, axis=0) * normal
+    north = north / np.linalg.norm(north, axis=0)
+    east = np.cross(north, normal, axis=0)
+
+    return pos, normal, north, east
+
+
+def observer_relative(sats_ecef, pos):
+    """
+    Satellite positions relative to the observer, differenced in float64 and
+    stored as COMPUTE_DTYPE (see PRECISION)
+
+    Parameters:
+    sats_ecef: ...,3 np.array of ECEF positions in meters
+    pos: 3, np.array observer ECEF position in meters, or array that broadcasts against sats_ecef
+
+    Returns:
+    ...,3 np.array of COMPUTE_DTYPE line of sight vectors in meters
+    """
+    return (sats_ecef - pos).astype(COMPUTE_DTYPE, copy=False)
+
+
+def ecef_to_az_el(sats_ecef, lla):
+    """
+    Azimuth and elevation of ECEF positions as seen from lla location
+
+    Parameters:
+    sats_ecef: ...,3 np.array of ECEF positions in meters
+    lla: 3, np.array lat/lon/alt in deg/deg/alt
+
+    Returns:
+    ..., np.array az in deg, CW from North (-180 to 180)
+    ..., np.array el in deg
+    """
+    pos, normal, north, east = local_frame(lla)
+
+    sat_rel = observer_relative(sats_ecef, pos)
+    sat_rel_unit = sat_rel / np.linalg.norm(sat_rel, axis=-1, keepdims=True)
+    normal, north, east = [v.astype(sat_rel.dtype) for v in (normal, north, east)]
+
+    el = 90.0 - np.arccos(np.clip(sat_rel_unit @ normal, -1.0, 1.0)) * RAD2DEG
+    az = np.arctan2(sat_rel_unit @ east, sat_rel_unit @ north) * RAD2DEG
+
+    return az, el
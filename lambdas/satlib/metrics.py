@@ -0,0 +1,170 @@
+"""
+Per request metrics of the query lambdas: stage timings, counts and cache
+hits/misses, printed as one CloudWatch embedded metric format line per request
+"""
+import os
+import json
+import time
+import threading
+from contextlib import contextmanager
+
+import numpy as np
+
+# "emf" prints one CloudWatch embedded metric format line per request with stage
+# timings, counts and cache hits/misses, "off" prints nothing (local mode still
+# keeps requests for metrics_report())
+METRICS = os.environ.get("METRICS", "emf")
+METRICS_NAMESPACE = os.environ.get("METRICS_NAMESPACE", "sat-finder")
+# "on" prints the full result of every request, which costs time and log volume
+# with large catalogs
+LOG_RESULTS = os.environ.get("LOG_RESULTS", "off")
+METRICS_HISTORY_SIZE = 1000
+
+# metrics of the request running on this thread, see request_metrics()
+metrics_local = threading.local()
+# finished local mode requests, see metrics_report()
+metrics_history = []
+
+
+@contextmanager
+def request_metrics(function, event):
+    """
+    Collect metrics for one handler call: stage timings from timed(), counts
+    from count_metric() and cache lookups from cache_metric(). When the request
+    ends one EMF line is printed (METRICS "emf"), and in local mode the request
+    is kept for metrics_report()
+
+    Parameters:
+    function: handler name, the Function dimension
+    event: lambda event, local mode if it has localTestDir
+
+    Yields:
+    dict of metrics being collected, handlers set "mode" (the Mode dimension)
+    """
+    metrics = {"function": function, "mode": "default", "stages": {}, "counts": {}, "caches": {}, "errors": 0}
+    metrics_local.current = metrics
+    start = time.perf_counter()
+
+    try:
+        yield metrics
+    except Exception:
+        metrics["errors"] = 1
+        raise
+    finally:
+        metrics["total_ms"] = (time.perf_counter() - start) * 1000.0
+        metrics_local.current = None
+
+        if METRICS == "emf":
+            print(json.dumps(emf_record(metrics)))
+        if "localTestDir" in event:
+            metrics_history.append(metrics)
+            del metrics_history[:-METRICS_HISTORY_SIZE]
+
+
+@contextmanager
+def timed(stage):
+    """
+    Add the time spent in the block to a stage of the current request. Does
+    nothing outside a request, e.g. in a worker thread or test function
+    """
+    metrics = getattr(metrics_local, "current", None)
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        if metrics is not None:
+            metrics["stages"][stage] = metrics["stages"].get(stage, 0.0) + (time.perf_counter() - start) * 1000.0
+
+
+def count_metric(name, value):
+    """
+    Add value to a count of the current request (e.g. satellites, results)
+    """
+    metrics = getattr(metrics_local, "current", None)
+    if metrics is not None:
+        metrics["counts"][name] = metrics["counts"].get(name, 0) + int(value)
+
+
+def cache_metric(cache, hit):
+    """
+    Record a hit or miss of one of the module caches for the current request
+    """
+    metrics = getattr(metrics_local, "current", None)
+    if metrics is not None:
+        outcomes = metrics["caches"].setdefault(cache, {"hits": 0, "misses": 0})
+        outcomes["hits" if hit else "misses"] += 1
+
+
+def metric_values(metrics):
+    """
+    Flatten request metrics into metric name: (value, CloudWatch unit)
+    """
+    values = {stage + "_ms": (ms, "Milliseconds") for stage, ms in metrics["stages"].items()}
+    values["total_ms"] = (metrics["total_ms"], "Milliseconds")
+
+    for count, value in metrics["counts"].items():
+        values[count] = (value, "Count")
+    for cache, outcomes in metrics["caches"].items():
+        for outcome, value in outcomes.items():
+            values["{}_cache_{}".format(cache, outcome)] = (value, "Count")
+    values["errors"] = (metrics["errors"], "Count")
+
+    return values
+
+
+def emf_record(metrics):
+    """
+    CloudWatch embedded metric format record of a finished request, with
+    Function and Mode dimensions
+    """
+    values = metric_values(metrics)
+
+    record = {"_aws": {"Timestamp": int(time.time() * 1000),
+                       "CloudWatchMetrics": [{"Namespace": METRICS_NAMESPACE,
+                                              "Dimensions": [["Function", "Mode"]],
+                                              "Metrics": [{"Name": name, "Unit": unit} for name, (_, unit) in values.items()]}]},
+              "Function": metrics["function"],
+              "Mode": metrics["mode"]}
+    record.update({name: value for name, (value, _) in values.items()})
+
+    return record
+
+
+def metrics_report(clear=False):
+    """
+    Print a summary of the requests handled in local mode (e.g. test_local or
+    local_server): for each handler and mode, the median, p95 and total of every
+    stage time and count over the requests that recorded it
+
+    Parameters:
+    clear: forget the requests once reported
+
+    Returns:
+    dict of "function/mode": {metric name: {"n", "median", "p95", "total"}}
+    """
+    grouped = {}
+    for metrics in metrics_history:
+        group = grouped.setdefault("{}/{}".format(metrics["function"], metrics["mode"]), {})
+        for metric, (value, _) in metric_values(metrics).items():
+            group.setdefault(metric, []).append(value)
+
+    report = {}
+    for group, metric_lists in grouped.items():
+        print("{} ({} requests)".format(group, len(metric_lists["total_ms"])))
+        print("  {:<28} {:>6} {:>10} {:>10} {:>12}".format("metric", "n", "median", "p95", "total"))
+
+        report[group] = {}
+        for metric, values in metric_lists.items():
+            values = np.array(values, dtype=float)
+            summary = {"n": int(values.size),
+                       "median": float(np.median(values)),
+                       "p95": float(np.percentile(values, 95)),
+                       "total": float(np.sum(values))}
+            report[group][metric] = summary
+            print("  {:<28} {:>6} {:>10.3f} {:>10.3f} {:>12.3f}".format(metric, summary["n"], summary["median"],
+                                                                      summary["p95"], summary["total"]))
+
+    if clear:
+        metrics_history.clear()
+
+    return report
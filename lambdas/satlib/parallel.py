@@ -0,0 +1,114 @@
+"""
+Sharding catalog work over forked worker processes, see run_sharded()
+"""
+import os
+import mmap
+import traceback
+
+import numpy as np
+
+# "serial" propagates in this process, "fork" shards the catalog over forked
+# worker processes that write into shared memory, see run_sharded()
+PARALLEL = os.environ.get("PARALLEL", "serial")
+# worker processes, 0 is one per available CPU (so a single vCPU runs serially)
+PARALLEL_WORKERS = int(os.environ.get("PARALLEL_WORKERS", "0"))
+# satellites per chunk, catalogs up to this size are never sharded
+PARALLEL_CHUNK = int(os.environ.get("PARALLEL_CHUNK", "2000"))
+
+
+def run_sharded(n, work, outputs=None, chunk=PARALLEL_CHUNK):
+    """
+    Run work over satellites 0..n-1 in chunks. With PARALLEL "fork" and more
+    than one chunk and worker, the chunks are spread over forked processes:
+    they inherit the catalog (sgp4 Satrec objects do not pickle) and write into
+    output arrays in shared memory, only the return values of work are sent
+    back. Otherwise the chunks run here, in order
+
+    Parameters:
+    n: number of satellites
+    work: function(start, stop, out) for satellites start..stop-1, out holds
+        the [start:stop] rows of every output array, return values must pickle
+    outputs: dict of name: (shape after the first axis, dtype), arrays of n rows
+    chunk: satellites per chunk
+
+    Returns:
+    dict of name: np.array per outputs entry
+    list of work return values in chunk order
+    """
+    outputs = outputs or {}
+    bounds = [(start, min(start + chunk, n)) for start in range(0, n, chunk)]
+    workers = min(parallel_workers(), len(bounds)) if PARALLEL == "fork" else 1
+
+    arrays = {}
+    for name, (shape, dtype) in outputs.items():
+        shape = (n,) + tuple(shape)
+        count = int(np.prod(shape))
+        if workers > 1:
+            # anonymous shared mapping inherited by the forked workers, unlike
+            # multiprocessing.shared_memory it does not need /dev/shm (lambda has none)
+            shared = mmap.mmap(-1, max(count * np.dtype(dtype).itemsize, 1))
+            arrays[name] = np.frombuffer(shared, dtype=dtype, count=count).reshape(shape)
+        else:
+            arrays[name] = np.empty(shape, dtype=dtype)
+
+    def run_chunk(start, stop):
+        return work(start, stop, {name: array[start:stop] for name, array in arrays.items()})
+
+    if workers <= 1:
+        return arrays, [run_chunk(start, stop) for start, stop in bounds]
+
+    import multiprocessing
+    ctx = multiprocessing.get_context("fork")
+    procs = []
+    for w in range(workers):
+        recv_conn, send_conn = ctx.Pipe(duplex=False)
+        proc = ctx.Process(target=sharded_worker, args=(run_chunk, bounds[w::workers], send_conn), daemon=True)
+        proc.start()
+        send_conn.close()
+        procs.append((proc, recv_conn))
+
+    results = [None] * len(bounds)
+    errors = []
+    for w, (proc, recv_conn) in enumerate(procs):
+        try:
+            status, value = recv_conn.recv()
+        except EOFError:
+            status, value = "error", "worker exited without a result"
+        recv_conn.close()
+        proc.join()
+
+        if status == "error":
+            errors.append(value)
+        else:
+            results[w::workers] = value
+
+    if errors:
+        raise RuntimeError("Parallel worker failed:\n{}".format(errors[0]))
+
+    return arrays, results
+
+
+def sharded_worker(run_chunk, bounds, conn):
+    """
+    Body of a forked run_sharded() worker: run its chunks and send back the
+    return values (or the traceback)
+    """
+    try:
+        conn.send(("ok", [run_chunk(start, stop) for start, stop in bounds]))
+    except Exception:
+        conn.send(("error", traceback.format_exc()))
+    finally:
+        conn.close()
+
+
+def parallel_workers():
+    """
+    Worker processes for run_sharded(), PARALLEL_WORKERS or one per available CPU
+    """
+    if PARALLEL_WORKERS > 0:
+        return PARALLEL_WORKERS
+
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
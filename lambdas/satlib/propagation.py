@@ -0,0 +1,286 @@
+"""
+SGP4 propagation of whole catalogs to ECEF positions and sunlit flags, with
+either the sgp4 package or the NumPy port in sgp4_numpy
+"""
+import os
+
+import numpy as np
+
+from sgp4.api import Satrec, SatrecArray, jday
+
+from satlib import sgp4_numpy
+from satlib.ephem_grid import interpolate_grid
+from satlib.ephemeris import utc_time, get_timescale, teme_to_itrs_rotation, get_sun_position_ecef_m, sunlit_mask
+from satlib.parallel import run_sharded
+
+# "sgp4" propagates with the sgp4 package (compiled), "numpy" with the pure
+# NumPy port in sgp4_numpy.py
+PROPAGATOR = os.environ.get("PROPAGATOR", "sgp4")
+
+MASTER_PROPAGATION_CACHE_SIZE = 8
+# time_utc: (master catalog, ephemeris, positions, sunlit), see propagate_catalog_ecef_sunlit()
+master_propagation_cache = {}
+
+
+def build_satrec_array(sats):
+    """
+    Parse every TLE in sats dict into a single vectorized propagator
+
+    Parameters:
+    sats: dict of sat name (key) and tle (value)
+
+    Returns:
+    propagator with one entry per sat, in sats dict order, see build_propagator()
+    """
+    return build_propagator({"satrec_list": [Satrec.twoline2rv(tle[0], tle[1]) for tle in sats.values()]})
+
+
+def build_propagator(catalog):
+    """
+    Vectorized propagator for a whole catalog: an sgp4 SatrecArray, or the
+    sgp4_numpy element set when PROPAGATOR is "numpy"
+
+    Parameters:
+    catalog: dict with satrec_list and/or elements, see load_catalog_object()
+
+    Returns:
+    SatrecArray or sgp4_numpy element set dict, either one works with propagate_teme()
+    """
+    if PROPAGATOR == "numpy":
+        elements = catalog.get("elements")
+        if elements is None:
+            elements = sgp4_numpy.elements_from_satrecs(catalog["satrec_list"])
+        return sgp4_numpy.sgp4init(elements)
+
+    return SatrecArray(catalog["satrec_list"])
+
+
+def propagator_subset(catalog, idx):
+    """
+    Propagator for only the catalog satellites at idx
+    """
+    if isinstance(catalog["satrecs"], dict):
+        return sgp4_numpy.subset(catalog["satrecs"], np.asarray(idx, dtype=int))
+
+    return SatrecArray([catalog["satrec_list"][i] for i in idx])
+
+
+def propagate_teme(satrecs, jd, fr):
+    """
+    Propagate every satellite to every time with either propagator
+
+    Parameters:
+    satrecs: SatrecArray or sgp4_numpy element set, see build_propagator()
+    jd: T, np.array UTC julian date whole part
+    fr: T, np.array UTC julian date fraction
+
+    Returns:
+    N,T np.array of sgp4 error codes (0 is success)
+    N,T,3 np.array TEME positions in km
+    N,T,3 np.array TEME velocities in km/s
+    """
+    if isinstance(satrecs, dict):
+        return sgp4_numpy.sgp4(satrecs, jd, fr)
+
+    return satrecs.sgp4(jd, fr)
+
+
+def propagate_ecef_sunlit(sats, time_utc, ephem, satrecs=None):
+    """
+    Calc ECEF position and sunlit status of each sat in sats dict at time
+
+    All satellites are propagated in a single vectorized SGP4 call, then rotated
+    TEME -> ITRS with one rotation matrix shared by the whole catalog. Results
+    match propagate_ecef_sunlit_loop (the per-satellite skyfield path) to within
+    1 mm in position; sunlit only differs for satellites within a few meters of
+    the shadow boundary. Satellites with SGP4 errors (e.g. decayed) get nan
+    positions and sunlit False.
+
+    Parameters:
+    sats: dict of sat name (key) and tle (value)
+    time_utc: string in format YYYY-MM-DD HH:MM:SS of propagation end time
+    ephem: ephemeris object with sun data from load_ephemeris()
+    satrecs: propagator for sats if already parsed (see load_catalog_object()), otherwise built here
+    
+    Returns:
+    N,3 ECEF position array in meters
+    N, boolean array of whether satellite is sunlit in position
+    """
+    # convert time to skyfield time format
+    time_dt, time_ts = utc_time(time_utc)
+
+    if satrecs is None:
+        satrecs = build_satrec_array(sats)
+
+    # sgp4 wants UTC julian date split into whole and fraction
+    jd, fr = jday(time_dt.year, time_dt.month, time_dt.day,
+                  time_dt.hour, time_dt.minute, time_dt.second)
+
+    err, pos_teme_km, _ = propagate_teme(satrecs, np.array([jd]), np.array([fr]))
+    pos_teme_m = pos_teme_km[:, 0, :] * 1000.0
+    pos_teme_m[err[:, 0] != 0, :] = np.nan
+
+    return teme_to_ecef_sunlit(pos_teme_m, time_ts, ephem)
+
+
+def teme_to_ecef_sunlit(pos_teme_m, time_ts, ephem):
+    """
+    Rotate TEME positions at one time to ECEF and find which are sunlit
+
+    Parameters:
+    pos_teme_m: N,3 TEME position array in meters
+    time_ts: skyfield time of the positions
+    ephem: ephemeris object with sun data from load_ephemeris()
+
+    Returns:
+    N,3 ECEF position array in meters
+    N, boolean array of whether satellite is sunlit in position
+    """
+    pos_ecef = pos_teme_m @ teme_to_itrs_rotation(time_ts).T
+
+    sun_ecef_m = get_sun_position_ecef_m(time_ts, ephem)
+    sunlit = sunlit_mask(pos_ecef, sun_ecef_m)
+
+    return pos_ecef, sunlit
+
+
+def propagate_catalog_ecef_sunlit(catalog, time_utc, ephem):
+    """
+    propagate_ecef_sunlit() for a whole catalog, sharded over worker processes
+    with PARALLEL "fork" (see run_sharded()). Results are the same either way.
+    If the catalog has an ephemeris grid covering the time (EPHEM_GRID "on")
+    positions are interpolated from it instead. Views of a master catalog
+    (with master and master_idx, see group_view() in satlib.catalogs) slice the
+    master's positions, which are propagated once per time for all views
+
+    Parameters:
+    catalog: dict from load_catalog_object()
+    time_utc: string in format YYYY-MM-DD HH:MM:SS of propagation end time
+    ephem: ephemeris object with sun data from load_ephemeris()
+
+    Returns:
+    N,3 ECEF position array in meters
+    N, boolean array of whether satellite is sunlit in position
+    """
+    if "master" in catalog:
+        master = catalog["master"]
+        entry = master_propagation_cache.pop(time_utc, None)
+
+        if entry is None or entry[0] is not master or entry[1] is not ephem:
+            entry = (master, ephem, propagate_catalog_ecef_sunlit(master, time_utc, ephem))
+
+        # least recently used times drop out once the cache is full
+        master_propagation_cache[time_utc] = entry
+        while len(master_propagation_cache) > MASTER_PROPAGATION_CACHE_SIZE:
+            master_propagation_cache.pop(next(iter(master_propagation_cache)))
+
+        pos_ecef, sunlit = entry[2]
+        return pos_ecef[catalog["master_idx"]], sunlit[catalog["master_idx"]]
+
+    grid = catalog.get("grid")
+    if grid is not None:
+        time_dt, time_ts = utc_time(time_utc)
+        jd, fr = jday(time_dt.year, time_dt.month, time_dt.day,
+                      time_dt.hour, time_dt.minute, time_dt.second)
+        pos_teme_km = interpolate_grid(grid, jd, fr)
+        if pos_teme_km is not None:
+            return teme_to_ecef_sunlit(pos_teme_km * 1000.0, time_ts, ephem)
+
+    n = len(catalog["names"])
+
+    def work(start, stop, out):
+        satrecs = catalog["satrecs"] if stop - start == n else propagator_subset(catalog, np.arange(start, stop))
+        out["pos"][:], out["sunlit"][:] = propagate_ecef_sunlit(catalog["sats"], time_utc, ephem, satrecs)
+
+    arrays, _ = run_sharded(n, work, {"pos": ((3,), float), "sunlit": ((), bool)})
+    return arrays["pos"], arrays["sunlit"]
+
+
+def propagate_track_ecef_sunlit(satrecs, time_utc, offsets_s, ephem):
+    """
+    Calc ECEF position and sunlit status of each sat at every time in a track,
+    with one SGP4 call over the whole time vector
+
+    Parameters:
+    satrecs: propagator for sats, see build_propagator()
+    time_utc: string in format YYYY-MM-DD HH:MM:SS of track start time
+    offsets_s: T, np.array seconds after time_utc
+    ephem: ephemeris object with sun data from load_ephemeris()
+
+    Returns:
+    T,N,3 ECEF position array in meters
+    T,N, boolean array of whether satellite is sunlit in position
+    """
+    time_dt, _ = utc_time(time_utc)
+
+    time_ts = get_timescale().utc(time_dt.year, time_dt.month, time_dt.day,
+                                  time_dt.hour, time_dt.minute, time_dt.second + offsets_s)
+
+    jd, fr = jday(time_dt.year, time_dt.month, time_dt.day,
+                  time_dt.hour, time_dt.minute, time_dt.second)
+
+    err, pos_teme_km, _ = propagate_teme(satrecs, np.full(offsets_s.size, jd), fr + offsets_s / 86400.0)
+    pos_teme_m = np.swapaxes(pos_teme_km, 0, 1) * 1000.0
+    pos_teme_m[err.T != 0, :] = np.nan
+
+    rot = np.moveaxis(teme_to_itrs_rotation(time_ts), -1, 0)
+    pos_ecef = np.einsum("tij,tnj->tni", rot, pos_teme_m)
+
+    sun_ecef_m = get_sun_position_ecef_m(time_ts, ephem)
+    sunlit = sunlit_mask(pos_ecef, sun_ecef_m.reshape(-1, 1, 3))
+
+    return pos_ecef, sunlit
+
+
+def propagate_ecef_sunlit_loop(sats, time_utc, ephem):
+    """
+    Reference version of propagate_ecef_sunlit that builds one skyfield
+    EarthSatellite per TLE. Much slower, kept to check the batched path.
+
+    Parameters:
+    sats: dict of sat name (key) and tle (value)
+    time_utc: string in format YYYY-MM-DD HH:MM:SS of propagation end time
+    ephem: ephemeris object with sun data from load_ephemeris()
+    
+    Returns:
+    N,3 ECEF position array in meters
+    N, boolean list of whether satellite is sunlit in position
+    """
+    from skyfield.sgp4lib import EarthSatellite
+    from skyfield.framelib import itrs
+
+    # convert time to skyfield time format
+    time_dt, time_ts = utc_time(time_utc)
+
+    pos_list = []
+    sunlit_list = []
+
+    for sat_name, tle in sats.items():
+        sat = EarthSatellite(line1=tle[0], line2=tle[1])
+        pos = sat.at(time_ts)
+        pos_list.append(pos.frame_xyz(itrs).m)
+        sunlit_list.append(bool(pos.is_sunlit(ephem)))
+
+    return np.array(pos_list), sunlit_list
+
+
+def test_propagation(sats, time_utc, ephem):
+    """
+    Compares batched propagate_ecef_sunlit against the per-satellite skyfield
+    loop, e.g. with sats from a lambda's read_satellite_data()
+
+    Parameters:
+    sats: dict of sat name (key) and tle (value)
+    time_utc: string in format YYYY-MM-DD HH:MM:SS
+    ephem: ephemeris object with sun data from load_ephemeris()
+    """
+    pos_batch, sunlit_batch = propagate_ecef_sunlit(sats, time_utc, ephem)
+    pos_loop, sunlit_loop = propagate_ecef_sunlit_loop(sats, time_utc, ephem)
+
+    # skyfield reports failed (nan) sats as sunlit, so only compare valid ones
+    valid = np.all(np.isfinite(pos_loop), axis=1)
+    pos_err = np.linalg.norm(pos_batch[valid] - pos_loop[valid], axis=1)
+    sunlit_diff = int(np.sum(np.array(sunlit_loop)[valid] != sunlit_batch[valid]))
+
+    print("Max position difference (m): {}".format(np.max(pos_err)))
+    print("Sunlit mismatches: {} of {}".format(sunlit_diff, int(np.sum(valid))))
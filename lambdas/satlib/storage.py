@@ -0,0 +1,190 @@
+"""
+Objects in the private bucket, or in a local directory standing in for it
+(local_dir). Imports nothing heavy, boto3 on first S3 access and numpy only to
+memory map local files
+"""
+import os
+import json
+import gzip
+
+obj_bucket = "sat-finder-private"
+lambda_tmp = "/tmp"
+
+# boto3 is imported and the client created on first S3 access, see get_s3()
+s3_cache = {}
+
+
+def get_s3():
+    """
+    S3 client, created on first use so that importing the module (and local
+    runs, which never touch S3) skip the boto3 import
+    """
+    if "client" not in s3_cache:
+        import boto3
+        s3_cache["client"] = boto3.client("s3")
+    return s3_cache["client"]
+
+
+def read_object_if_changed(obj_key, version, local_dir=None, byte_range=None):
+    """
+    Conditional read of an object: S3 only returns the body if its ETag no
+    longer matches version, locally the file name, modified time and size are
+    used and the file is memory mapped
+
+    Parameters:
+    obj_key: object key (file name)
+    version: version string from a previous read, None to always read
+    local_dir: path to use as a stand-in for bucket
+    byte_range: (start, stop) to only read those bytes (a ranged GET from S3,
+        fewer if the object is shorter), None for the whole object
+
+    Returns:
+    version string of the stored data
+    bytes-like object contents, None if version is unchanged
+
+    Raises FileNotFoundError if the object does not exist, PermissionError if
+    S3 denies the read (which is also its answer for a missing key without
+    s3:ListBucket)
+    """
+    if local_dir is None:
+        args = {"Bucket": obj_bucket, "Key": obj_key}
+        if version is not None:
+            args["IfNoneMatch"] = version
+        if byte_range is not None:
+            args["Range"] = "bytes={}-{}".format(byte_range[0], byte_range[1] - 1)
+
+        try:
+            data_s3 = get_s3().get_object(**args)
+        except get_s3().exceptions.NoSuchKey as e:
+            raise FileNotFoundError(obj_key) from e
+        except get_s3().exceptions.ClientError as e:
+            if e.response["Error"]["Code"] in ["304", "NotModified"]:
+                return version, None
+            if e.response["Error"]["Code"] in ["403", "AccessDenied"]:
+                raise PermissionError(obj_key) from e
+            raise
+
+        return data_s3["ETag"], data_s3["Body"].read()
+    else:
+        local_path = local_dir + "/" + obj_key
+        stat = os.stat(local_path)
+        local_version = "{}-{}-{}".format(obj_key, stat.st_mtime_ns, stat.st_size)
+
+        if local_version == version:
+            return version, None
+
+        # numpy is only needed here, refresh_data reads whole objects without it
+        import numpy as np
+        data = np.memmap(local_path, dtype=np.uint8, mode="r")
+        return local_version, data if byte_range is None else data[byte_range[0]:byte_range[1]]
+
+
+def read_object_range(obj_key, version, start, stop, local_dir=None):
+    """
+    Bytes start to stop of an object, as long as it is still the version read
+    before (an S3 ranged GET with If-Match, locally a slice of the memory
+    mapped file), so pieces of one object never mix with a newer upload
+
+    Parameters:
+    obj_key: object key (file name)
+    version: version string from read_object_if_changed()
+    start/stop: byte range
+    local_dir: path to use as a stand-in for bucket
+
+    Returns:
+    bytes-like object contents, None if the object has changed since version
+
+    Raises FileNotFoundError if the object does not exist
+    """
+    if local_dir is None:
+        try:
+            data_s3 = get_s3().get_object(Bucket=obj_bucket, Key=obj_key, IfMatch=version,
+                                          Range="bytes={}-{}".format(start, stop - 1))
+        except get_s3().exceptions.NoSuchKey as e:
+            raise FileNotFoundError(obj_key) from e
+        except get_s3().exceptions.ClientError as e:
+            if e.response["Error"]["Code"] in ["412", "PreconditionFailed"]:
+                return None
+            raise
+
+        return data_s3["Body"].read()
+    else:
+        local_version, data = read_object_if_changed(obj_key, None, local_dir, (start, stop))
+        return data if local_version == version else None
+
+
+def read_object(obj_key, local_dir=None):
+    """
+    Contents of a stored object as written by store_object() (still gzipped if
+    it was stored gzipped)
+
+    Raises FileNotFoundError if the object does not exist
+    """
+    if local_dir is None:
+        try:
+            return get_s3().get_object(Bucket=obj_bucket, Key=obj_key)["Body"].read()
+        except get_s3().exceptions.NoSuchKey as e:
+            raise FileNotFoundError(obj_key) from e
+    else:
+        with open(local_dir + "/" + obj_key, "rb") as fptr:
+            return fptr.read()
+
+
+def read_stored_metadata(obj_key, local_dir=None):
+    """
+    Metadata saved with an object by store_object(), empty if there is no object
+    """
+    if local_dir is None:
+        try:
+            return get_s3().head_object(Bucket=obj_bucket, Key=obj_key)["Metadata"]
+        except get_s3().exceptions.ClientError as e:
+            if e.response["Error"]["Code"] in ["404", "NoSuchKey", "NotFound"]:
+                return {}
+            raise
+    else:
+        meta_path = local_dir + "/" + obj_key + ".meta"
+        if not os.path.exists(meta_path):
+            return {}
+        with open(meta_path) as fptr:
+            return json.load(fptr)
+
+
+def store_object(obj_key, body, local_dir=None, meta=None, gzipped=False):
+    """
+    Write an object, with its metadata if there is any (next to it as .meta
+    locally). Local files are written to a temporary file and renamed over the
+    old one, so readers (which memory map them) never see a partial file
+
+    Parameters:
+    obj_key: object key (file name)
+    body: bytes to store
+    local_dir: path to use as a stand-in for bucket
+    meta: dict of metadata strings, None for none
+    gzipped: body is gzip compressed, sets the S3 content encoding
+    """
+    if local_dir is None:
+        args = {"Body": body, "Bucket": obj_bucket, "Key": obj_key}
+        if meta is not None:
+            args["Metadata"] = meta
+        if gzipped:
+            args["ContentEncoding"] = "gzip"
+        get_s3().put_object(**args)
+    else:
+        local_path = local_dir + "/" + obj_key
+        with open(local_path + ".tmp", "wb") as fptr:
+            fptr.write(body)
+        os.replace(local_path + ".tmp", local_path)
+
+        if meta is not None:
+            with open(local_path + ".meta.tmp", "w") as fptr:
+                json.dump(meta, fptr)
+            os.replace(local_path + ".meta.tmp", local_path + ".meta")
+
+
+def maybe_gunzip(data):
+    """
+    Decompress objects that refresh_data stored gzipped, pass anything else through
+    """
+    if bytes(data[:2]) == b"\x1f\x8b":
+        return gzip.decompress(data)
+    return data